@@ -0,0 +1,65 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # so the app's modules can be imported
+import extraction
+import pages
+import tools
+
+###################################################################
+#     Benchmark of the text extraction backends on HTML pages     #
+###################################################################
+
+# Run with: python benchmarks/bench_extraction.py [--iterations N] [--term TERM] [--fixtures-dir DIR]
+# For each page in the fixtures directory, and each available backend, reports the mean time to extract the page's text,
+# the throughput, the length of the extracted text, its number of different words (tokens, see tools.get_token_counts)
+# and the number of times the term occurs in it.
+# The pages in the default fixtures directory are synthetic (see generate_fixtures), so the timings are only indicative.
+# For representative numbers, pass --fixtures-dir with a directory of real saved article pages.
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'articles')
+
+
+# Split the page into chunks the same size as when a page is downloaded.
+def get_chunks(html: bytes) -> list:
+    return [html[i:i + pages.PAGE_CHUNK_BYTES] for i in range(0, len(html), pages.PAGE_CHUNK_BYTES)]
+
+
+def run(iterations: int, term: str, fixtures_dir: str = None):
+    if fixtures_dir is None:
+        fixtures_dir = FIXTURES_DIR
+    fixtures = sorted(name for name in os.listdir(fixtures_dir) if name.endswith('.html'))
+    backends = extraction.get_available_backends()
+    print(f'{"page":<36} {"backend":<8} {"KB":>6} {"ms/page":>9} {"MB/s":>7} {"text len":>9} {"tokens":>7} {"count":>6}')
+
+    totals = {backend: 0.0 for backend in backends}
+    for name in fixtures:
+        with open(os.path.join(fixtures_dir, name), 'rb') as file:
+            html = file.read()
+        chunks = get_chunks(html)
+        for backend in backends:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                text = extraction.extract_text(iter(chunks), backend=backend)
+            elapsed = (time.perf_counter() - start) / iterations
+            totals[backend] += elapsed
+            count = text.lower().count(term.lower())
+            print(f'{name:<36} {backend:<8} {len(html) / 1024:>6.0f} {elapsed * 1000:>9.2f} '
+                  f'{len(html) / elapsed / 1024 / 1024:>7.1f} {len(text):>9} {len(tools.get_token_counts(text)):>7} '
+                  f'{count:>6}')
+
+    print()
+    for backend in backends:
+        print(f'{backend:<8} total {totals[backend] * 1000:.2f} ms for {len(fixtures)} pages')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the text extraction backends on HTML pages.')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--term', default='market')
+    parser.add_argument('--fixtures-dir', default=None, help='a directory of saved .html pages to use instead of the '
+                                                              'synthetic fixtures')
+    arguments = parser.parse_args()
+    run(arguments.iterations, arguments.term, arguments.fixtures_dir)
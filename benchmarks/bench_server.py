@@ -0,0 +1,164 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # so the app's modules can be imported
+from pymongo import MongoClient
+from local_services import FakeNewsApi, FixtureSite
+import db
+import main
+import newsapi
+import tools
+
+##########################################################################################
+#     Load benchmark of the server's endpoints, against local stand-ins for services     #
+##########################################################################################
+
+# Run with: python benchmarks/bench_server.py [--article-counts 50,200] [--terms N] [--concurrency N] [--warm-repeats N]
+#                                             [--latency-ms MS] [--error-rate RATE] [--sites N] [--mongo-uri URI]
+#                                             [--fixtures-dir DIR] [--index-page-texts]
+# The news api and the article sites are served locally (see local_services), so no api key or network is needed. The
+# article pages are synthetic (see generate_fixtures), unless --fixtures-dir is a directory of real saved pages.
+# The stored page texts are only added to the term index in the background (see tools.schedule_page_text_indexing) if
+# --index-page-texts is given, so that by default only the requests' own latency is measured.
+# The db is a local MongoDB if --mongo-uri is given (using the BENCHMARK_DB_NAME database, which is dropped first),
+# otherwise an in-memory stand-in (mongomock, which must be installed).
+# For each article count, each endpoint is requested once for each of the terms while nothing is stored yet (cold), and
+# then again --warm-repeats times (warm), with --concurrency requests at once. Reports the latency percentiles, the
+# throughput, and the number of requests made to the news api and the article sites.
+
+BENCHMARK_DB_NAME = 'newsDB-benchmark'
+ENDPOINTS = ['/internal/get-articles', '/internal/get-num-term-occurrences']
+
+
+# Return an in-memory client that can be used in place of a MongoClient.
+# mongomock isn't safe to use from multiple threads, so each collection operation holds a lock. This means that db
+# operations never run at the same time, and since mongomock has no indexes (each lookup scans its collection), large
+# writes can hold up all the requests, e.g. the term index's writes (which is why the page texts aren't indexed unless
+# --index-page-texts is given). Use --mongo-uri for the db's own concurrency. Newer pymongo versions also pass a 'sort' to bulk updates, which mongomock
+# doesn't accept (and which isn't used by the app). mongomock also doesn't have the 'collStats' command that the articles'
+# eviction checks their size with (see db.get_collection_stats), so it's answered with the size of the entries as BSON.
+def create_in_memory_client():
+    import bson
+    import mongomock
+    import mongomock.collection
+    import mongomock.database
+
+    lock = threading.RLock()
+
+    def hold_lock(func):
+        def locked(*args, **kwargs):
+            with lock:
+                result = func(*args, **kwargs)
+                return iter(list(result)) if func.__name__ in ['find', 'aggregate'] else result
+        return locked
+
+    for name in ['find', 'find_one', 'insert_one', 'insert_many', 'replace_one', 'update_one', 'update_many', 'delete_one',
+                 'delete_many', 'bulk_write', 'aggregate', 'count_documents', 'create_index', 'drop']:
+        setattr(mongomock.collection.Collection, name, hold_lock(getattr(mongomock.collection.Collection, name)))
+
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+
+    mongomock.collection.BulkOperationBuilder.add_update = add_update_without_sort
+
+    command = mongomock.database.Database.command
+
+    def command_with_coll_stats(self, command_name, value=None, **kwargs):
+        if command_name != 'collStats':
+            return command(self, command_name, **kwargs)
+        sizes = [len(bson.encode(entry)) for entry in self.get_collection(value).find()]
+        size = sum(sizes)
+        return {'ns': self.name + '.' + value, 'count': len(sizes), 'size': size,
+                'avgObjSize': size // len(sizes) if len(sizes) > 0 else 0, 'storageSize': size, 'totalIndexSize': 0}
+
+    mongomock.database.Database.command = command_with_coll_stats
+    return mongomock.MongoClient()
+
+
+def set_up_db(mongo_uri: str = None):
+    db.MONGODB_DB_NAME = BENCHMARK_DB_NAME
+    if mongo_uri is not None:
+        db.client = MongoClient(mongo_uri)
+        db.client.drop_database(BENCHMARK_DB_NAME)
+    else:
+        db.client = create_in_memory_client()
+    db.ensure_indexes()
+
+
+# Return the value at the given percentile (0-100) of the sorted values.
+def get_percentile(sorted_values: list, percentile: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(percentile / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+# Request the endpoint once with each of the params (with concurrency requests at once), and return the latencies (in
+# seconds) and the total time.
+def run_requests(endpoint: str, all_params: list, concurrency: int) -> tuple[list, float]:
+    def request(params: dict) -> float:
+        client = main.app.test_client()
+        start = time.perf_counter()
+        response = client.get(endpoint, query_string=params)
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            print('request failed:', endpoint, params, response.status_code, file=sys.stderr)
+        return elapsed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(request, all_params))
+    return latencies, time.perf_counter() - start
+
+
+def run(article_counts: list, num_terms: int, concurrency: int, warm_repeats: int, latency_ms: float, error_rate: float,
+        num_sites: int, mongo_uri: str = None, fixtures_dir: str = None, index_page_texts: bool = False):
+    tools.INDEX_PAGE_TEXTS_IN_BACKGROUND = index_page_texts
+    site = FixtureSite(num_sites, latency_ms / 1000, error_rate, fixtures_dir)
+    api = FakeNewsApi(site.urls)
+    newsapi.BASE_URL = api.url
+    newsapi.headers = {'Authorization': ''}
+    newsapi.scheduler = None  # (the stand-in api has no quota)
+    set_up_db(mongo_uri)
+
+    print(f'{"endpoint":<36} {"articles":>8} {"phase":<5} {"n":>4} {"p50 ms":>8} {"p90 ms":>8} {"p99 ms":>8} '
+          f'{"max ms":>8} {"req/s":>7} {"api":>5} {"pages":>6}')
+    for num_articles in article_counts:
+        api.num_articles = num_articles
+        terms = ['bench%dx%d' % (num_articles, i) for i in range(num_terms)]
+        for endpoint in ENDPOINTS:
+            for phase, repeats in [('cold', 1), ('warm', warm_repeats)]:
+                all_params = [{'q': term} for _ in range(repeats) for term in terms]
+                num_api_requests, num_page_requests = api.num_requests, site.num_requests
+                latencies, total_time = run_requests(endpoint, all_params, concurrency)
+                latencies = sorted(latencies)
+                print(f'{endpoint:<36} {num_articles:>8} {phase:<5} {len(latencies):>4} '
+                      f'{get_percentile(latencies, 50) * 1000:>8.1f} {get_percentile(latencies, 90) * 1000:>8.1f} '
+                      f'{get_percentile(latencies, 99) * 1000:>8.1f} {latencies[-1] * 1000:>8.1f} '
+                      f'{len(latencies) / total_time:>7.1f} {api.num_requests - num_api_requests:>5} '
+                      f'{site.num_requests - num_page_requests:>6}')
+
+    api.close()
+    site.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load benchmark of the server\'s endpoints, against local stand-ins.')
+    parser.add_argument('--article-counts', default='50,200', help='comma-separated numbers of articles per search')
+    parser.add_argument('--terms', type=int, default=4, help='number of different terms searched for each article count')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warm-repeats', type=int, default=5)
+    parser.add_argument('--latency-ms', type=float, default=50, help='latency of each article page')
+    parser.add_argument('--error-rate', type=float, default=0.05, help='fraction of article pages that fail')
+    parser.add_argument('--sites', type=int, default=10, help='number of different article sites (domains)')
+    parser.add_argument('--mongo-uri', default=None, help='a local MongoDB to use instead of the in-memory stand-in')
+    parser.add_argument('--fixtures-dir', default=None, help='a directory of saved .html pages to serve as the articles')
+    parser.add_argument('--index-page-texts', action='store_true', help='index the stored page texts in the background')
+    arguments = parser.parse_args()
+    run([int(count) for count in arguments.article_counts.split(',')], arguments.terms, arguments.concurrency,
+        arguments.warm_repeats, arguments.latency_ms, arguments.error_rate, arguments.sites, arguments.mongo_uri,
+        arguments.fixtures_dir, arguments.index_page_texts)
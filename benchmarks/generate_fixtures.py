@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+import random
+
+#####################################################################################
+#     Generator of the synthetic article pages used as the benchmarks' fixtures     #
+#####################################################################################
+
+# Run with: python benchmarks/generate_fixtures.py [--output-dir DIR]
+# The fixtures are synthetic (generated, not saved from real sites), so that they can be shipped and are the same on every
+# run. They are made to be representative of real news article pages where it matters for the benchmarks: most of a
+# page's bytes are markup, styles and scripts rather than text, and the article's words follow a Zipf distribution over a
+# large vocabulary, so that each page has a few thousand different words (which is what the term index stores, see
+# tools.get_token_counts). The benchmarks can also be run on real saved pages instead (see their --fixtures-dir option).
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'articles')
+SEED = 2024
+
+# Size of the vocabulary the pages' words are drawn from, and the exponent of its Zipf distribution.
+VOCABULARY_SIZE = 20000
+ZIPF_EXPONENT = 1.07
+# The most common English words, which are the most frequent words of any article.
+COMMON_WORDS = ('the of and to a in is that for it on was with as he be at by this had not are but from or have an they '
+                'which one you were her all she there would their we him been has when who will more no if out so said '
+                'what up its about into than them can only other new some could time these two may then do first any my '
+                'now such like our over man me even most made after also did many before must through back years where '
+                'much your way well down should because each just those people how too little state good very make world '
+                'still own see men work long get here between both life being under never day same another know while '
+                'last might us great old year off come since against go came right used take three').split()
+
+# name -> (headline, the topic's words, which are mixed into the article's text more often than the rest of its words)
+ARTICLES = {
+    'city-council-energy-plan': ('City council approves a new energy plan after a long debate',
+                                 'council energy plan city solar grid vote residents budget power utility'),
+    'markets-inflation-report': ('Markets fall as the inflation report comes in higher than expected',
+                                 'market markets inflation rates stocks investors prices bank report economy'),
+    'storm-coast-emergency': ('Storm brings emergency services to the coast',
+                              'storm coast emergency rain wind flooding evacuation shelters forecast damage')
+}
+
+
+# Return a made up word, built from random syllables.
+def make_word(rng: random.Random) -> str:
+    onsets = ['b', 'br', 'c', 'ch', 'cl', 'd', 'dr', 'f', 'fl', 'g', 'gr', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'pl', 'pr',
+              'qu', 'r', 's', 'sh', 'sl', 'st', 't', 'th', 'tr', 'v', 'w', 'y', 'z', '']
+    vowels = ['a', 'e', 'i', 'o', 'u', 'ai', 'ea', 'ee', 'io', 'ou', 'y']
+    codas = ['', '', 'n', 'r', 's', 't', 'l', 'nd', 'st', 'ng', 'ck', 'm', 'x']
+    return ''.join(rng.choice(onsets) + rng.choice(vowels) + rng.choice(codas) for _ in range(rng.choice([1, 2, 2, 3, 3, 4])))
+
+
+# Return the vocabulary (most common words first) and the cumulative weights of its Zipf distribution.
+def make_vocabulary(rng: random.Random) -> tuple[list, list]:
+    vocabulary = list(COMMON_WORDS)
+    seen = set(vocabulary)
+    while len(vocabulary) < VOCABULARY_SIZE:
+        word = make_word(rng)
+        if word not in seen:
+            seen.add(word)
+            vocabulary.append(word)
+    cumulative_weights = []
+    total = 0.0
+    for rank in range(1, len(vocabulary) + 1):
+        total += 1 / rank ** ZIPF_EXPONENT
+        cumulative_weights.append(total)
+    return vocabulary, cumulative_weights
+
+
+def make_sentence(rng: random.Random, vocabulary: list, cumulative_weights: list, topic_words: list) -> str:
+    words = rng.choices(vocabulary, cum_weights=cumulative_weights, k=rng.randint(8, 28))
+    for _ in range(rng.randint(0, 2)):
+        words.insert(rng.randrange(len(words) + 1), rng.choice(topic_words))
+    if rng.random() < 0.3:  # numbers and names, as in real articles
+        words.insert(rng.randrange(len(words) + 1), rng.choice([str(rng.randint(2, 2025)), '%d%%' % rng.randint(1, 99),
+                                                                words[0].capitalize()]))
+    sentence = ' '.join(words)
+    return sentence[0].upper() + sentence[1:] + rng.choice(['.', '.', '.', '?', ',"'])
+
+
+def make_paragraph(rng: random.Random, vocabulary: list, cumulative_weights: list, topic_words: list) -> str:
+    sentences = [make_sentence(rng, vocabulary, cumulative_weights, topic_words) for _ in range(rng.randint(2, 6))]
+    # (Some words are links or emphasized, so the text is split over several elements like in real articles)
+    for i in range(len(sentences)):
+        if rng.random() < 0.15:
+            words = sentences[i].split(' ')
+            j = rng.randrange(len(words))
+            words[j] = '<a href="/topic/%s">%s</a>' % (words[j].strip('.,?"').lower(), words[j])
+            sentences[i] = ' '.join(words)
+    return '<p>' + ' '.join(sentences) + '</p>'
+
+
+def make_links(rng: random.Random, vocabulary: list, num_links: int, css_class: str) -> str:
+    links = []
+    for _ in range(num_links):
+        words = [rng.choice(vocabulary[:3000]) for _ in range(rng.randint(1, 3))]
+        links.append('<li class="%s__item"><a class="%s__link" href="/%s">%s</a></li>' % (
+            css_class, css_class, '-'.join(words), ' '.join(words).title()))
+    return '<ul class="%s">\n%s\n</ul>' % (css_class, '\n'.join(links))
+
+
+def make_styles(rng: random.Random, vocabulary: list) -> str:
+    rules = []
+    properties = [
+        lambda: 'color:#%06x' % rng.randint(0, 0xffffff),
+        lambda: 'margin:%dpx %dpx' % (rng.randint(0, 48), rng.randint(0, 48)),
+        lambda: 'padding:%dpx' % rng.randint(0, 32),
+        lambda: 'font-size:%.3frem' % rng.uniform(0.75, 3),
+        lambda: 'line-height:%.2f' % rng.uniform(1, 1.8),
+        lambda: 'border:%dpx solid #%06x' % (rng.randint(1, 4), rng.randint(0, 0xffffff)),
+        lambda: 'max-width:%dpx' % rng.choice([320, 480, 640, 768, 960, 1200]),
+        lambda: 'display:' + rng.choice(['block', 'flex', 'grid', 'none', 'inline-block']),
+        lambda: 'grid-template-columns:repeat(%d,1fr)' % rng.randint(2, 6)
+    ]
+    for _ in range(rng.randint(350, 500)):
+        selector = '.%s-%s' % (rng.choice(vocabulary[:2000]), rng.choice(['wrapper', 'item', 'header', 'media', 'title']))
+        if rng.random() < 0.2:
+            selector = '@media (min-width:%dpx){%s' % (rng.choice([480, 768, 1024]), selector)
+        declarations = ';'.join(prop() for prop in rng.sample(properties, rng.randint(2, 5)))
+        rules.append(selector + '{' + declarations + '}' + ('}' if selector.startswith('@media') else ''))
+    return '\n'.join(rules)
+
+
+# A minified-looking script, which is left out of the page's text by all the extraction backends.
+def make_script(rng: random.Random, vocabulary: list, num_statements: int) -> str:
+    statements = []
+    for _ in range(num_statements):
+        name = rng.choice(vocabulary[:5000])
+        statements.append(rng.choice([
+            'var %s=function(e,t){return e&&t?e.%s(t):null}' % (name, rng.choice(vocabulary[:500])),
+            'window.__%s=window.__%s||[];window.__%s.push({id:%d,t:"%s"})' % (name, name, name, rng.randint(0, 99999), name),
+            'if(document.querySelector(".%s")){document.body.classList.add("has-%s")}' % (name, name),
+            'function %s(n){for(var i=0;i<n.length;i++){n[i].dataset.%s=%d}}' % (name, name, rng.randint(0, 9))
+        ]))
+    return ';'.join(statements)
+
+
+def make_page(name: str, headline: str, topic_words: list, rng: random.Random, vocabulary: list,
+              cumulative_weights: list) -> str:
+    json_ld = json.dumps({'@context': 'https://schema.org', '@type': 'NewsArticle', 'headline': headline,
+                          'datePublished': '2024-03-%02dT%02d:00:00Z' % (rng.randint(1, 28), rng.randint(0, 23)),
+                          'author': {'@type': 'Person', 'name': ' '.join(w.title() for w in rng.sample(vocabulary, 2))}})
+    paragraphs = [make_paragraph(rng, vocabulary, cumulative_weights, topic_words) for _ in range(rng.randint(20, 35))]
+    related = ['<li><a href="/news/%d">%s</a></li>' % (rng.randint(10000, 99999), make_sentence(
+        rng, vocabulary, cumulative_weights, topic_words).rstrip('.?,"')) for _ in range(rng.randint(15, 25))]
+    return '\n'.join([
+        '<!DOCTYPE html>',
+        '<html lang="en">',
+        '<head>',
+        '<meta charset="utf-8">',
+        '<title>%s | example-times.net</title>' % headline,
+        '<meta name="description" content="%s">' % make_sentence(rng, vocabulary, cumulative_weights, topic_words),
+        '\n'.join('<meta property="og:%s" content="%s">' % (prop, rng.choice(vocabulary)) for prop in
+                  ['type', 'site_name', 'locale', 'section', 'tag', 'image', 'url']),
+        '\n'.join('<link rel="preload" href="/static/%s.%s" as="%s">' % (rng.choice(vocabulary), ext, kind) for ext, kind in
+                  [('js', 'script'), ('css', 'style'), ('woff2', 'font')] * 4),
+        '<style>%s</style>' % make_styles(rng, vocabulary),
+        '<script type="application/ld+json">%s</script>' % json_ld,
+        '<script>%s</script>' % make_script(rng, vocabulary, rng.randint(300, 500)),
+        '</head>',
+        '<body class="article-page">',
+        '<!-- %s -->' % make_sentence(rng, vocabulary, cumulative_weights, topic_words),
+        '<header class="site-header"><nav>',
+        make_links(rng, vocabulary, rng.randint(50, 90), 'site-nav'),
+        '</nav></header>',
+        '<noscript><img src="/pixel.gif?id=%d" alt=""></noscript>' % rng.randint(0, 99999),
+        '<main><article>',
+        '<h1>%s</h1>' % headline,
+        '<p class="byline">By %s and %s</p>' % tuple(' '.join(w.title() for w in rng.sample(vocabulary, 2)) for _ in range(2)),
+        '\n'.join(paragraphs[:len(paragraphs) // 2]),
+        '<aside class="ad-slot"><script>%s</script></aside>' % make_script(rng, vocabulary, rng.randint(50, 100)),
+        '\n'.join(paragraphs[len(paragraphs) // 2:]),
+        '</article>',
+        '<aside class="related"><h2>More news</h2><ul>\n%s\n</ul></aside>' % '\n'.join(related),
+        '</main>',
+        '<footer>',
+        make_links(rng, vocabulary, rng.randint(30, 50), 'site-footer'),
+        '<p>&copy; 2024 Example Times. %s</p>' % make_sentence(rng, vocabulary, cumulative_weights, topic_words),
+        '</footer>',
+        '<template id="%s-card"><div class="card"><h3></h3><p></p></div></template>' % name,
+        '<script>%s</script>' % make_script(rng, vocabulary, rng.randint(400, 700)),
+        '</body>',
+        '</html>',
+        ''
+    ])
+
+
+def run(output_dir: str):
+    rng = random.Random(SEED)
+    vocabulary, cumulative_weights = make_vocabulary(rng)
+    os.makedirs(output_dir, exist_ok=True)
+    for name, (headline, topic_words) in ARTICLES.items():
+        page = make_page(name, headline, topic_words.split(), rng, vocabulary, cumulative_weights)
+        with open(os.path.join(output_dir, name + '.html'), 'w', encoding='utf-8', newline='\n') as file:
+            file.write(page)
+        print('Wrote %s.html (%d KB)' % (name, len(page.encode()) // 1024))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the synthetic article pages used by the benchmarks.')
+    parser.add_argument('--output-dir', default=FIXTURES_DIR)
+    arguments = parser.parse_args()
+    run(arguments.output_dir)
@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import json
+import os
+import threading
+import time
+
+##############################################################################################
+#     Local stand-ins for newsapi.org and the article sites, used by the load benchmarks     #
+##############################################################################################
+
+# The article pages served by the FixtureSite, which by default are the synthetic pages made by generate_fixtures.
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'articles')
+# How far apart the fake articles are published, newest first (so that all of them are within the default 30 days).
+ARTICLE_SPACING = timedelta(minutes=30)
+
+
+# Serves newsapi.org's /v2/everything (paginated, and filtered by 'from' and 'to') and /v2/top-headlines/sources with
+# fake articles, whose urls point at the FixtureSite. Every search has num_articles articles.
+class FakeNewsApi:
+    def __init__(self, site_urls: list, num_articles: int = 100):
+        self.site_urls = site_urls
+        self.num_articles = num_articles
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.now = datetime.now(timezone.utc)
+        self.server = start_server(self.create_handler(), '127.0.0.1')
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def get_articles(self, term: str, from_date: datetime = None, to_date: datetime = None) -> list:
+        articles = []
+        for i in range(self.num_articles):
+            published_at = self.now - i * ARTICLE_SPACING
+            if (from_date is not None and published_at < from_date) or (to_date is not None and published_at > to_date):
+                continue
+            site_url = self.site_urls[i % len(self.site_urls)]
+            articles.append({
+                'source': {'id': None, 'name': 'Site %d' % (i % len(self.site_urls))},
+                'author': 'Author',
+                'title': '%s article %d' % (term, i),
+                'description': 'About %s' % term,
+                'url': '%s/%s/%d' % (site_url, term.replace(' ', '-'), i),
+                'urlToImage': None,
+                'publishedAt': published_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'content': 'About %s' % term
+            })
+        return articles
+
+    def create_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with api.lock:
+                    api.num_requests += 1
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if url.path == '/v2/everything':
+                    from_date = datetime.fromisoformat(params['from']) if 'from' in params else None
+                    to_date = datetime.fromisoformat(params['to']) if 'to' in params else None
+                    articles = api.get_articles(params.get('q', ''), from_date, to_date)
+                    page_size = int(params.get('pageSize', 100))
+                    page = int(params.get('page', 1))
+                    body = {'status': 'ok', 'totalResults': len(articles),
+                            'articles': articles[(page - 1) * page_size:page * page_size]}
+                elif url.path == '/v2/top-headlines/sources':
+                    body = {'status': 'ok', 'sources': [{'id': 'site-%d' % i, 'url': site_url}
+                                                        for i, site_url in enumerate(api.site_urls)]}
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                send_body(self, 200, json.dumps(body).encode(), 'application/json')
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+
+
+# Serves the article pages in the fixtures directory (FIXTURES_DIR, unless another is given) for any path, after
+# latency_sec seconds. A path's page is
+# always the same, and it fails (with a 500) for about error_rate of the paths. The same server is reachable from
+# num_sites different hosts (127.0.0.1, 127.0.0.2, ...), so that the pages are spread over several domains.
+class FixtureSite:
+    def __init__(self, num_sites: int = 10, latency_sec: float = 0.05, error_rate: float = 0.05, fixtures_dir: str = None):
+        if fixtures_dir is None:
+            fixtures_dir = FIXTURES_DIR
+        self.latency_sec = latency_sec
+        self.error_rate = error_rate
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.pages = []
+        for name in sorted(os.listdir(fixtures_dir)):
+            if name.endswith('.html'):
+                with open(os.path.join(fixtures_dir, name), 'rb') as file:
+                    self.pages.append(file.read())
+        self.server = start_server(self.create_handler(), '')
+        port = self.server.server_address[1]
+        self.urls = ['http://127.0.0.%d:%d' % (i + 1, port) for i in range(num_sites)]
+
+    def create_handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with site.lock:
+                    site.num_requests += 1
+                time.sleep(site.latency_sec)
+                path_hash = sum(self.path.encode())
+                etag = '"%d"' % path_hash
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                if (path_hash * 7919) % 1000 < site.error_rate * 1000:
+                    send_body(self, 500, b'error', 'text/plain')
+                    return
+                send_body(self, 200, site.pages[path_hash % len(site.pages)], 'text/html; charset=utf-8', etag)
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+
+
+def start_server(handler, host: str) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def send_body(handler: BaseHTTPRequestHandler, status_code: int, body: bytes, content_type: str, etag: str = None):
+    handler.send_response(status_code)
+    handler.send_header('Content-Type', content_type)
+    handler.send_header('Content-Length', str(len(body)))
+    if etag is not None:
+        handler.send_header('ETag', etag)
+    handler.end_headers()
+    handler.wfile.write(body)
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+import threading
+import time
+import metrics
+
+####################################################################################
+#     This module defines the in-process cache used in front of the db and api     #
+####################################################################################
+
+
+# A cache of up to max_size entries, each of which expires ttl_sec seconds after it was set. Past max_size, the least
+# recently used entries are removed. Values are shared between callers, so they must not be modified.
+# Hits and misses are recorded under the cache's name (see metrics.record_cache_lookups). Safe to use from multiple threads.
+class TTLCache:
+    def __init__(self, name: str, max_size: int, ttl_sec: float):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires at, value), from least to most recently used
+
+    # Return the key's value, or default if it's not in the cache (or it expired).
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() >= entry[0]:
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        metrics.record_cache_lookups('l1.' + self.name, int(entry is not None), int(entry is None))
+        return entry[1] if entry is not None else default
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_sec, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
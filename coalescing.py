@@ -0,0 +1,47 @@
+import threading
+
+###############################################################################################
+#     This module defines how identical work that is in-flight at the same time is shared     #
+###############################################################################################
+
+
+# A call that is in-flight, whose result is shared with every caller that asked for the same key while it ran.
+class InFlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Runs only one call at a time for each key: callers that ask for a key while a call for it is in-flight wait for that
+# call and get its result (or its exception) instead of running their own. Once the call is done, the next call for the
+# key runs again. Results are shared between callers, so they must not be modified. Safe to use from multiple threads.
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # key -> InFlightCall
+
+    # Return func(), or the result of the call for the key that is already in-flight.
+    def run(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.calls[key] = InFlightCall()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
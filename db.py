@@ -1,6 +1,19 @@
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
-from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from datetime import datetime, timedelta, timezone
+import atexit
+import hashlib
+import json
+import math
+import os
+import queue
+import re
+import threading
+import time
+import zlib
+import metrics
 
 # This module defines functions for interacting with our MongoDB database #
 # The basic utility of the db is to store previously received or calculated results, to reduce the necessary number of API calls
@@ -8,47 +21,254 @@ from datetime import datetime, timedelta
 # We will store all previous searches so that future searches with the same parameters can just be retrieved from the db instead
 # of needing to make a duplicate API call. These are stored in the 'news-searches' collection.
 # The number of term occurrences for a given term is also stored so that once it is calculated we do not need to calculate it again.
-# These are stored in a separate collection ('articles') so that searches with overlapping articles can take advantage of any results already calculate.
+# These are stored per article in a separate collection ('term-counts') so that searches with overlapping articles can take advantage of any results already calculate.
 
-uri_file = open(r"tokens/mongodb_uri.txt", "r")
-uri = uri_file.readline()
-client = MongoClient(uri, server_api=ServerApi('1'))
+# Connection settings. Each can be overridden with an environment variable of the same name, e.g. to use smaller pools
+# when running many worker processes on the same node.
+MONGODB_URI_FILE = os.environ.get('MONGODB_URI_FILE', r"tokens/mongodb_uri.txt")
+MONGODB_DB_NAME = os.environ.get('MONGODB_DB_NAME', 'newsDB')
+MONGODB_MAX_POOL_SIZE = int(os.environ.get('MONGODB_MAX_POOL_SIZE', 50))
+MONGODB_MIN_POOL_SIZE = int(os.environ.get('MONGODB_MIN_POOL_SIZE', 0))
+MONGODB_CONNECT_TIMEOUT_MS = int(os.environ.get('MONGODB_CONNECT_TIMEOUT_MS', 5000))
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = int(os.environ.get('MONGODB_SERVER_SELECTION_TIMEOUT_MS', 5000))
+MONGODB_SOCKET_TIMEOUT_MS = int(os.environ.get('MONGODB_SOCKET_TIMEOUT_MS', 30000))
 
-# Send a ping to confirm a successful connection
-try:
-    client.admin.command('ping')
-    print("Successfully connected to MongoDB.")
-except Exception as e:
-    print(e)
+# Retention settings, which can also be overridden with environment variables.
+# Stored news searches (and their days) are removed by the db once they expire, which is this long after they're stored.
+# Searches that include today expire sooner, since newsapi keeps adding articles to today (see get_news_search_expiry).
+NEWS_SEARCH_TTL_SEC = int(os.environ.get('NEWS_SEARCH_TTL_SEC', 30 * 24 * 60 * 60))
+NEWS_SEARCH_CURRENT_TTL_SEC = int(os.environ.get('NEWS_SEARCH_CURRENT_TTL_SEC', 60 * 60))
+# Max total size of the stored articles. Past this, the oldest articles that no stored news search refers to anymore are
+# removed (see evict_unreferenced_articles), which is checked at most once every interval.
+ARTICLES_MAX_BYTES = int(os.environ.get('ARTICLES_MAX_BYTES', 256 * 1024 * 1024))
+ARTICLES_EVICTION_INTERVAL_SEC = int(os.environ.get('ARTICLES_EVICTION_INTERVAL_SEC', 60 * 60))
 
-news_db = client.newsDB
+# The client is only created when the db is first used (see get_client), so importing this module doesn't connect.
+client = None
+client_lock = threading.Lock()
 
 # Max we are willing to accept when retrieving a news-search from the db
 MAX_TIME_DIFF_NEWS_RETRIEVAL_MIN = 1440  # (12 hours)
 
+# If True, new news searches and their articles are written to the db by a background thread (see
+# insert_new_news_search_and_articles) so that results can be returned without waiting on the db.
+WRITE_BEHIND = False
+
+# Max total size of the (compressed) article page texts that are stored. The least recently used are removed past this,
+# which is checked at most once every interval (see evict_page_texts).
+PAGE_TEXTS_MAX_BYTES = 512 * 1024 * 1024
+PAGE_TEXTS_EVICTION_INTERVAL_SEC = 10 * 60
+
+# Stored term counts that aren't used for this long are removed (see the term counts functions). When they're used, they
+# are only marked as used again once this long passed since they last were.
+TERM_COUNTS_TTL_SEC = 90 * 24 * 60 * 60
+TERM_COUNTS_LAST_USED_RESOLUTION_SEC = 24 * 60 * 60
+# Max number of pages in each entry of the term index (see insert_term_index), which bounds how much of an entry is
+# rewritten when a page is added to it.
+TERM_INDEX_MAX_POSTINGS_PER_ENTRY = 100
+# Max number of updates in each bulk write to the term index, so that a write doesn't hold up the db for long.
+TERM_INDEX_MAX_UPDATES_PER_WRITE = 1000
+
+# The error code of a write that conflicts with an existing entry on a unique index.
+DUPLICATE_KEY_ERROR_CODE = 11000
+
 
 ###############################
 #     Helper db functions     #
 ###############################
 
+# Return this process's client, creating it (and the indexes, see ensure_indexes) on first use.
+# A client can't be used across a fork (its connections and monitoring threads aren't carried over), so a forked process
+# (e.g. a worker of a preforking server like gunicorn) starts without one and creates its own (see reset_after_fork).
+def get_client() -> MongoClient:
+    global client
+    if client is not None:
+        return client
+    with client_lock:
+        if client is None:
+            with open(MONGODB_URI_FILE, "r") as uri_file:
+                uri = uri_file.readline().strip()
+            client = MongoClient(uri, server_api=ServerApi('1'),
+                                 maxPoolSize=MONGODB_MAX_POOL_SIZE,
+                                 minPoolSize=MONGODB_MIN_POOL_SIZE,
+                                 connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+                                 serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+                                 socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS)
+            ensure_indexes()
+    return client
+
+
+def get_collection(collection_name: str):
+    return get_client().get_database(MONGODB_DB_NAME).get_collection(collection_name)
+
+
+# Forget the parent's client and write-behind state in a forked child process, so that it creates its own on first use.
+# (The parent's client is left as is rather than closed, since closing it would also affect the parent's connections)
+def reset_after_fork():
+    global client, client_lock, write_behind_queue, write_behind_thread, write_behind_thread_lock, eviction_lock
+    client = None
+    client_lock = threading.Lock()
+    eviction_lock = threading.Lock()
+    write_behind_queue = queue.Queue()
+    write_behind_thread = None
+    write_behind_thread_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+# The indexes that our lookups rely on, as (collection name, keys, index options).
+INDEXES = [
+    ('articles', [('url', 1)], {'unique': True}),
+    ('articles', [('publishedAt', 1)], {}),
+    # (sparse so that entries stored before search keys were added don't conflict with each other)
+    ('news-searches', [('searchKey', 1)], {'unique': True, 'sparse': True}),
+    ('news-search-days', [('queryKey', 1), ('day', 1)], {'unique': True}),
+    # (For finding the articles that no stored search refers to, see evict_unreferenced_articles)
+    ('news-searches', [('articles', 1)], {}),
+    ('news-search-days', [('articles.url', 1)], {}),
+    # (Entries are removed by the db once their 'expiresAt' passes)
+    ('news-searches', [('expiresAt', 1)], {'expireAfterSeconds': 0}),
+    ('news-search-days', [('expiresAt', 1)], {'expireAfterSeconds': 0}),
+    ('page-texts', [('url', 1)], {'unique': True}),
+    ('page-texts', [('lastUsed', 1)], {}),
+    ('term-index', [('token', 1), ('day', 1)], {}),
+    ('term-index', [('postings.url', 1)], {}),
+    ('term-counts', [('term', 1), ('url', 1)], {'unique': True}),
+    ('term-counts', [('url', 1)], {}),
+    ('term-counts', [('lastUsed', 1)], {'expireAfterSeconds': TERM_COUNTS_TTL_SEC}),
+    ('jobs', [('jobId', 1)], {'unique': True}),
+    ('jobs', [('expiresAt', 1)], {'expireAfterSeconds': 0})
+]
+
+
+# Create the INDEXES, if they don't exist yet. (Done once per process, when the client is created)
+# Each index is created on its own, so that one that can't be created doesn't keep the others from being created. A unique
+# index can't be created while its collection has duplicate entries (e.g. articles stored more than once by concurrent
+# writes before the index existed), which can be removed with remove_duplicate_entries (`python manage.py dedupe`).
+# Returns the names of the indexes that couldn't be created.
+def ensure_indexes() -> list:
+    failed_indexes = []
+    for collection_name, keys, options in INDEXES:
+        index_name = collection_name + '.' + '_'.join(field for field, _ in keys)
+        try:
+            get_collection(collection_name).create_index(keys, **options)
+        except OperationFailure as e:
+            failed_indexes.append(index_name)
+            if e.code == DUPLICATE_KEY_ERROR_CODE:
+                print('Error creating db index %s: the collection has duplicate entries, which can be removed with '
+                      '`python manage.py dedupe`:' % index_name, e)
+            else:
+                print('Error creating db index %s:' % index_name, e)
+        except Exception as e:
+            failed_indexes.append(index_name)
+            print('Error creating db index %s:' % index_name, e)
+    return failed_indexes
+
+
+# Remove the duplicate entries of each collection with a unique index in INDEXES (i.e. the entries with the same values
+# for the index's fields), keeping the most recently inserted entry of each, so that the index can be created. Returns
+# a dict of collection name -> the number of entries removed.
+def remove_duplicate_entries(batch_size: int = 1000) -> dict:
+    num_removed_by_collection = {}
+    for collection_name, keys, options in INDEXES:
+        if not options.get('unique'):
+            continue
+        pipeline = [
+            {'$sort': {'_id': 1}},
+            {'$group': {
+                '_id': {field: '$' + field for field, _ in keys},
+                'ids': {'$push': '$_id'},
+                'numEntries': {'$sum': 1}
+            }},
+            {'$match': {'numEntries': {'$gt': 1}}}
+        ]
+        if options.get('sparse'):  # (entries without the fields aren't in the index, so they aren't duplicates)
+            pipeline.insert(0, {'$match': {field: {'$exists': True} for field, _ in keys}})
+        collection = get_collection(collection_name)
+        duplicate_ids = [entry_id for entry in collection.aggregate(pipeline, allowDiskUse=True)
+                         for entry_id in entry.get('ids')[:-1]]
+        for start in range(0, len(duplicate_ids), batch_size):
+            collection.delete_many({'_id': {'$in': duplicate_ids[start:start + batch_size]}})
+        num_removed_by_collection[collection_name] = num_removed_by_collection.get(collection_name, 0) + len(duplicate_ids)
+    return num_removed_by_collection
+
+
 def update_or_create_entry(collection_name: str, filters: dict, update: dict) -> bool:
-    return news_db.get_collection(collection_name).update_one(
+    return get_collection(collection_name).update_one(
         filters,
         update,
         upsert=True  # upsert = True so that it only creates new doc if not already existing
     ).acknowledged
 
 
+# Same as update_or_create_entry, but for many entries at once. All the updates are sent in a single unordered bulk write
+# instead of a separate round trip for each entry.
+# Expects a list of (filters, update) tuples.
+def update_or_create_entries(collection_name: str, filters_and_updates: list) -> bool:
+    if len(filters_and_updates) == 0:
+        return True
+    operations = [UpdateOne(filters, update, upsert=True) for filters, update in filters_and_updates]
+    collection = get_collection(collection_name)
+    try:
+        return collection.bulk_write(operations, ordered=False).acknowledged
+    except BulkWriteError as e:
+        # Upserts of the same new entry made at the same time (e.g. by requests sharing the same pages) can conflict, since
+        # only one of them creates the entry. The conflicting upserts are retried once, which then update that entry.
+        write_errors = e.details.get('writeErrors', [])
+        if len(write_errors) == 0 or any(error.get('code') != DUPLICATE_KEY_ERROR_CODE for error in write_errors):
+            raise
+        retried_operations = [operations[error.get('index')] for error in write_errors]
+        return collection.bulk_write(retried_operations, ordered=False).acknowledged
+
+
+# When each eviction (see schedule_eviction) was last run in this process, as name -> a time.monotonic() value.
+last_eviction_times = {}
+eviction_lock = threading.Lock()
+
+
+# Run evict_func in a background thread, unless the eviction with the given name (e.g. 'articles') was already run in the
+# last interval_sec, so that checking what to evict isn't done on every write.
+def schedule_eviction(name: str, evict_func, interval_sec: float):
+    with eviction_lock:
+        now = time.monotonic()
+        if name in last_eviction_times and now - last_eviction_times[name] < interval_sec:
+            return
+        last_eviction_times[name] = now
+    threading.Thread(target=run_eviction, args=(name, evict_func), daemon=True).start()
+
+
+def run_eviction(name: str, evict_func):
+    try:
+        evict_func()
+    except Exception as e:
+        print('Error evicting %s:' % name, e)
+
+
 # Retrieve a db entry that has ONLY the given filters/fields, excluding all other fields that are provided.
 # This allows us to differentiate between an entry that only has the given fields and one that also has them in addition to other fields
 def retrieve_only_with_existing_fields(all_fields: list, collection_name: str, filters: dict, projection: dict):
     missing_fields = all_fields - filters.keys()
     filters = dict(filters)
     filters.update({k: {'$exists': False} for k in missing_fields})  # set any fields not passed in to not exist.
-    result = news_db.get_collection(collection_name).find_one(filters, projection)
+    result = get_collection(collection_name).find_one(filters, projection)
     return result
 
 
+#################################################################
+#     Functions for handling the enums (the filter options)     #
+#################################################################
+
+# Return the values of the enum with the given name (e.g. 'language'), as a dict of value -> display name, or None if
+# there is no such enum.
+@metrics.timed('db.retrieve_enum_values')
+def retrieve_enum_values(name: str) -> dict | None:
+    result = get_collection('enums').find_one({'name': name}, {'_id': 0, 'values': 1})
+    if result is not None:
+        return result.get('values', {})
+    return None
+
+
 ####################################################
 #     Functions for handling newsapi's sources     #
 ####################################################
@@ -58,7 +278,7 @@ def insert_new_sources_entry(args: dict, sources: list) -> bool:
         **args,
         'sources': sources
     }
-    return news_db.get_collection('sources').insert_one(document).acknowledged
+    return get_collection('sources').insert_one(document).acknowledged
 
 
 def update_or_create_sources_entry(filters: dict, sources: list) -> bool:
@@ -68,6 +288,7 @@ def update_or_create_sources_entry(filters: dict, sources: list) -> bool:
 
 
 # Expects category, country, and/or language (1-3).
+@metrics.timed('db.retrieve_sources_entry')
 def retrieve_sources_entry(filters: dict) -> list | None:
     all_possible_filters = ['category', 'country', 'language']
 
@@ -86,70 +307,147 @@ def retrieve_sources_entry(filters: dict) -> list | None:
 #     Functions for handling news-api's news searches     #
 ###########################################################
 
-# Expects the args as would be sent to the newsapi. If max_time_difference_min is greater than 0, the function will try
-# to find a suitable db entry that is within the given number of minutes of the 'from' and 'to' date times, even if it
-# is not an exact match.
-def retrieve_news_search(params: dict, max_time_difference_min: int = None) -> tuple[bool, dict | None]:
+# Return the key of a news search, which is what news searches are stored and looked up by. The key is a hash of all the
+# args, except that the 'from' and 'to' dates are rounded down to a window of max_time_difference_min minutes, so that
+# searches with the same args and with dates in the same windows have the same key.
+# Expects the args as would be sent to the newsapi (after tools.clean_news_search_args).
+def get_news_search_key(params: dict, max_time_difference_min: int = None) -> str:
     if max_time_difference_min is None:
         max_time_difference_min = MAX_TIME_DIFF_NEWS_RETRIEVAL_MIN
 
-    # All fields for news search entries. Set any not passed in to not exist so that we can differentiate between an entry that only has the
-    # given fields and one that also has them in addition to other fields, as such a difference makes the entry unique.
-    all_fields = ['q',
-                  'searchIn',
-                  'sources',
-                  'domains',
-                  'excludeDomains',
-                  'from',
-                  'to',
-                  'language',
-                  'sortBy',
-                  'pageSize',
-                  'page'
-                  ]
+    # All values are keyed as strings, so that e.g. a 'page' of 1 and '1' have the same key.
+    key_args = {k: str(v) for k, v in params.items()}
+    for date_arg in ['from', 'to']:
+        if date_arg in params:
+            timestamp = datetime.fromisoformat(params[date_arg]).timestamp()
+            if max_time_difference_min > 0:
+                key_args[date_arg] = int(timestamp // (max_time_difference_min * 60))
+            else:
+                key_args[date_arg] = timestamp
+    # (Keys made with different windows should never match)
+    key_args['dateWindowMin'] = max_time_difference_min
+    return hashlib.sha256(json.dumps(key_args, sort_keys=True).encode()).hexdigest()
+
+
+# Expects the args as would be sent to the newsapi. If max_time_difference_min is greater than 0, the function will find
+# a db entry whose 'from' and 'to' date times are in the same window of that number of minutes (see get_news_search_key),
+# even if it is not an exact match.
+# article_projection is used for the returned articles, so that callers can retrieve only the article fields they need.
+# article_offset and article_limit select which of the search's articles are returned, so that only the articles that
+# will actually be used are retrieved. 'totalResults' is always the total for the whole search.
+@metrics.timed('db.retrieve_news_search')
+def retrieve_news_search(params: dict, max_time_difference_min: int = None, article_projection: dict = None,
+                         article_offset: int = 0, article_limit: int = None) -> tuple[bool, dict | None]:
+    if max_time_difference_min is None:
+        max_time_difference_min = MAX_TIME_DIFF_NEWS_RETRIEVAL_MIN
 
     projection = {'totalResults': 1, 'articles': 1, '_id': 0}
+    if article_limit is not None:
+        # Only return the requested part of the stored article urls
+        projection['articles'] = {'$slice': [article_offset, article_limit]}
 
-    # Replace the 'from' and 'to' date args with actual date objects.
-    filters = dict(params)
-    if 'from' in filters:
-        from_date = datetime.fromisoformat(filters['from'])
-        lowest_from_date = from_date - timedelta(minutes=max_time_difference_min)
-        greatest_from_date = from_date + timedelta(minutes=max_time_difference_min)
-        filters['from'] = {'$gte': lowest_from_date, '$lte': greatest_from_date}
-    if 'to' in filters:
-        to_date = datetime.fromisoformat(filters['to'])
-        lowest_to_date = to_date - timedelta(minutes=max_time_difference_min)
-        greatest_to_date = to_date + timedelta(minutes=max_time_difference_min)
-        filters['to'] = {'$gte': lowest_to_date, '$lte': greatest_to_date}
-
-    # Get the news search entry
-    result = retrieve_only_with_existing_fields(
-        all_fields, 'news-searches', filters, projection)
+    # Get the news search entry, using its key so that the lookup is a single indexed match.
+    filters = {'searchKey': get_news_search_key(params, max_time_difference_min)}
+    result = get_collection('news-searches').find_one(filters, projection)
 
     succeeded = result is not None
-    # Get all articles from each article url, since articles are stored with just the urls in the 'news-searches' collection.
+    # Get all articles from the article urls, since articles are stored with just the urls in the 'news-searches' collection.
     if succeeded:
         article_urls = result.get('articles', [])
-        for i, url in enumerate(article_urls):
-            article_data = retrieve_article({'url': url})
-            result['articles'][i] = article_data
+        if article_limit is None:
+            article_urls = article_urls[article_offset:]
+        result['articles'] = retrieve_articles_by_urls(article_urls, article_projection)
     return succeeded, result
 
 
+# Return whether the news search is stored, with its dates matched as for retrieve_news_search, without retrieving it.
+def news_search_exists(params: dict, max_time_difference_min: int = None) -> bool:
+    filters = {'searchKey': get_news_search_key(params, max_time_difference_min)}
+    return get_collection('news-searches').find_one(filters, {'_id': 1}) is not None
+
+
 def retrieve_article(filters: dict, projection: dict = None) -> dict | None:
     if projection is None:
         projection = {'_id': 0}
-    return news_db.get_collection('articles').find_one(filters, projection)
+    return get_collection('articles').find_one(filters, projection)
+
+
+# Same as retrieve_article, but returns all articles matching the filters.
+def retrieve_articles(filters: dict, projection: dict = None) -> list:
+    if projection is None:
+        projection = {'_id': 0}
+    return list(get_collection('articles').find(filters, projection))
+
+
+# Return the articles for the given urls, in the same order as the urls, with a single query.
+# Urls that don't have an article in the db are left out.
+# By default, the articles' page failures (and the term counts of articles that weren't migrated yet, see
+# migrate_term_counts) are not returned, as they are only needed for counting term occurrences.
+@metrics.timed('db.retrieve_articles_by_urls')
+def retrieve_articles_by_urls(urls: list, projection: dict = None) -> list:
+    if projection is None:
+        projection = {'_id': 0, 'termCounts': 0, 'pageFailure': 0}
+    else:
+        # The url is needed to put the articles back in order, so make sure it's always returned.
+        projection = {k: v for k, v in projection.items() if k != 'url'}
+        if any(v for k, v in projection.items() if k != '_id'):  # i.e., if the projection only includes the given fields
+            projection['url'] = 1
+    articles_by_url = {article.get('url'): article for article in retrieve_articles({'url': {'$in': list(urls)}}, projection)}
+    metrics.record_cache_lookups('articles', len(articles_by_url), len(set(urls)) - len(articles_by_url))
+    return [articles_by_url[url] for url in urls if url in articles_by_url]
+
+
+# Articles whose page failed to be retrieved have a 'pageFailure' field with the response's status code (None if there
+# was no response), when it failed, and when it expires (after which the page may be retrieved again).
+
+# Return the set of the given urls whose page recently failed to be retrieved (i.e. the failure didn't expire yet).
+@metrics.timed('db.retrieve_failed_page_urls')
+def retrieve_failed_page_urls(urls: list) -> set:
+    filters = {
+        'url': {'$in': list(urls)},
+        'pageFailure.expiresAt': {'$gt': datetime.now(timezone.utc)}
+    }
+    return {article.get('url') for article in retrieve_articles(filters, {'_id': 0, 'url': 1})}
+
+
+# Store the failure for each url in the given dict of url -> failure, with a single bulk write. Each failure has the
+# 'status' and 'expiresAt'.
+@metrics.timed('db.insert_page_failures')
+def insert_page_failures(failures: dict) -> bool:
+    now = datetime.now(timezone.utc)
+    filters_and_updates = [
+        ({'url': url}, {'$set': {'pageFailure': {**failure, 'failedAt': now}}})
+        for url, failure in failures.items()
+    ]
+    return update_or_create_entries('articles', filters_and_updates)
 
 
 # Since articles may have already been encountered from a different news search, we only update those with this search's term
 # instead of making a full new entry.
+# All the articles are written with a single unordered bulk write, and then the news search itself is inserted (after the
+# articles, so that a news search found in the db always has its articles available).
+# If in_background is True (defaults to WRITE_BEHIND), then the entries are queued to be written by a background thread
+# and the function returns immediately, so that the caller doesn't need to wait on the db.
 # Expects:
 #   args - the args used for the search
 #   total_results - the number of results (articles retrieved)
 #   articles - the article objects, which contain the urls as well as the other associating info
-def insert_new_news_search_and_articles(args: dict, articles: list, total_results: int) -> bool:
+#   max_time_difference_min - the date window the search's key is made with (see get_news_search_key)
+def insert_new_news_search_and_articles(args: dict, articles: list, total_results: int, in_background: bool = None,
+                                        max_time_difference_min: int = None) -> bool:
+    if in_background is None:
+        in_background = WRITE_BEHIND
+    if in_background:
+        start_write_behind_thread()
+        write_behind_queue.put((args, articles, total_results, max_time_difference_min))
+        return True
+    return write_news_search_and_articles(args, articles, total_results, max_time_difference_min)
+
+
+@metrics.timed('db.write_news_search_and_articles')
+def write_news_search_and_articles(args: dict, articles: list, total_results: int,
+                                   max_time_difference_min: int = None) -> bool:
+    search_key = get_news_search_key(args, max_time_difference_min)
     args = dict(args)
 
     # For the args, we input them as received, except that we make actual date objects for the 'from' and 'to' parameters
@@ -159,30 +457,580 @@ def insert_new_news_search_and_articles(args: dict, articles: list, total_result
     if 'to' in args:
         args['to'] = datetime.fromisoformat(args['to'])
 
+    # Filter is set just based on the url as that is what makes an article unique. Also, this way entries
+    # will be updated as time goes on if some of the other data changes.
+    # Article is a dict of values, each value needs to be '$set' since we are using update.
+    # (Articles are keyed by url first so that a url appearing twice in the page only results in one operation)
+    articles_by_url = {article.get('url', ''): article for article in articles}
+    article_insertion_succeeded = update_or_create_entries(
+        'articles', [({'url': url}, {'$set': article}) for url, article in articles_by_url.items()])
+
     # For the articles, we keep only the url for the db entry in the 'news-searches' collection.
     # The other article info will be stored separately in the 'articles' collection, along with the number of term occurrences.
+    now = datetime.now(timezone.utc)
     news_searches_document = {
         **args,
+        'searchKey': search_key,
         'articles': [article.get('url') for article in articles],
-        'totalResults': total_results
+        'totalResults': total_results,
+        'insertedAt': now,
+        'expiresAt': get_news_search_expiry(args.get('to'), now)
     }
 
-    news_search_insertion_succeeded = news_db.get_collection('news-searches').insert_one(
-        news_searches_document).acknowledged
-
-    article_insertion_succeeded = True
-    for article in articles:
-        # Filter is set just based on the url as that is what makes an article unique. Also, this way entries
-        # will be updates as time goes on if some of the other data changes.
-        article_filter = {
-            'url': article.get('url', '')
-        }
-
-        # Article is a dict of values, each value needs to be '$set' since we are using update
-        article_update = {
-            '$set': article
-        }
-
-        article_insertion_succeeded = article_insertion_succeeded and update_or_create_entry(
-            'articles', article_filter, article_update)
-    return news_search_insertion_succeeded and article_insertion_succeeded
\ No newline at end of file
+    # The key is unique, so replace any existing entry with the same key (e.g. one that was written concurrently).
+    news_search_insertion_succeeded = get_collection('news-searches').replace_one(
+        {'searchKey': search_key}, news_searches_document, upsert=True).acknowledged
+    schedule_articles_eviction()
+    return news_search_insertion_succeeded and article_insertion_succeeded
+
+
+# Return when a news search (or a stored day of one) stored now should expire, given the end of its dates (None if it has
+# no end, i.e. it goes until now). Searches that include any of today (in UTC) expire after NEWS_SEARCH_CURRENT_TTL_SEC,
+# since they're soon out of date, and others after NEWS_SEARCH_TTL_SEC.
+def get_news_search_expiry(to_date: datetime | None, now: datetime) -> datetime:
+    start_of_today = datetime(year=now.year, month=now.month, day=now.day, tzinfo=timezone.utc)
+    if to_date is None or to_date >= start_of_today:
+        return now + timedelta(seconds=NEWS_SEARCH_CURRENT_TTL_SEC)
+    return now + timedelta(seconds=NEWS_SEARCH_TTL_SEC)
+
+
+# Write-behind queue for news searches. Each item is the (args, articles, total_results, max_time_difference_min) of a
+# news search to insert.
+write_behind_queue = queue.Queue()
+write_behind_thread = None
+write_behind_thread_lock = threading.Lock()
+
+
+# Start the background thread that writes the queued news searches, if it isn't already running.
+def start_write_behind_thread():
+    global write_behind_thread
+    with write_behind_thread_lock:
+        if write_behind_thread is None or not write_behind_thread.is_alive():
+            write_behind_thread = threading.Thread(target=write_behind_worker, daemon=True)
+            write_behind_thread.start()
+
+
+def write_behind_worker():
+    while True:
+        args, articles, total_results, max_time_difference_min = write_behind_queue.get()
+        try:
+            write_news_search_and_articles(args, articles, total_results, max_time_difference_min)
+        except Exception as e:
+            print('Error writing news search to the db:', e)
+        finally:
+            write_behind_queue.task_done()
+
+
+# Block until all queued news searches have been written. This is called on shutdown so that no queued searches are lost.
+def flush_write_behind_queue():
+    if write_behind_thread is not None and write_behind_thread.is_alive():
+        write_behind_queue.join()
+
+
+atexit.register(flush_write_behind_queue)
+
+
+########################################################################
+#     Functions for handling news searches stored by day (buckets)     #
+########################################################################
+
+# News searches are also stored split up by (UTC) day in the 'news-search-days' collection, so that a new search can reuse
+# any days it has in common with previous searches even if its dates are different (see tools.retrieve_news_search_by_days).
+# Each entry has the search's query (its args besides for the dates and paging) and the query's key, the day, the url and
+# publish date of each article published that day, and when it was retrieved.
+
+# Return the key of a news search's query, which is what its days are stored and looked up by.
+def get_news_search_query_key(query: dict) -> str:
+    return hashlib.sha256(json.dumps({k: str(v) for k, v in query.items()}, sort_keys=True).encode()).hexdigest()
+
+
+# Return a dict of day -> entry for each of the given days that has an entry for the query, with a single query.
+@metrics.timed('db.retrieve_news_search_days')
+def retrieve_news_search_days(query: dict, days: list) -> dict:
+    filters = {
+        'queryKey': get_news_search_query_key(query),
+        'day': {'$in': list(days)}
+    }
+    entries = {}
+    for entry in get_collection('news-search-days').find(filters, {'_id': 0, 'query': 0, 'queryKey': 0}):
+        # The db returns dates without a timezone (they are stored in UTC)
+        entry['day'] = entry.get('day').replace(tzinfo=timezone.utc)
+        entry['retrievedAt'] = entry.get('retrievedAt').replace(tzinfo=timezone.utc)
+        for article in entry.get('articles', []):
+            article['publishedAt'] = article.get('publishedAt').replace(tzinfo=timezone.utc)
+        entries[entry['day']] = entry
+    return entries
+
+
+# Store the articles for each day in the given dict of day -> articles, replacing any existing entries for those days.
+# Each article is expected to have its 'url' and its 'publishedAt' date (as a datetime).
+@metrics.timed('db.insert_news_search_days')
+def insert_news_search_days(query: dict, articles_by_day: dict, retrieved_at: datetime) -> bool:
+    query_key = get_news_search_query_key(query)
+    filters_and_updates = [
+        ({'queryKey': query_key, 'day': day}, {'$set': {
+            'query': query,
+            'articles': [{'url': article.get('url'), 'publishedAt': article.get('publishedAt')} for article in articles],
+            'retrievedAt': retrieved_at,
+            'expiresAt': get_news_search_expiry(day, retrieved_at)
+        }})
+        for day, articles in articles_by_day.items()
+    ]
+    return update_or_create_entries('news-search-days', filters_and_updates)
+
+
+##################################################
+#     Functions for handling the term counts     #
+##################################################
+
+# The count of each term on each article's page is stored in the 'term-counts' collection, with an entry per url and
+# term (which is unique), so that looking up a term's counts is a single indexed match no matter how many other terms
+# were counted on the same pages. Each entry also has when it was last used, and entries that weren't used for
+# TERM_COUNTS_TTL_SEC are removed by the db (a TTL index), so the collection doesn't keep growing with rarely used terms.
+# (Term counts used to be stored in each article's 'termCounts' list, see migrate_term_counts)
+
+# Return a dict of url -> count for each of the given urls that already has a count stored for the term.
+# Urls without a stored count for the term are not included. All urls are looked up with a single query.
+@metrics.timed('db.retrieve_term_counts')
+def retrieve_term_counts(term: str, urls: list) -> dict:
+    filters = {
+        'term': term,
+        'url': {'$in': list(urls)}
+    }
+    counts = {entry.get('url'): entry.get('count')
+              for entry in get_collection('term-counts').find(filters, {'_id': 0, 'url': 1, 'count': 1})}
+    # Mark the counts as used, unless they already were recently (so that most lookups don't also need a write).
+    if len(counts) > 0:
+        now = datetime.now(timezone.utc)
+        get_collection('term-counts').update_many(
+            {**filters, 'lastUsed': {'$lt': now - timedelta(seconds=TERM_COUNTS_LAST_USED_RESOLUTION_SEC)}},
+            {'$set': {'lastUsed': now}})
+    return counts
+
+
+# Remove all stored term counts for the given urls (e.g. because their pages' content changed).
+@metrics.timed('db.remove_term_counts')
+def remove_term_counts(urls: list) -> bool:
+    if len(urls) == 0:
+        return True
+    return get_collection('term-counts').delete_many({'url': {'$in': list(urls)}}).acknowledged
+
+
+# Store the counts of all the terms for each url in the given dict of url -> (dict of term -> count), with a single bulk
+# write. Counts that are already stored are replaced, so storing the same counts more than once (e.g. from concurrent
+# requests) leaves a single entry.
+@metrics.timed('db.insert_terms_counts')
+def insert_terms_counts(counts_by_url: dict) -> bool:
+    now = datetime.now(timezone.utc)
+    filters_and_updates = [
+        ({'url': url, 'term': term}, {'$set': {'count': count, 'lastUsed': now}})
+        for url, counts in counts_by_url.items() for term, count in counts.items()
+    ]
+    return update_or_create_entries('term-counts', filters_and_updates)
+
+
+# Move the term counts stored in the articles' 'termCounts' lists (before they had their own collection) to the
+# 'term-counts' collection, batch_size articles at a time, and remove the lists. If an article has more than one count
+# for the same term, then the first is kept (the one that was used). Returns the number of articles migrated.
+def migrate_term_counts(batch_size: int = 100) -> int:
+    now = datetime.now(timezone.utc)
+    num_migrated = 0
+    while True:
+        articles = list(get_collection('articles').find(
+            {'termCounts': {'$exists': True}}, {'_id': 0, 'url': 1, 'termCounts': 1}, limit=batch_size))
+        if len(articles) == 0:
+            break
+        filters_and_updates = []
+        for article in articles:
+            first_counts = {}
+            for term_count in article.get('termCounts') or []:
+                first_counts.setdefault(term_count.get('term'), term_count.get('count'))
+            # (Counts that are already in the collection are newer, so they're kept)
+            filters_and_updates += [
+                ({'url': article.get('url'), 'term': term}, {'$setOnInsert': {'count': count, 'lastUsed': now}})
+                for term, count in first_counts.items()
+            ]
+        update_or_create_entries('term-counts', filters_and_updates)
+        urls = [article.get('url') for article in articles]
+        get_collection('articles').update_many({'url': {'$in': urls}}, {'$unset': {'termCounts': ''}})
+        num_migrated += len(articles)
+
+    try:
+        get_collection('articles').drop_index('termCounts.term_1')
+    except Exception:  # (it was already dropped, or never created)
+        pass
+    return num_migrated
+
+
+################################################
+#     Functions for handling background jobs     #
+################################################
+
+# The state of each background job (see the jobs module) is stored in the 'jobs' collection, so that it can be retrieved
+# from any of the app's processes. Each entry has the job's id, its state (JSON-encoded, since the state's keys include
+# the counted terms, which aren't always valid field names) and when it expires, after which the db removes it.
+
+# Store the job's state (see jobs.Job.to_dict), replacing any state stored for the job before.
+@metrics.timed('db.update_job_state')
+def update_job_state(state: dict, expires_at: datetime) -> bool:
+    document = {'jobId': state.get('job_id'), 'state': json.dumps(state), 'expiresAt': expires_at}
+    return get_collection('jobs').replace_one({'jobId': state.get('job_id')}, document, upsert=True).acknowledged
+
+
+# Return the stored state of the job, or None if there is none.
+@metrics.timed('db.retrieve_job_state')
+def retrieve_job_state(job_id: str) -> dict | None:
+    entry = get_collection('jobs').find_one({'jobId': job_id}, {'_id': 0, 'state': 1})
+    return json.loads(entry.get('state')) if entry is not None else None
+
+
+###############################################
+#     Functions for computing term trends     #
+###############################################
+
+# The intervals that a term's trend can be computed by, as interval -> (the length of the prefix of the articles'
+# 'publishedAt' that is the same for all articles in the same interval, the prefix's date format). (newsapi's publish dates
+# are ISO strings in UTC, e.g. '2024-01-31T12:34:56Z')
+TERM_TREND_INTERVAL_FORMATS = {
+    'day': (10, '%Y-%m-%d'),
+    'hour': (13, '%Y-%m-%dT%H')
+}
+
+
+# Return a dict of interval start -> counts for each (UTC) interval that any of the given urls' articles with a stored
+# count for the term were published in. The counts are how many of the articles have a stored count for the term
+# ('numCountedArticles'), and the total of those counts ('numOccurrences'). They're computed with an aggregation over the
+# term's counts, joined with their articles' publish dates (so the articles must already be written to the db).
+@metrics.timed('db.retrieve_term_trend')
+def retrieve_term_trend(term: str, urls: list, interval: str) -> dict:
+    prefix_length, date_format = TERM_TREND_INTERVAL_FORMATS[interval]
+    term_counts_pipeline = [
+        {'$match': {'term': term, 'url': {'$in': list(urls)}}},
+        {'$lookup': {'from': 'articles', 'localField': 'url', 'foreignField': 'url', 'as': 'article'}},
+        {'$unwind': '$article'},
+        {'$group': {
+            '_id': {'$substr': ['$article.publishedAt', 0, prefix_length]},
+            'numCountedArticles': {'$sum': 1},
+            'numOccurrences': {'$sum': '$count'}
+        }}
+    ]
+    trend = {}
+    for entry in get_collection('term-counts').aggregate(term_counts_pipeline):
+        trend[datetime.strptime(entry.pop('_id'), date_format).replace(tzinfo=timezone.utc)] = entry
+    return trend
+
+
+
+##########################################################
+#     Functions for handling the articles' page text     #
+##########################################################
+
+# The text of each article's page is stored compressed in the 'page-texts' collection, so that counting a new term on
+# a page that was already retrieved doesn't require retrieving the page again. Each entry has the url, a hash of the text
+# (to tell if the page's content changed), the compressed text and its size, the page's 'ETag' and 'Last-Modified'
+# headers (so it can be revalidated without downloading it again), when it was retrieved and last used, and whether its
+# text is in the term index yet ('indexed', see the term index functions below).
+# Once the total size goes over PAGE_TEXTS_MAX_BYTES, the least recently used entries are removed.
+
+# Return a dict of url -> entry for each of the given urls that has its text stored, with a single query.
+# Each entry has the (decompressed) 'text', 'contentHash', 'etag', 'lastModified', 'retrievedAt' and 'indexed'.
+# If include_text is False, then the text isn't returned (nor decompressed), e.g. for when the term index is used instead.
+@metrics.timed('db.retrieve_page_texts')
+def retrieve_page_texts(urls: list, include_text: bool = True) -> dict:
+    projection = {'_id': 0, 'url': 1, 'text': 1, 'contentHash': 1, 'etag': 1, 'lastModified': 1, 'retrievedAt': 1,
+                  'indexed': 1}
+    if not include_text:
+        del projection['text']
+    entries = {}
+    for entry in get_collection('page-texts').find({'url': {'$in': list(urls)}}, projection):
+        if include_text:
+            entry['text'] = zlib.decompress(entry.get('text')).decode('utf-8')
+        entry['indexed'] = entry.get('indexed', False)
+        entry['retrievedAt'] = entry.get('retrievedAt').replace(tzinfo=timezone.utc)  # (stored in UTC)
+        entries[entry.pop('url')] = entry
+    if len(entries) > 0:
+        get_collection('page-texts').update_many(
+            {'url': {'$in': list(entries)}}, {'$set': {'lastUsed': datetime.now(timezone.utc)}})
+    return entries
+
+
+# Return the hash of a page's text that is stored with it.
+def get_content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# Store the text for each url in the given dict of url -> page, with a single bulk write. Each page has the 'text', and
+# optionally the 'etag' and 'lastModified' headers it was retrieved with. The texts are marked as not indexed yet (see
+# insert_term_index).
+@metrics.timed('db.insert_page_texts')
+def insert_page_texts(pages: dict) -> bool:
+    now = datetime.now(timezone.utc)
+    filters_and_updates = []
+    for url, page in pages.items():
+        text = page.get('text')
+        compressed_text = zlib.compress(text.encode('utf-8'))
+        filters_and_updates.append(({'url': url}, {'$set': {
+            'contentHash': get_content_hash(text),
+            'text': compressed_text,
+            'size': len(compressed_text),
+            'etag': page.get('etag'),
+            'lastModified': page.get('lastModified'),
+            'retrievedAt': now,
+            'lastUsed': now,
+            'indexed': False
+        }}))
+    succeeded = update_or_create_entries('page-texts', filters_and_updates)
+    if len(filters_and_updates) > 0:
+        schedule_eviction('page texts', evict_page_texts, PAGE_TEXTS_EVICTION_INTERVAL_SEC)
+    return succeeded
+
+
+# Mark the stored texts of the given urls as just retrieved, for when the pages were revalidated and hadn't changed.
+@metrics.timed('db.update_page_texts_retrieved')
+def update_page_texts_retrieved(urls: list) -> bool:
+    if len(urls) == 0:
+        return True
+    return get_collection('page-texts').update_many(
+        {'url': {'$in': list(urls)}}, {'$set': {'retrievedAt': datetime.now(timezone.utc)}}).acknowledged
+
+
+# Remove the least recently used page texts until their total size is within max_bytes, along with their entries in the
+# term index. Returns the number removed. (Run in the background at most once every PAGE_TEXTS_EVICTION_INTERVAL_SEC
+# when page texts are stored, since summing their sizes goes over the whole collection)
+@metrics.timed('db.evict_page_texts')
+def evict_page_texts(max_bytes: int = None) -> int:
+    if max_bytes is None:
+        max_bytes = PAGE_TEXTS_MAX_BYTES
+    collection = get_collection('page-texts')
+
+    total_size = next(collection.aggregate([{'$group': {'_id': None, 'size': {'$sum': '$size'}}}]), {}).get('size', 0)
+    if total_size <= max_bytes:
+        return 0
+
+    ids_to_remove = []
+    urls_to_remove = []
+    for entry in collection.find({}, {'_id': 1, 'url': 1, 'size': 1}, sort=[('lastUsed', 1)]):
+        if total_size <= max_bytes:
+            break
+        ids_to_remove.append(entry.get('_id'))
+        urls_to_remove.append(entry.get('url'))
+        total_size -= entry.get('size', 0)
+    num_removed = collection.delete_many({'_id': {'$in': ids_to_remove}}).deleted_count
+    remove_from_term_index(urls_to_remove)
+    # (Entries whose pages were all removed are only deleted here, rather than every time pages are removed from the index)
+    get_collection('term-index').delete_many({'postings': {'$size': 0}})
+    return num_removed
+
+
+#################################################
+#     Functions for handling the term index     #
+#################################################
+
+# The 'term-index' collection is an inverted index of the stored page texts: for each word (token), it has entries with
+# the token's postings, i.e. the pages it is on, as a list of the page's url, the number of times the token is on the page,
+# and the article's publish date (so the index can also be queried by date). Each entry only has the pages of articles
+# published on the same day (its 'day'), and at most TERM_INDEX_MAX_POSTINGS_PER_ENTRY of them, so that its size is
+# bounded. The page texts are indexed in the background once they're stored (see tools.schedule_page_text_indexing),
+# and a page text's entry in 'page-texts' is marked as 'indexed' once its tokens are in the index.
+# (An index stored by an earlier version, with an entry for each token on each page, is replaced by running
+# `python manage.py index-page-texts --rebuild`)
+
+# Add the tokens for each url in the given dict of url -> (dict of token -> count) to the index, replacing any tokens that
+# were indexed for the url before, and mark their page texts as indexed. content_hashes is a dict of url -> the
+# 'contentHash' of the page text that was tokenized, and a page text is only marked as indexed if it's still the same
+# text (so a text that was stored again in the meantime is indexed again), and only once its tokens were all written.
+# The tokens are written with one update for each token and day (rather than one for each token on each page), in bulk
+# writes of at most TERM_INDEX_MAX_UPDATES_PER_WRITE updates.
+# (If the same page is indexed twice at the same time, then it may be in a token's postings twice, which lookups ignore)
+@metrics.timed('db.insert_term_index')
+def insert_term_index(token_counts_by_url: dict, content_hashes: dict) -> bool:
+    if len(token_counts_by_url) == 0:
+        return True
+    urls = list(token_counts_by_url)
+    published_dates = {article.get('url'): article.get('publishedAt')
+                       for article in retrieve_articles({'url': {'$in': urls}}, {'_id': 0, 'url': 1, 'publishedAt': 1})}
+    remove_from_term_index(urls)
+
+    postings_by_token_and_day = {}
+    for url, token_counts in token_counts_by_url.items():
+        published_at = datetime.fromisoformat(published_dates[url]) if published_dates.get(url) else None
+        day = published_at.replace(hour=0, minute=0, second=0, microsecond=0) if published_at is not None else None
+        for token, count in token_counts.items():
+            postings_by_token_and_day.setdefault((token, day), []).append(
+                {'url': url, 'count': count, 'publishedAt': published_at})
+    filters_and_updates = []
+    for (token, day), postings in postings_by_token_and_day.items():
+        # Pages are added to the day's entry for the token that still has room, or to a new entry if none do
+        for i in range(0, len(postings), TERM_INDEX_MAX_POSTINGS_PER_ENTRY):
+            batch = postings[i:i + TERM_INDEX_MAX_POSTINGS_PER_ENTRY]
+            filters_and_updates.append((
+                {'token': token, 'day': day, 'size': {'$lte': TERM_INDEX_MAX_POSTINGS_PER_ENTRY - len(batch)}},
+                {'$push': {'postings': {'$each': batch}}, '$inc': {'size': len(batch)}}))
+    for i in range(0, len(filters_and_updates), TERM_INDEX_MAX_UPDATES_PER_WRITE):
+        if not update_or_create_entries('term-index', filters_and_updates[i:i + TERM_INDEX_MAX_UPDATES_PER_WRITE]):
+            return False
+    return get_collection('page-texts').bulk_write(
+        [UpdateOne({'url': url, 'contentHash': content_hashes.get(url)}, {'$set': {'indexed': True}}) for url in urls],
+        ordered=False).acknowledged
+
+
+# Remove the given urls from the postings of all the tokens in the index.
+# (An entry's 'size' isn't decreased, so it's the number of pages that were ever added to it)
+def remove_from_term_index(urls: list) -> bool:
+    if len(urls) == 0:
+        return True
+    return get_collection('term-index').update_many(
+        {'postings.url': {'$in': list(urls)}}, {'$pull': {'postings': {'url': {'$in': list(urls)}}}}).acknowledged
+
+
+# Remove the whole term index (including its db indexes, which are created again by ensure_indexes), and mark all the
+# page texts as not indexed, so that they're all indexed again.
+def clear_term_index() -> bool:
+    get_collection('term-index').drop()
+    ensure_indexes()
+    return get_collection('page-texts').update_many({}, {'$set': {'indexed': False}}).acknowledged
+
+
+# Return a dict of url -> the number of times the word occurs on the page, for each indexed page that the word occurs on.
+# Expects the word to be lowercase, and made up only of word characters (so that it can only occur within a single token).
+# How the word is matched against the tokens depends on match:
+# - 'exact': only the tokens that are the word itself (e.g. 'apple', but not 'apples'). Uses the index's bounds, so it
+#   only reads the word's own entries.
+# - 'prefix': the tokens that start with the word (e.g. 'apple' and 'apples'). Also uses the index's bounds.
+# - 'substring': the tokens that contain the word anywhere (e.g. also 'pineapples'), counting each occurrence within
+#   them, so the counts are the same as counting the word in the pages' texts (see tools.count_terms_in_text). This can't
+#   use the index's bounds, so it scans all the index's (token, day) keys, but only reads the entries of the tokens that
+#   match (and not every page's tokens).
+# Only the given urls are looked up if any are given, and only the pages published between the dates if any are given.
+@metrics.timed('db.retrieve_indexed_word_counts')
+def retrieve_indexed_word_counts(word: str, match: str = 'exact', urls: list = None, from_date: datetime = None,
+                                 to_date: datetime = None) -> dict:
+    if match == 'exact':
+        filters = {'token': word}
+    elif match == 'prefix':
+        filters = {'token': {'$regex': '^' + re.escape(word)}}
+    else:
+        filters = {'token': {'$regex': re.escape(word)}}
+    posting_filters = {}
+    if urls is not None:
+        filters['postings.url'] = {'$in': list(urls)}
+        posting_filters['postings.url'] = {'$in': list(urls)}
+    if from_date is not None or to_date is not None:
+        filters['day'] = {}
+        posting_filters['postings.publishedAt'] = {}
+        if from_date is not None:
+            filters['day']['$gte'] = from_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            posting_filters['postings.publishedAt']['$gte'] = from_date
+        if to_date is not None:
+            filters['day']['$lte'] = to_date
+            posting_filters['postings.publishedAt']['$lte'] = to_date
+    pipeline = [{'$match': filters}, {'$unwind': '$postings'}]
+    if len(posting_filters) > 0:
+        pipeline.append({'$match': posting_filters})
+    pipeline.append({'$project': {'_id': 0, 'token': 1, 'url': '$postings.url', 'count': '$postings.count'}})
+
+    counts_by_url_and_token = {}
+    for entry in get_collection('term-index').aggregate(pipeline):
+        counts_by_url_and_token[(entry.get('url'), entry.get('token'))] = entry.get('count')
+    counts = {}
+    for (url, token), count in counts_by_url_and_token.items():
+        counts[url] = counts.get(url, 0) + token.count(word) * count
+    return counts
+
+
+# Return the urls of the page texts that aren't indexed yet, up to limit of them.
+def retrieve_unindexed_page_text_urls(limit: int) -> list:
+    entries = get_collection('page-texts').find({'indexed': {'$ne': True}}, {'_id': 0, 'url': 1}, limit=limit)
+    return [entry.get('url') for entry in entries]
+
+
+##################################################
+#     Functions for limiting the stored data     #
+##################################################
+
+# Stored news searches expire on their own (see get_news_search_expiry). Articles are only removed once no stored search
+# refers to them, and only when they take up more than ARTICLES_MAX_BYTES (see evict_unreferenced_articles).
+
+# The collections that are compacted by compact_collections.
+COMPACTED_COLLECTIONS = ['news-searches', 'news-search-days', 'articles', 'page-texts', 'term-index', 'term-counts']
+
+
+# Return the db's stats for the collection ('size', 'avgObjSize', 'storageSize', 'totalIndexSize', etc.), in bytes.
+def get_collection_stats(collection_name: str) -> dict:
+    return get_client().get_database(MONGODB_DB_NAME).command('collStats', collection_name)
+
+
+# If the articles take up more than max_bytes (defaults to ARTICLES_MAX_BYTES), then remove the oldest (by publish date)
+# articles that no stored news search refers to, until they'd fit (based on the articles' average size), or until there
+# are no more unreferenced articles, along with their pages' stored texts, term counts and term index postings. Returns
+# the number of articles removed.
+# The unreferenced articles are found by the db, which goes through the articles by publish date and looks up whether any
+# stored search (or stored day of one) refers to each, until it has found enough of them.
+@metrics.timed('db.evict_unreferenced_articles')
+def evict_unreferenced_articles(max_bytes: int = None) -> int:
+    if max_bytes is None:
+        max_bytes = ARTICLES_MAX_BYTES
+    stats = get_collection_stats('articles')
+    if stats.get('size', 0) <= max_bytes:
+        return 0
+    num_to_remove = math.ceil((stats.get('size') - max_bytes) / max(stats.get('avgObjSize', 1), 1))
+
+    # (Only whether any entry refers to an article matters, so at most one entry is looked up for each)
+    pipeline = [
+        {'$sort': {'publishedAt': 1}},
+        {'$project': {'_id': 1, 'url': 1}},
+        {'$lookup': {'from': 'news-searches', 'localField': 'url', 'foreignField': 'articles',
+                     'pipeline': [{'$limit': 1}, {'$project': {'_id': 1}}], 'as': 'searches'}},
+        {'$match': {'searches': {'$size': 0}}},
+        {'$lookup': {'from': 'news-search-days', 'localField': 'url', 'foreignField': 'articles.url',
+                     'pipeline': [{'$limit': 1}, {'$project': {'_id': 1}}], 'as': 'days'}},
+        {'$match': {'days': {'$size': 0}}},
+        {'$limit': num_to_remove},
+        {'$project': {'_id': 1, 'url': 1}}
+    ]
+    articles = list(get_collection('articles').aggregate(pipeline))
+    if len(articles) == 0:
+        return 0
+    urls = [article.get('url') for article in articles]
+    num_removed = get_collection('articles').delete_many(
+        {'_id': {'$in': [article.get('_id') for article in articles]}}).deleted_count
+    get_collection('page-texts').delete_many({'url': {'$in': urls}})
+    get_collection('term-counts').delete_many({'url': {'$in': urls}})
+    remove_from_term_index(urls)
+    return num_removed
+
+
+# Evict unreferenced articles (see evict_unreferenced_articles) in a background thread, unless that was already done in
+# the last ARTICLES_EVICTION_INTERVAL_SEC. (Called whenever a news search is stored)
+def schedule_articles_eviction():
+    schedule_eviction('articles', evict_unreferenced_articles, ARTICLES_EVICTION_INTERVAL_SEC)
+
+
+# Give the stored news searches (and days) that were stored before they had an expiry one, as if they were stored now.
+# Returns the number updated.
+def set_missing_news_search_expiries() -> int:
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=NEWS_SEARCH_TTL_SEC)
+    num_updated = 0
+    for collection_name in ['news-searches', 'news-search-days']:
+        num_updated += get_collection(collection_name).update_many(
+            {'expiresAt': {'$exists': False}}, {'$set': {'expiresAt': expires_at}}).modified_count
+    return num_updated
+
+
+# Compact each of the COMPACTED_COLLECTIONS, so that the space of removed entries is released, and return a dict of
+# collection name -> its size on disk (including its indexes) before and after ('bytesBefore' and 'bytesAfter'), and the
+# 'error' if it couldn't be compacted (e.g. if the db user isn't allowed to).
+def compact_collections() -> dict:
+    database = get_client().get_database(MONGODB_DB_NAME)
+    results = {}
+    for collection_name in COMPACTED_COLLECTIONS:
+        stats = get_collection_stats(collection_name)
+        result = {'bytesBefore': stats.get('storageSize', 0) + stats.get('totalIndexSize', 0), 'error': None}
+        try:
+            database.command('compact', collection_name)
+        except OperationFailure as e:
+            result['error'] = str(e)
+        stats = get_collection_stats(collection_name)
+        result['bytesAfter'] = stats.get('storageSize', 0) + stats.get('totalIndexSize', 0)
+        results[collection_name] = result
+    return results
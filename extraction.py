@@ -0,0 +1,97 @@
+from html.parser import HTMLParser
+import codecs
+from bs4 import BeautifulSoup
+
+try:
+    from lxml import etree
+except ImportError:  # lxml is optional, the 'stream' backend is used without it
+    etree = None
+
+##########################################################################################
+#     This module defines the backends used for extracting the text of article pages     #
+##########################################################################################
+
+# The content of these elements is never part of the page's text.
+SKIPPED_TAGS = ['script', 'style', 'noscript', 'template']
+
+# The backend used when none is given. Can be any of the keys of BACKENDS.
+DEFAULT_BACKEND = 'lxml' if etree is not None else 'stream'
+
+
+# Return the text of the HTML page given as an iterable of byte chunks (e.g. as it is being downloaded), without the
+# content of any SKIPPED_TAGS. encoding is the page's encoding if known (e.g. from the response's headers), otherwise
+# the backend will detect it or use utf-8.
+def extract_text(chunks, encoding: str = None, backend: str = None) -> str:
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    return BACKENDS[backend](chunks, encoding)
+
+
+# Return the names of the backends that can be used (i.e. that have their dependencies installed).
+def get_available_backends() -> list:
+    return [backend for backend in BACKENDS if backend != 'lxml' or etree is not None]
+
+
+####################
+#     Backends     #
+####################
+
+# Uses lxml's HTML parser (libxml2), fed one chunk at a time. The fastest backend.
+def extract_text_lxml(chunks, encoding: str = None) -> str:
+    parser = etree.HTMLParser(encoding=encoding, remove_comments=True, remove_pis=True)
+    for chunk in chunks:
+        parser.feed(chunk)
+    root = parser.close()
+    if root is None:
+        return ''
+    etree.strip_elements(root, *SKIPPED_TAGS, with_tail=False)
+    return ''.join(root.itertext())
+
+
+# Collects the text of an HTML page as it's fed, skipping the content of any SKIPPED_TAGS.
+class StreamingTextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipped_tags_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skipped_tags_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS and self.skipped_tags_depth > 0:
+            self.skipped_tags_depth -= 1
+
+    def handle_data(self, data):
+        if self.skipped_tags_depth == 0:
+            self.parts.append(data)
+
+    def get_text(self) -> str:
+        return ''.join(self.parts)
+
+
+# Uses the standard library's HTML tokenizer, fed one chunk at a time without building a tree. Has no dependencies.
+def extract_text_stream(chunks, encoding: str = None) -> str:
+    decoder = codecs.getincrementaldecoder(encoding or 'utf-8')(errors='replace')
+    extractor = StreamingTextExtractor()
+    for chunk in chunks:
+        extractor.feed(decoder.decode(chunk))
+    extractor.feed(decoder.decode(b'', final=True))
+    extractor.close()
+    return extractor.get_text()
+
+
+# Uses BeautifulSoup with Python's HTML parser, which builds the whole tree. The slowest backend, kept for comparison.
+def extract_text_bs4(chunks, encoding: str = None) -> str:
+    soup = BeautifulSoup(b''.join(chunks), 'html.parser', from_encoding=encoding)
+    for element in soup(SKIPPED_TAGS):
+        element.decompose()
+    return soup.get_text()
+
+
+BACKENDS = {
+    'lxml': extract_text_lxml,
+    'stream': extract_text_stream,
+    'bs4': extract_text_bs4
+}
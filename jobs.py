@@ -0,0 +1,176 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import copy
+import threading
+import time
+import uuid
+import db
+
+####################################################################################################
+#     This module defines the background jobs used for long-running work (e.g. counting terms)     #
+####################################################################################################
+
+# Max number of jobs that run at once. Any other jobs wait in a queue until a worker is free.
+MAX_WORKERS = 4
+# Finished jobs are kept for this long so that their result can still be retrieved, then they're removed.
+FINISHED_JOB_MAX_AGE_SEC = 30 * 60
+
+# Jobs run in the process they're submitted to, but if the db is used, their state is also stored in the db, so that it
+# can be retrieved from any process (e.g. any worker of a preforking server, not only the one running the job). Their
+# progress is written at most once every JOB_STATE_WRITE_INTERVAL_SEC (other changes are written right away), and other
+# processes check for changes every JOB_POLL_INTERVAL_SEC. Stored jobs are removed by the db FINISHED_JOB_MAX_AGE_SEC
+# after they were last updated (so also if the process running the job stopped).
+JOB_STATE_WRITE_INTERVAL_SEC = 1
+JOB_POLL_INTERVAL_SEC = 1
+
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='job')
+jobs_lock = threading.Lock()
+jobs = {}  # job id -> Job, for the jobs submitted to this process
+
+
+# A job's state. Every change to it increments its version and notifies anyone waiting on it (see wait_for_job_update).
+# If use_db is True, then the state is also stored in the db (see write_state).
+class Job:
+    def __init__(self, use_db: bool = False):
+        self.id = uuid.uuid4().hex
+        self.use_db = use_db
+        self.write_lock = threading.Lock()
+        self.written_version = -1
+        self.written_at = None
+        self.status = 'queued'  # then 'running', and finally 'succeeded' or 'failed'
+        self.progress = {}
+        self.result = None
+        self.errors = {}
+        self.version = 0
+        self.updated = threading.Condition()
+        self.started_at = None
+        self.finished_at = None
+        # When the first progress was reported and how many pages were done then, for estimating the time left
+        self.progress_started_at = None
+        self.progress_start_num_pages_done = 0
+
+    def update(self, **fields):
+        with self.updated:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self.updated.notify_all()
+        # (Only the progress changes often, so other changes are always written)
+        if self.use_db and (fields.keys() != {'progress'} or self.written_at is None or
+                            time.monotonic() - self.written_at >= JOB_STATE_WRITE_INTERVAL_SEC):
+            self.write_state()
+
+    # Store the job's current state in the db, unless it's already stored. (Concurrent updates are written one at a time,
+    # so that an older state never replaces a newer one)
+    def write_state(self):
+        with self.write_lock:
+            state = self.to_dict()
+            if state.get('version') <= self.written_version:
+                return
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=FINISHED_JOB_MAX_AGE_SEC)
+            try:
+                db.update_job_state(state, expires_at)
+                self.written_version = state.get('version')
+                self.written_at = time.monotonic()
+            except Exception as e:
+                print('Error storing job state:', e)
+
+    # Record the progress reported by the job's function. Expects a dict with at least 'num_pages_total' and
+    # 'num_pages_done' (see tools.num_occurrences_of_terms_on_pages).
+    def report_progress(self, progress: dict):
+        if self.progress_started_at is None:
+            self.progress_started_at = time.monotonic()
+            self.progress_start_num_pages_done = progress.get('num_pages_done', 0)
+        self.update(progress=copy.deepcopy(progress))
+
+    # Return the estimated number of seconds left, based on how fast pages were done since the first progress was
+    # reported. Returns None if it can't be estimated yet.
+    def get_eta_sec(self) -> float | None:
+        if self.status != 'running' or self.progress_started_at is None:
+            return None
+        num_pages_done = self.progress.get('num_pages_done', 0) - self.progress_start_num_pages_done
+        elapsed = time.monotonic() - self.progress_started_at
+        if num_pages_done <= 0 or elapsed <= 0:
+            return None
+        num_pages_left = self.progress.get('num_pages_total', 0) - self.progress.get('num_pages_done', 0)
+        return round(num_pages_left * elapsed / num_pages_done, 1)
+
+    def to_dict(self) -> dict:
+        with self.updated:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'progress': self.progress,
+                'eta_sec': self.get_eta_sec(),
+                'result': self.result,
+                'errors': self.errors,
+                'version': self.version
+            }
+
+    def is_finished(self) -> bool:
+        return self.status in ['succeeded', 'failed']
+
+
+# Run func in the background and return the job's id. func is called with a function for reporting its progress (see
+# Job.report_progress), and should return a tuple of (succeeded, result, errors), like the functions in tools.
+# If use_db is True, then the job's state is stored in the db, so that it can be retrieved from any process.
+def submit_job(func, use_db: bool = False) -> str:
+    remove_old_jobs()
+    job = Job(use_db)
+    with jobs_lock:
+        jobs[job.id] = job
+    if use_db:
+        job.write_state()
+    executor.submit(run_job, job, func)
+    return job.id
+
+
+def run_job(job: Job, func):
+    job.update(status='running', started_at=time.monotonic())
+    try:
+        succeeded, result, errors = func(job.report_progress)
+        job.update(status='succeeded' if succeeded else 'failed', result=result, errors=errors,
+                   finished_at=time.monotonic())
+    except Exception:  # Unknown error, mark the job as failed to indicate so.
+        job.update(status='failed', errors={'error_source': 'internal', 'message': 'error running job'},
+                   finished_at=time.monotonic())
+
+
+# Return the job's state as a dict (see Job.to_dict), or None if there is no job with the id (or it was removed).
+# If use_db is True, then jobs that were submitted to other processes are retrieved from the db.
+def get_job(job_id: str, use_db: bool = False) -> dict | None:
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is not None:
+        return job.to_dict()
+    return db.retrieve_job_state(job_id) if use_db else None
+
+
+# Wait until the job's version is greater than the given one (i.e. it changed since), or until the timeout, and return
+# the job's state as a dict (see Job.to_dict). Returns None if there is no job with the id.
+# If use_db is True, then jobs that were submitted to other processes are checked in the db every JOB_POLL_INTERVAL_SEC.
+def wait_for_job_update(job_id: str, version: int, timeout_sec: float, use_db: bool = False) -> dict | None:
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is not None:
+        with job.updated:
+            job.updated.wait_for(lambda: job.version > version, timeout=timeout_sec)
+        return job.to_dict()
+    if not use_db:
+        return None
+
+    deadline = time.monotonic() + timeout_sec
+    while True:
+        state = db.retrieve_job_state(job_id)
+        remaining = deadline - time.monotonic()
+        if state is None or state.get('version') > version or remaining <= 0:
+            return state
+        time.sleep(min(JOB_POLL_INTERVAL_SEC, remaining))
+
+
+def remove_old_jobs():
+    now = time.monotonic()
+    with jobs_lock:
+        for job_id in [job_id for job_id, job in jobs.items()
+                       if job.is_finished() and now - job.finished_at > FINISHED_JOB_MAX_AGE_SEC]:
+            del jobs[job_id]
@@ -1,8 +1,13 @@
-from flask import Flask, render_template, request
+from flask import Flask, Response, g, render_template, request, stream_with_context
+from datetime import datetime
+import hashlib
 import json
+import time
 from werkzeug.exceptions import HTTPException
 import tools
-import db
+import jobs
+import metrics
+import prewarming
 
 ##########################
 #     The server app     #
@@ -10,6 +15,39 @@ import db
 
 app = Flask(__name__)
 USE_DB = True  # If false, then it will always use the API
+SHARD_LARGE_SEARCHES = True  # If true, then searches with too many results to count at once are split up by date
+ENUMS_MAX_AGE_SEC = 60 * 60  # How long browsers may reuse the enums (the filter options) before checking for changes
+# If true, then responses include a breakdown of where the request's time was spent (per stage, and the caches' hits and
+# misses) in their 'dev_logs'. The totals across all requests are always available at /metrics.
+INCLUDE_DEV_LOGS = False
+JOB_STREAM_KEEPALIVE_SEC = 15  # How often a job's progress stream sends something when nothing changed, to keep it open
+# If true (and the db is used), then the most popular searches are kept stored in the db, using spare api quota, by a
+# background thread that runs every PREWARM_INTERVAL_SEC (see tools.prewarm_popular_searches).
+PREWARM_POPULAR_SEARCHES = True
+PREWARM_INTERVAL_SEC = 10 * 60
+
+
+# (Started on the first request rather than on import, so that each worker process of a preforking server runs its own)
+@app.before_request
+def start_prewarmer():
+    if PREWARM_POPULAR_SEARCHES and USE_DB:
+        prewarming.start_prewarmer(tools.prewarm_popular_searches, PREWARM_INTERVAL_SEC)
+
+
+@app.before_request
+def start_request_timing():
+    g.request_start = time.perf_counter()
+    if INCLUDE_DEV_LOGS:
+        metrics.start_request_log()
+    else:
+        metrics.stop_request_log()
+
+
+@app.after_request
+def record_request_timing(response):
+    if 'request_start' in g and request.url_rule is not None:
+        metrics.record_stage_time('request ' + request.url_rule.rule, time.perf_counter() - g.request_start)
+    return response
 
 
 @app.route('/')
@@ -24,14 +62,25 @@ def search():
     return render_template('search.html', term1=term_1)
 
 
+# Return a response that browsers may reuse for ENUMS_MAX_AGE_SEC seconds, and then only need to revalidate (with its
+# ETag). The ETag is based on the values only, since the rest of the body (e.g. the request's time) changes every time.
+# If the request's If-None-Match matches the ETag, then the response is a 304 without the body.
+def get_cacheable_response(body: str, values) -> Response:
+    response = Response(body)
+    response.cache_control.public = True
+    response.cache_control.max_age = ENUMS_MAX_AGE_SEC
+    response.set_etag(hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest())
+    return response.make_conditional(request)
+
+
 # Used for news searches. No args expected.
 @app.route('/internal/get-languages')
 def get_languages():
-    result = db.news_db.get_collection('enums').find_one({'name': 'language'}, {'_id': 0, 'values': 1})
-    if result is not None:
-        languages = result.get('values', {})
+    languages = tools.retrieve_enum_values('language')
+    if languages is not None:
         return_dict = tools.get_template_response_dict(
             request.base_url, request.args, len(languages), True, {}, languages)
+        return get_cacheable_response(json.dumps(return_dict), languages)
     else:
         return_dict = tools.get_template_response_dict(
             request.base_url, request.args, 0, False,
@@ -43,11 +92,11 @@ def get_languages():
 # Used for news searches. No args expected.
 @app.route('/internal/get-countries')
 def get_countries():
-    result = db.news_db.get_collection('enums').find_one({'name': 'country'}, {'_id': 0, 'values': 1})
-    if result is not None:
-        countries = result.get('values')
+    countries = tools.retrieve_enum_values('country')
+    if countries is not None:
         return_dict = tools.get_template_response_dict(
             request.base_url, request.args, len(countries), True, {}, countries)
+        return get_cacheable_response(json.dumps(return_dict), countries)
     else:
         return_dict = tools.get_template_response_dict(
             request.base_url, request.args, 0, False,
@@ -59,11 +108,11 @@ def get_countries():
 # Used for news searches. No args expected.
 @app.route('/internal/get-categories')
 def get_categories():
-    result = db.news_db.get_collection('enums').find_one({'name': 'category'}, {'_id': 0, 'values': 1})
-    if result is not None:
-        categories = result.get('values')
+    categories = tools.retrieve_enum_values('category')
+    if categories is not None:
         return_dict = tools.get_template_response_dict(
             request.base_url, request.args, len(categories), True, {}, categories)
+        return get_cacheable_response(json.dumps(return_dict), categories)
     else:
         return_dict = tools.get_template_response_dict(
             request.base_url, request.args, 0, False,
@@ -72,9 +121,10 @@ def get_categories():
     return json.dumps(return_dict)
 
 
-# Return news articles based on the given parameters. Only returns the first 10 articles, but gives the total number of articles that exist.
+# Return news articles based on the given parameters. Only returns 10 articles, but gives the total number of articles that exist.
 # Expects:
 #   'q' (required)
+#   'offset' (the number of articles to skip, for paginating over the articles. Defaults to 0)
 #   'from' (an iso string)
 #   'to' (an iso string)
 #   'language'
@@ -89,15 +139,26 @@ def get_articles():
     return_dict = tools.get_template_response_dict(
         url=request.base_url, args=request.args)
     errors = {}
+
+    # The offset is only used for selecting the articles to return, so it isn't sent as part of the news search.
+    search_args = request.args.to_dict()
+    offset = search_args.pop('offset', '0')
+    if not offset.isdigit():
+        return_dict['errors']['error_source'] = 'internal'
+        return_dict['errors']['message'] = 'invalid input: \'offset\' must be a non-negative integer'
+        return json.dumps(return_dict), 400
+    offset = int(offset)
+
     if len(request.args.get('q', '')) > 0:
         succeeded, results, errors = tools.retrieve_news_search(
-            request.args, False, USE_DB)
+            search_args, False, USE_DB, offset, num_articles_to_return, record_popularity=True)
         return_dict['succeeded'] = succeeded
         return_dict['errors'] = errors
         if succeeded:
-            return_dict['results']['num_results'] = 2
+            return_dict['results']['num_results'] = 3
             return_dict['results']['values'] = {'num_articles': results.get('totalResults'),
-                                                'articles': results.get('articles')[:num_articles_to_return]}
+                                                'offset': offset,
+                                                'articles': results.get('articles')}
             return json.dumps(return_dict), 200
         else:
             return_dict['num_results'] = 0
@@ -119,14 +180,15 @@ def get_num_term_occurrences():
     errors = {}
     if len(request.args.get('q', '')) > 0:
         succeeded, results, errors = tools.retrieve_news_search(
-            request.args, True, USE_DB)
+            request.args, True, USE_DB, shard_by_date=SHARD_LARGE_SEARCHES,
+            article_projection=tools.COUNTED_ARTICLE_PROJECTION, record_popularity=True)
         return_dict['succeeded'] = succeeded
         return_dict['errors'] = errors
         if succeeded:
             urls = [article.get('url') for article in results.get('articles')]
-            num_occurrences = tools.num_occurrences_on_pages(USE_DB, request.args.get('q'), urls)
+            occurrences = tools.num_occurrences_on_pages(USE_DB, request.args.get('q'), urls)
             return_dict['results']['num_results'] = 1
-            return_dict['results']['values'] = {'num_occurrences': num_occurrences,
+            return_dict['results']['values'] = {**occurrences,
                                                 'num_articles': results.get('totalResults', -1)}
             return json.dumps(return_dict), 200
         else:
@@ -141,6 +203,200 @@ def get_num_term_occurrences():
     return json.dumps(return_dict), 400
 
 
+# Return the total number of times each term appears on all webpages for its news search, with the same filters for all terms.
+# Each page is only retrieved once, even if it's in more than one of the terms' searches.
+# Expects the same args as /internal/get-articles, except that 'q' can be given more than once (once for each term).
+@app.route('/internal/get-num-terms-occurrences')
+def get_num_terms_occurrences():
+    return_dict = tools.get_template_response_dict(
+        url=request.base_url, args=request.args)
+    errors = {}
+    terms = [term for term in request.args.getlist('q') if len(term) > 0]
+    if len(terms) > 0:
+        filters = {k: v for k, v in request.args.to_dict().items() if k != 'q'}
+        succeeded, results, errors = tools.num_occurrences_of_terms(USE_DB, filters, terms, SHARD_LARGE_SEARCHES)
+        return_dict['succeeded'] = succeeded
+        return_dict['errors'] = errors
+        if succeeded:
+            return_dict['results']['num_results'] = len(results)
+            return_dict['results']['values'] = results
+            return json.dumps(return_dict), 200
+        else:
+            return_dict['results']['num_results'] = 0
+            return_dict['errors']['error_source'] = errors.get('error_source', 'internal')
+            return_dict['errors']['message'] = errors.get('message', 'error retrieving num terms occurrences')
+            return json.dumps(return_dict), 500
+
+    return_dict['results']['num_results'] = 0
+    return_dict['errors']['error_source'] = errors.get('error_source', 'internal')
+    return_dict['errors']['message'] = errors.get('message', 'invalid input: missing parameter \'q\'')
+    return json.dumps(return_dict), 400
+
+
+# Return the trend of the term over the search's dates, as the number of articles and the number of times the term appears
+# on them in each interval (see tools.retrieve_term_trend). Only the counts already stored are used, so no pages are
+# retrieved (each interval has the number of its articles that were counted, e.g. by /internal/get-num-term-occurrences).
+# Expects the same args as /internal/get-articles, plus an optional 'interval' ('day' (default) or 'hour').
+@app.route('/internal/get-term-trend')
+def get_term_trend():
+    return_dict = tools.get_template_response_dict(
+        url=request.base_url, args=request.args)
+    errors = {}
+
+    filters = request.args.to_dict()
+    interval = filters.pop('interval', 'day')
+    if interval not in tools.TERM_TREND_INTERVALS:
+        return_dict['errors']['error_source'] = 'internal'
+        return_dict['errors']['message'] = 'invalid input: \'interval\' must be one of: ' + ', '.join(tools.TERM_TREND_INTERVALS)
+        return json.dumps(return_dict), 400
+    if not USE_DB:
+        return_dict['errors']['error_source'] = 'internal'
+        return_dict['errors']['message'] = 'term trends are only available when the db is used'
+        return json.dumps(return_dict), 500
+
+    if len(request.args.get('q', '')) > 0:
+        succeeded, results, errors = tools.retrieve_term_trend(filters, interval, SHARD_LARGE_SEARCHES)
+        return_dict['succeeded'] = succeeded
+        return_dict['errors'] = errors
+        if succeeded:
+            return_dict['results']['num_results'] = len(results.get('points'))
+            return_dict['results']['values'] = results
+            return json.dumps(return_dict), 200
+        else:
+            return_dict['results']['num_results'] = 0
+            return_dict['errors']['error_source'] = errors.get('error_source', 'internal')
+            return_dict['errors']['message'] = errors.get('message', 'error retrieving term trend')
+            return json.dumps(return_dict), 500
+
+    return_dict['results']['num_results'] = 0
+    return_dict['errors']['error_source'] = errors.get('error_source', 'internal')
+    return_dict['errors']['message'] = errors.get('message', 'invalid input: missing parameter \'q\'')
+    return json.dumps(return_dict), 400
+
+
+# Return the total number of times the term appears on the stored pages of the articles published between the 'from' and
+# 'to' dates, and the number of pages it appears on, using only the term index (see tools.num_occurrences_in_index).
+# Unlike /internal/get-num-term-occurrences, no news search is made and no pages are retrieved, so only the pages that
+# were already retrieved (for any search) and indexed are included.
+# Expects 'q', and optionally the 'from' and 'to' dates (as for /internal/get-articles), and 'match' ('exact' (default),
+# 'prefix' or 'substring'), which is how the term's words are matched (see db.retrieve_indexed_word_counts). Only
+# 'substring' counts the same occurrences as /internal/get-num-term-occurrences (e.g. 'apple' in 'pineapples'), but it's
+# also the slowest, since it can't use the index's bounds.
+@app.route('/internal/get-indexed-term-occurrences')
+def get_indexed_term_occurrences():
+    return_dict = tools.get_template_response_dict(
+        url=request.base_url, args=request.args)
+    match = request.args.get('match', 'exact')
+    if match not in tools.TERM_INDEX_MATCH_MODES:
+        return_dict['errors']['error_source'] = 'internal'
+        return_dict['errors']['message'] = 'invalid input: \'match\' must be one of: ' + ', '.join(tools.TERM_INDEX_MATCH_MODES)
+        return json.dumps(return_dict), 400
+    if not USE_DB:
+        return_dict['errors']['error_source'] = 'internal'
+        return_dict['errors']['message'] = 'indexed term occurrences are only available when the db is used'
+        return json.dumps(return_dict), 500
+
+    if len(request.args.get('q', '')) > 0:
+        dates = tools.update_news_search_date_args({k: v for k, v in request.args.items() if k in ['from', 'to']})
+        occurrences = tools.num_occurrences_in_index(request.args.get('q'), datetime.fromisoformat(dates['from']),
+                                                     datetime.fromisoformat(dates['to']), match)
+        if occurrences is not None:
+            return_dict['succeeded'] = True
+            return_dict['results']['num_results'] = 1
+            return_dict['results']['values'] = {**occurrences, 'from': dates['from'], 'to': dates['to']}
+            return json.dumps(return_dict), 200
+        return_dict['results']['num_results'] = 0
+        return_dict['errors']['error_source'] = 'internal'
+        return_dict['errors']['message'] = 'invalid input: \'q\' must contain at least one word'
+        return json.dumps(return_dict), 400
+
+    return_dict['results']['num_results'] = 0
+    return_dict['errors']['error_source'] = 'internal'
+    return_dict['errors']['message'] = 'invalid input: missing parameter \'q\''
+    return json.dumps(return_dict), 400
+
+
+# Start counting the total number of times each term appears on all webpages for its news search in the background, and
+# return the job's id. The job's progress and its result can then be retrieved with /internal/get-job or
+# /internal/stream-job. The job's result is the same as the values returned by /internal/get-num-terms-occurrences.
+# Expects the same args as /internal/get-num-terms-occurrences.
+@app.route('/internal/submit-num-terms-occurrences', methods=['POST'])
+def submit_num_terms_occurrences():
+    return_dict = tools.get_template_response_dict(
+        url=request.base_url, args=request.args)
+    terms = [term for term in request.args.getlist('q') if len(term) > 0]
+    if len(terms) > 0:
+        filters = {k: v for k, v in request.args.to_dict().items() if k != 'q'}
+        job_id = jobs.submit_job(lambda on_progress: tools.num_occurrences_of_terms(
+            USE_DB, filters, terms, SHARD_LARGE_SEARCHES, on_progress), USE_DB)
+        return_dict['succeeded'] = True
+        return_dict['results']['num_results'] = 1
+        return_dict['results']['values'] = {'job_id': job_id}
+        return json.dumps(return_dict), 202
+
+    return_dict['results']['num_results'] = 0
+    return_dict['errors']['error_source'] = 'internal'
+    return_dict['errors']['message'] = 'invalid input: missing parameter \'q\''
+    return json.dumps(return_dict), 400
+
+
+# Return a background job's status, progress, estimated time left and result (once it's done).
+# Expects:
+#   'job_id' (required)
+@app.route('/internal/get-job')
+def get_job():
+    return_dict = tools.get_template_response_dict(
+        url=request.base_url, args=request.args)
+    job = jobs.get_job(request.args.get('job_id', ''), USE_DB)
+    if job is not None:
+        return_dict['succeeded'] = True
+        return_dict['results']['num_results'] = 1
+        return_dict['results']['values'] = job
+        return json.dumps(return_dict), 200
+
+    return_dict['results']['num_results'] = 0
+    return_dict['errors']['error_source'] = 'internal'
+    return_dict['errors']['message'] = 'invalid input: no job with the given \'job_id\''
+    return json.dumps(return_dict), 404
+
+
+# Stream a background job's state (the same values as /internal/get-job) as Server-Sent Events, each time it changes,
+# until the job is done.
+# Each stream holds on to a worker for as long as the job runs, so this should only be used when the server runs with
+# async or threaded workers (e.g. gunicorn's gevent or gthread worker classes). Otherwise, /internal/get-job should be
+# polled instead (which is what the UI does by default).
+# Expects:
+#   'job_id' (required)
+@app.route('/internal/stream-job')
+def stream_job():
+    job_id = request.args.get('job_id', '')
+    job = jobs.get_job(job_id, USE_DB)
+    if job is None:
+        return '404 error', 404
+
+    def generate_events():
+        current_job = job
+        yield 'data: ' + json.dumps(current_job) + '\n\n'
+        while current_job.get('status') not in ['succeeded', 'failed']:
+            updated_job = jobs.wait_for_job_update(job_id, current_job.get('version'), JOB_STREAM_KEEPALIVE_SEC, USE_DB)
+            if updated_job is None:  # (the job was removed)
+                return
+            if updated_job.get('version') == current_job.get('version'):
+                yield ': keepalive\n\n'
+                continue
+            current_job = updated_job
+            yield 'data: ' + json.dumps(current_job) + '\n\n'
+
+    return Response(stream_with_context(generate_events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+# Return the totals of where time was spent across all requests (see the metrics module), in Prometheus' text format.
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.get_prometheus_text(), mimetype='text/plain; version=0.0.4')
+
+
 # Source: https://github.com/BeeFriedman/FluxNodeUptimeMonitor/blob/da0f425b5bf64efa62e4d7c05ec1b16df0282dc5/app.py#LL40C6-L40C6
 @app.errorhandler(Exception)
 def handle_exception(e):
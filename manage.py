@@ -0,0 +1,84 @@
+import argparse
+import db
+import tools
+
+##########################################################
+#     Maintenance commands for the app's stored data     #
+##########################################################
+
+# Run with: python manage.py <command> [options]
+# Each command is a function below that takes the parsed arguments, and is added to the parser in create_parser.
+
+
+# Add the stored page texts that aren't in the term index yet to the index (see tools.index_stored_page_texts), e.g.
+# after upgrading from a version without the index. With --rebuild, the index is first cleared and all the page texts are
+# indexed again (see db.clear_term_index), e.g. after upgrading from a version that stored the index differently.
+def index_page_texts(arguments: argparse.Namespace):
+    if arguments.rebuild:
+        db.clear_term_index()
+    num_indexed = tools.index_stored_page_texts(arguments.batch_size)
+    print('Indexed %d page texts' % num_indexed)
+
+
+# Move the term counts stored in the articles to their own collection (see db.migrate_term_counts), for upgrading from a
+# version that stored them in the articles.
+def migrate_term_counts(arguments: argparse.Namespace):
+    num_migrated = db.migrate_term_counts(arguments.batch_size)
+    print('Migrated the term counts of %d articles' % num_migrated)
+
+
+# Give any stored news searches without an expiry one, evict unreferenced articles if the articles are over their budget,
+# and then compact the collections, reporting how much space was reclaimed in each.
+def compact(arguments: argparse.Namespace):
+    print('Set the expiry of %d stored news searches' % db.set_missing_news_search_expiries())
+    print('Evicted %d unreferenced articles' % db.evict_unreferenced_articles(arguments.articles_max_bytes))
+
+    results = db.compact_collections()
+    print(f'{"collection":<20} {"before MB":>10} {"after MB":>10} {"reclaimed MB":>13}')
+    for collection_name, result in results.items():
+        reclaimed = result['bytesBefore'] - result['bytesAfter']
+        print(f'{collection_name:<20} {result["bytesBefore"] / 2 ** 20:>10.1f} {result["bytesAfter"] / 2 ** 20:>10.1f} '
+              f'{reclaimed / 2 ** 20:>13.1f}' + (' (not compacted: %s)' % result['error'] if result['error'] else ''))
+    total_reclaimed = sum(result['bytesBefore'] - result['bytesAfter'] for result in results.values())
+    print('Reclaimed %.1f MB in total' % (total_reclaimed / 2 ** 20))
+
+
+# Remove the duplicate entries that keep the unique indexes from being created (see db.remove_duplicate_entries), e.g.
+# articles that were stored more than once by concurrent writes before the index existed, and then create the indexes.
+def dedupe(arguments: argparse.Namespace):
+    for collection_name, num_removed in db.remove_duplicate_entries(arguments.batch_size).items():
+        print('Removed %d duplicate entries from %s' % (num_removed, collection_name))
+    failed_indexes = db.ensure_indexes()
+    if len(failed_indexes) > 0:
+        print('Could not create the indexes: %s' % ', '.join(failed_indexes))
+    else:
+        print('Created all the indexes')
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Maintenance commands for the app\'s stored data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index-page-texts', help='add the stored page texts to the term index')
+    index_parser.add_argument('--batch-size', type=int, default=100, help='number of page texts to index at once')
+    index_parser.add_argument('--rebuild', action='store_true', help='clear the index and index all the page texts again')
+    index_parser.set_defaults(func=index_page_texts)
+
+    migrate_parser = subparsers.add_parser('migrate-term-counts', help='move the articles\' term counts to their own collection')
+    migrate_parser.add_argument('--batch-size', type=int, default=100, help='number of articles to migrate at once')
+    migrate_parser.set_defaults(func=migrate_term_counts)
+
+    compact_parser = subparsers.add_parser('compact', help='remove expired and unreferenced data, and compact the db')
+    compact_parser.add_argument('--articles-max-bytes', type=int, default=None,
+                                help='max total size of the articles (defaults to db.ARTICLES_MAX_BYTES)')
+    compact_parser.set_defaults(func=compact)
+
+    dedupe_parser = subparsers.add_parser('dedupe', help='remove duplicate entries and create the unique indexes')
+    dedupe_parser.add_argument('--batch-size', type=int, default=1000, help='number of entries to remove at once')
+    dedupe_parser.set_defaults(func=dedupe)
+    return parser
+
+
+if __name__ == '__main__':
+    arguments = create_parser().parse_args()
+    arguments.func(arguments)
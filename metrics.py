@@ -0,0 +1,195 @@
+from contextlib import contextmanager
+import contextvars
+import functools
+import threading
+import time
+
+#######################################################################################
+#     This module defines the timing and counters used to see where time is spent     #
+#######################################################################################
+
+# Metrics are kept in-process and exposed in Prometheus' text format (see get_prometheus_text). Each metric has a name
+# (e.g. 'stage_duration_seconds') and optional labels (e.g. {'stage': 'db.retrieve_news_search'}).
+METRIC_NAME_PREFIX = 'newstrends_'
+# The upper bounds (in seconds) of the histograms' buckets.
+HISTOGRAM_BUCKETS_SEC = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# name -> (type, description), for every metric that may be recorded
+METRICS = {
+    'stage_duration_seconds': ('histogram', 'Time spent in each stage of handling requests.'),
+    'cache_lookups_total': ('counter', 'Number of lookups in each cache, by whether they were found (hit) or not (miss).'),
+    'newsapi_requests_total': ('counter', 'Number of requests made to the news api, by endpoint, status code and priority.'),
+    'newsapi_requests_rejected_total': ('counter', 'Number of requests to the news api that weren\'t made for lack of quota.'),
+    'newsapi_quota_remaining': ('gauge', 'Number of requests left in the news api\'s quota, as last reported by the api.'),
+    'page_retrievals_total': ('counter', 'Number of article pages retrieved, by result.')
+}
+
+lock = threading.Lock()
+counters = {}  # (name, labels) -> value
+gauges = {}  # (name, labels) -> value
+histograms = {}  # (name, labels) -> [count in each bucket (not cumulative, the last is for values past all buckets), sum]
+
+# The breakdown of the current request, if it's being logged (see start_request_log).
+request_log_var = contextvars.ContextVar('request_log', default=None)
+
+
+# The breakdown of where a single request's time was spent. entries is a list of dicts, one for each stage and cache
+# used by the request, which are updated in place as the request goes on (so it can be put in the response up front).
+class RequestLog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []
+        self.entries_by_key = {}
+
+    def get_entry(self, key: tuple, default_entry: dict) -> dict:
+        entry = self.entries_by_key.get(key)
+        if entry is None:
+            entry = self.entries_by_key[key] = default_entry
+            self.entries.append(entry)
+        return entry
+
+    def add_stage_time(self, stage: str, elapsed_sec: float):
+        with self.lock:
+            entry = self.get_entry(('stage', stage), {'stage': stage, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            entry['count'] += 1
+            entry['total_ms'] = round(entry['total_ms'] + elapsed_sec * 1000, 3)
+            entry['max_ms'] = round(max(entry['max_ms'], elapsed_sec * 1000), 3)
+
+    def add_cache_lookups(self, cache: str, num_hits: int, num_misses: int):
+        with self.lock:
+            entry = self.get_entry(('cache', cache), {'cache': cache, 'hits': 0, 'misses': 0})
+            entry['hits'] += num_hits
+            entry['misses'] += num_misses
+
+
+# Start logging the breakdown of the current request (in the current thread, and in any functions wrapped with
+# with_request_log, e.g. for the threads that retrieve pages). Returns the log's entries.
+def start_request_log() -> list:
+    request_log = RequestLog()
+    request_log_var.set(request_log)
+    return request_log.entries
+
+
+def stop_request_log():
+    request_log_var.set(None)
+
+
+# Return the entries of the current request's log, or an empty list if it isn't being logged.
+def get_request_log() -> list:
+    request_log = request_log_var.get()
+    return request_log.entries if request_log is not None else []
+
+
+# Return func wrapped so that it logs to the current request's log (if any) even when it's called from another thread,
+# e.g. by a ThreadPoolExecutor. (Must be called from the request's thread)
+# All the other context variables of the current context are carried over too (e.g. the priority of news api requests).
+def with_request_log(func):
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def func_with_request_log(*args, **kwargs):
+        # (A context can't be used by more than one thread at once, so each call runs in its own copy)
+        return context.copy().run(func, *args, **kwargs)
+    return func_with_request_log
+
+
+def get_key(name: str, labels: dict = None) -> tuple:
+    return name, tuple(sorted(labels.items())) if labels is not None else ()
+
+
+def increment_counter(name: str, labels: dict = None, amount: float = 1):
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def set_gauge(name: str, value: float, labels: dict = None):
+    with lock:
+        gauges[get_key(name, labels)] = value
+
+
+def observe(name: str, value: float, labels: dict = None):
+    key = get_key(name, labels)
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [[0] * (len(HISTOGRAM_BUCKETS_SEC) + 1), 0.0]
+        bucket_index = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS_SEC) if value <= bound), len(HISTOGRAM_BUCKETS_SEC))
+        histogram[0][bucket_index] += 1
+        histogram[1] += value
+
+
+# Record the time spent in the stage, both in the stage's histogram and in the current request's log (if any).
+def record_stage_time(stage: str, elapsed_sec: float):
+    observe('stage_duration_seconds', elapsed_sec, {'stage': stage})
+    request_log = request_log_var.get()
+    if request_log is not None:
+        request_log.add_stage_time(stage, elapsed_sec)
+
+
+# Time the code in the with block as the given stage (see record_stage_time).
+@contextmanager
+def time_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage_time(stage, time.perf_counter() - start)
+
+
+# Decorator that times each call of the function as the given stage (see record_stage_time).
+def timed(stage: str):
+    def decorator(func):
+        @functools.wraps(func)
+        def timed_func(*args, **kwargs):
+            with time_stage(stage):
+                return func(*args, **kwargs)
+        return timed_func
+    return decorator
+
+
+# Record the number of lookups in the cache that were found (hits) and that weren't (misses), both in the cache's counters
+# and in the current request's log (if any).
+def record_cache_lookups(cache: str, num_hits: int, num_misses: int):
+    if num_hits > 0:
+        increment_counter('cache_lookups_total', {'cache': cache, 'result': 'hit'}, num_hits)
+    if num_misses > 0:
+        increment_counter('cache_lookups_total', {'cache': cache, 'result': 'miss'}, num_misses)
+    request_log = request_log_var.get()
+    if request_log is not None:
+        request_log.add_cache_lookups(cache, num_hits, num_misses)
+
+
+def format_labels(labels: tuple, extra_labels: tuple = ()) -> str:
+    all_labels = labels + extra_labels
+    if len(all_labels) == 0:
+        return ''
+    escaped = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in all_labels]
+    return '{' + ','.join(escaped) + '}'
+
+
+# Return all the metrics in Prometheus' text exposition format.
+def get_prometheus_text() -> str:
+    with lock:
+        values_by_name = {}
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            values_by_name.setdefault(name, []).append((labels, value))
+        histograms_by_name = {}
+        for (name, labels), (bucket_counts, total) in histograms.items():
+            histograms_by_name.setdefault(name, []).append((labels, list(bucket_counts), total))
+
+    lines = []
+    for name, (metric_type, description) in METRICS.items():
+        full_name = METRIC_NAME_PREFIX + name
+        lines.append('# HELP %s %s' % (full_name, description))
+        lines.append('# TYPE %s %s' % (full_name, metric_type))
+        for labels, value in sorted(values_by_name.get(name, [])):
+            lines.append('%s%s %s' % (full_name, format_labels(labels), value))
+        for labels, bucket_counts, total in sorted(histograms_by_name.get(name, []), key=lambda histogram: histogram[0]):
+            cumulative_count = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS_SEC + ['+Inf'], bucket_counts):
+                cumulative_count += count
+                lines.append('%s_bucket%s %d' % (full_name, format_labels(labels, (('le', bound),)), cumulative_count))
+            lines.append('%s_sum%s %s' % (full_name, format_labels(labels), round(total, 6)))
+            lines.append('%s_count%s %d' % (full_name, format_labels(labels), cumulative_count))
+    return '\n'.join(lines) + '\n'
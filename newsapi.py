@@ -1,6 +1,11 @@
+from contextlib import contextmanager
+import contextvars
 import json
-import requests
+import os
 from requests import Response
+import metrics
+import ratelimit
+import sessions
 
 ##############################################################################
 #     This module defines functions for using the news api (newsapi.org)     #
@@ -8,12 +13,85 @@ from requests import Response
 
 USE_API = True
 BASE_URL = 'https://newsapi.org'
-api_key_file = open(r"tokens/newsapiorg_apikey.txt", "r")
-API_KEY = api_key_file.readline()
+# The api key is only read when the api is first used (see get_headers), so importing this module doesn't need it.
+API_KEY_FILE = os.environ.get('NEWSAPI_KEY_FILE', r"tokens/newsapiorg_apikey.txt")
+headers = None
 
-headers = {
-    'Authorization': API_KEY if USE_API else ""
-}
+# Timeout for each request to the api (used for both connecting and reading).
+# These settings can be overridden with an environment variable of the same name prefixed with 'NEWSAPI_'.
+TIMEOUT_SEC = float(os.environ.get('NEWSAPI_TIMEOUT_SEC', 15))
+# Max number of connections to the api that may be open at once, and how failed requests are retried (see sessions).
+MAX_CONNECTIONS = int(os.environ.get('NEWSAPI_MAX_CONNECTIONS', 10))
+MAX_RETRIES = int(os.environ.get('NEWSAPI_MAX_RETRIES', 3))
+RETRY_BACKOFF_SEC = float(os.environ.get('NEWSAPI_RETRY_BACKOFF_SEC', 0.5))
+
+# The response header with the number of requests left in the api's quota (if the api sends it).
+QUOTA_REMAINING_HEADER = 'X-RateLimit-Remaining'
+
+# Requests are scheduled to stay within the api's quota (see ratelimit.QuotaScheduler): up to QUOTA_PER_DAY requests a
+# day (0 for no limit), in bursts of up to QUOTA_BURST requests. Background requests (see priority) are only made while
+# QUOTA_BACKGROUND_RESERVE requests are left over for interactive ones, and don't wait for quota, while interactive
+# requests wait up to MAX_QUOTA_WAIT_SEC. Once the api reports that the quota is used up, no requests are made for
+# QUOTA_PAUSE_SEC. These settings can also be overridden with environment variables (prefixed with 'NEWSAPI_'), and are
+# per process, so when running several worker processes, the quota should be split between them.
+QUOTA_PER_DAY = int(os.environ.get('NEWSAPI_QUOTA_PER_DAY', 100))
+QUOTA_BURST = int(os.environ.get('NEWSAPI_QUOTA_BURST', 25))
+QUOTA_BACKGROUND_RESERVE = int(os.environ.get('NEWSAPI_QUOTA_BACKGROUND_RESERVE', 10))
+MAX_QUOTA_WAIT_SEC = float(os.environ.get('NEWSAPI_MAX_QUOTA_WAIT_SEC', 10))
+QUOTA_PAUSE_SEC = float(os.environ.get('NEWSAPI_QUOTA_PAUSE_SEC', 60 * 60))
+
+# The priorities of requests, lowest first. Requests are made with the priority of the current context (see priority).
+INTERACTIVE_PRIORITY = 0
+BACKGROUND_PRIORITY = 1
+priority_var = contextvars.ContextVar('newsapi_priority', default=INTERACTIVE_PRIORITY)
+
+# Shared session for all requests to the api, so that connections are reused. (Creating it doesn't connect)
+session = sessions.create_session(MAX_CONNECTIONS, 1, MAX_RETRIES, RETRY_BACKOFF_SEC)
+
+
+# Return the scheduler for the requests to the api, or None if they aren't limited (see QUOTA_PER_DAY).
+def create_scheduler() -> ratelimit.QuotaScheduler | None:
+    if QUOTA_PER_DAY <= 0:
+        return None
+    return ratelimit.QuotaScheduler(QUOTA_BURST, QUOTA_PER_DAY / (24 * 60 * 60), BACKGROUND_PRIORITY,
+                                    QUOTA_BACKGROUND_RESERVE, QUOTA_PAUSE_SEC)
+
+
+scheduler = create_scheduler()
+
+
+# Return the headers sent with every request to the api, reading the api key on first use.
+def get_headers() -> dict:
+    global headers
+    if headers is None:
+        with open(API_KEY_FILE, "r") as api_key_file:
+            api_key = api_key_file.readline().strip()
+        headers = {
+            'Authorization': api_key if USE_API else ""
+        }
+    return headers
+
+
+# Give a forked child process its own session, since connections can't be shared with the parent process. (It also gets
+# its own scheduler, since the parent's may be locked by one of its threads)
+def reset_after_fork():
+    global session, scheduler
+    session = sessions.create_session(MAX_CONNECTIONS, 1, MAX_RETRIES, RETRY_BACKOFF_SEC)
+    scheduler = create_scheduler()
+
+
+# Make the api requests within the with block with the given priority, e.g. BACKGROUND_PRIORITY for work that no one is
+# waiting on. (The priority is carried over to functions wrapped with metrics.with_request_log, e.g. for other threads)
+@contextmanager
+def priority(value: int):
+    token = priority_var.set(value)
+    try:
+        yield
+    finally:
+        priority_var.reset(token)
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
 
 ################################################
 #     Simple wrappers of newsapi.org's API     #
@@ -22,15 +100,55 @@ headers = {
 
 # Get all news sources. All parameters are optional and can be used as filters, but not required.
 def get_sources(**params) -> Response:
-    endpoint = '/v2/top-headlines/sources'
-    url = BASE_URL + endpoint
-    result = requests.get(url, headers=headers, params=params)
-    return result
+    return make_request('/v2/top-headlines/sources', params, 'newsapi.get_sources')
 
 
 # Return all news articles for the given filters. Using the 'everything' endpoint.
 def get_articles(params) -> Response:
-    endpoint = '/v2/everything'
-    url = BASE_URL + endpoint
-    result = requests.get(url, headers=headers, params=params)
-    return result
\ No newline at end of file
+    return make_request('/v2/everything', params, 'newsapi.get_articles')
+
+
+# Make a request to the endpoint (timed as the given stage) once the scheduler allows it, with the current priority.
+# If it isn't allowed in time (see MAX_QUOTA_WAIT_SEC), then the request isn't made, and a response like the api's own
+# for a used up quota is returned instead (see create_rate_limited_response).
+def make_request(endpoint: str, params: dict, stage: str) -> Response:
+    request_priority = priority_var.get()
+    priority_name = 'background' if request_priority >= BACKGROUND_PRIORITY else 'interactive'
+    if scheduler is not None:
+        max_wait_sec = MAX_QUOTA_WAIT_SEC if request_priority < BACKGROUND_PRIORITY else 0
+        with metrics.time_stage('newsapi.wait_for_quota'):
+            allowed = scheduler.acquire(request_priority, max_wait_sec)
+        if not allowed:
+            metrics.increment_counter('newsapi_requests_rejected_total', {'endpoint': endpoint, 'priority': priority_name})
+            return create_rate_limited_response()
+
+    with metrics.time_stage(stage):
+        result = session.get(BASE_URL + endpoint, headers=get_headers(), params=params, timeout=TIMEOUT_SEC)
+    record_response_metrics(endpoint, result, priority_name)
+    if scheduler is not None:
+        quota_remaining = result.headers.get(QUOTA_REMAINING_HEADER)
+        scheduler.record_quota(int(quota_remaining) if quota_remaining is not None and quota_remaining.isdigit() else None,
+                               result.status_code == 429)
+    return result
+
+
+# Return a response like the api's when its quota is used up, for a request that wasn't made for lack of quota.
+def create_rate_limited_response() -> Response:
+    response = Response()
+    response.status_code = 429
+    response.headers['Content-Type'] = 'application/json'
+    response._content = json.dumps({
+        'status': 'error',
+        'code': 'rateLimited',
+        'message': 'The request was not made, since there is not enough of the news api\'s quota left. Try again later.'
+    }).encode()
+    return response
+
+
+# Count the request (each of which uses up some of the api's quota), and record the quota left if the api reported it.
+def record_response_metrics(endpoint: str, response: Response, priority_name: str):
+    metrics.increment_counter('newsapi_requests_total',
+                              {'endpoint': endpoint, 'status': response.status_code, 'priority': priority_name})
+    quota_remaining = response.headers.get(QUOTA_REMAINING_HEADER)
+    if quota_remaining is not None and quota_remaining.isdigit():
+        metrics.set_gauge('newsapi_quota_remaining', int(quota_remaining))
\ No newline at end of file
@@ -0,0 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from urllib.parse import urlparse
+import os
+import threading
+import time
+import metrics
+import sessions
+
+#######################################################################################
+#     This module defines the engine used for fetching article pages concurrently     #
+#######################################################################################
+
+# Total number of pages that may be in-flight at once, across all domains.
+MAX_WORKERS = 20
+# Max number of pages from the same domain that may be in-flight at once, so that we don't hammer a single site.
+MAX_REQUESTS_PER_DOMAIN = 4
+# Timeout for each individual page request (used for both connecting and reading).
+REQUEST_TIMEOUT_SEC = 10
+# Max total time to spend on a batch of pages. Pages that aren't done by then are considered failed.
+OVERALL_DEADLINE_SEC = 90
+# Max number of bytes of a page that are read. Anything past this is ignored (article text is near the start of the page).
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+# Size of the chunks a page is read in.
+PAGE_CHUNK_BYTES = 64 * 1024
+# Max number of different sites whose connections are kept open for reuse, how failed requests are retried, and how long a
+# request waits for a free connection to its site (see sessions).
+MAX_HOSTS = 100
+MAX_RETRIES = 1
+RETRY_BACKOFF_SEC = 0.5
+POOL_TIMEOUT_SEC = 30
+
+# Shared session for all requests to article pages, so that connections to the same site are reused. (It also limits the
+# number of connections to the same site to MAX_REQUESTS_PER_DOMAIN)
+session = sessions.create_session(MAX_REQUESTS_PER_DOMAIN, MAX_HOSTS, MAX_RETRIES, RETRY_BACKOFF_SEC, POOL_TIMEOUT_SEC)
+
+
+# Give a forked child process its own session, since connections can't be shared with the parent process.
+def reset_after_fork():
+    global session
+    session = sessions.create_session(MAX_REQUESTS_PER_DOMAIN, MAX_HOSTS, MAX_RETRIES, RETRY_BACKOFF_SEC, POOL_TIMEOUT_SEC)
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+# Circuit breaker settings: once a domain has had at least CIRCUIT_BREAKER_MIN_REQUESTS requests in the last
+# CIRCUIT_BREAKER_WINDOW_SEC seconds and at least CIRCUIT_BREAKER_FAILURE_RATE of them failed, its pages are skipped for
+# CIRCUIT_BREAKER_COOLDOWN_SEC seconds. After that a single request is let through to test the domain again.
+CIRCUIT_BREAKER_WINDOW_SEC = 300
+CIRCUIT_BREAKER_MIN_REQUESTS = 5
+CIRCUIT_BREAKER_FAILURE_RATE = 0.5
+CIRCUIT_BREAKER_COOLDOWN_SEC = 600
+
+
+# Keeps track of the recent request results for each domain, to skip domains that are currently failing (e.g. sites
+# that are down, or that block us) instead of waiting on them to fail again. Safe to use from multiple threads.
+class DomainCircuitBreaker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results_by_domain = {}  # domain -> deque of (time, succeeded)
+        self.open_until_by_domain = {}  # domain -> time until which the domain is skipped
+        self.testing_domains = set()  # domains whose cooldown is over, with a test request in-flight
+
+    # Return whether a request to the domain should be made now.
+    def allow_request(self, domain: str) -> bool:
+        with self.lock:
+            open_until = self.open_until_by_domain.get(domain)
+            if open_until is None:
+                return True
+            if time.monotonic() < open_until or domain in self.testing_domains:
+                return False
+            self.testing_domains.add(domain)  # let a single request through to test the domain
+            return True
+
+    # Record the result of a request to the domain.
+    def record_result(self, domain: str, succeeded: bool):
+        now = time.monotonic()
+        with self.lock:
+            if domain in self.testing_domains:
+                self.testing_domains.discard(domain)
+                if succeeded:
+                    self.open_until_by_domain.pop(domain, None)
+                    self.results_by_domain.pop(domain, None)
+                else:
+                    self.open_until_by_domain[domain] = now + CIRCUIT_BREAKER_COOLDOWN_SEC
+                return
+
+            results = self.results_by_domain.setdefault(domain, deque())
+            results.append((now, succeeded))
+            while results[0][0] < now - CIRCUIT_BREAKER_WINDOW_SEC:
+                results.popleft()
+            num_failed = sum(1 for _, result_succeeded in results if not result_succeeded)
+            if len(results) >= CIRCUIT_BREAKER_MIN_REQUESTS and num_failed / len(results) >= CIRCUIT_BREAKER_FAILURE_RATE:
+                self.open_until_by_domain[domain] = now + CIRCUIT_BREAKER_COOLDOWN_SEC
+                results.clear()
+
+    # Forget a request to the domain that has no result, since it never reached the domain (e.g. it timed out waiting for
+    # one of our own connections). If it was the request testing the domain, then another one may test it instead.
+    def cancel_request(self, domain: str):
+        with self.lock:
+            self.testing_domains.discard(domain)
+
+
+circuit_breaker = DomainCircuitBreaker()
+
+
+def get_domain(url: str) -> str:
+    return (urlparse(url).hostname or '').lower()
+
+
+# Run func(url) for each (unique) url concurrently and return a dict of url -> result for every url that completed.
+# Urls that raised an exception or that did not complete before the deadline are not included in the result.
+# At most max_workers calls run at once in total, and at most max_per_domain calls run at once for the same domain.
+def run_for_all_urls(urls: list, func, max_workers: int = None, max_per_domain: int = None,
+                     deadline_sec: float = None) -> dict:
+    if max_workers is None:
+        max_workers = MAX_WORKERS
+    if max_per_domain is None:
+        max_per_domain = MAX_REQUESTS_PER_DOMAIN
+    if deadline_sec is None:
+        deadline_sec = OVERALL_DEADLINE_SEC
+
+    # Group the urls by domain so that we only submit a url once its domain has a free slot.
+    pending_by_domain = {}
+    for url in dict.fromkeys(urls):  # (dict.fromkeys removes duplicates while keeping the order)
+        pending_by_domain.setdefault(get_domain(url), deque()).append(url)
+    in_flight_by_domain = {domain: 0 for domain in pending_by_domain}
+
+    results = {}
+    if not pending_by_domain:
+        return results
+
+    deadline = time.monotonic() + deadline_sec
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {}  # future -> (url, domain)
+    func = metrics.with_request_log(func)
+
+    def submit_available():
+        for domain, pending in pending_by_domain.items():
+            while pending and in_flight_by_domain[domain] < max_per_domain and len(futures) < max_workers:
+                url = pending.popleft()
+                futures[executor.submit(func, url)] = (url, domain)
+                in_flight_by_domain[domain] += 1
+
+    try:
+        submit_available()
+        while futures:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, domain = futures.pop(future)
+                in_flight_by_domain[domain] -= 1
+                try:
+                    results[url] = future.result()
+                except Exception:
+                    pass  # a failed url is simply left out of the results
+            submit_available()
+    finally:
+        # Don't wait on anything still in-flight after the deadline. Those requests are bounded by their own timeout.
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results
+
+
+# Return the content of a streamed response (i.e. requested with stream=True) chunk by chunk, stopping once max_bytes
+# have been read. The response is closed once it's done, or once the generator is closed (e.g. if the caller fails part
+# way through). (The caller must still close the response if it never starts iterating)
+def iter_page_content(response, max_bytes: int = None):
+    if max_bytes is None:
+        max_bytes = MAX_PAGE_BYTES
+    num_bytes = 0
+    try:
+        for chunk in response.iter_content(chunk_size=PAGE_CHUNK_BYTES):
+            if num_bytes + len(chunk) >= max_bytes:
+                yield chunk[:max_bytes - num_bytes]
+                break
+            num_bytes += len(chunk)
+            yield chunk
+    finally:
+        response.close()
+
+
+# Return the encoding given in the response's Content-Type header, or None if it doesn't give one.
+def get_response_encoding(response) -> str | None:
+    content_type = response.headers.get('Content-Type', '')
+    for param in content_type.split(';')[1:]:
+        name, _, value = param.strip().partition('=')
+        if name.lower() == 'charset' and len(value) > 0:
+            return value.strip('"\'')
+    return None
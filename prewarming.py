@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+#############################################################################################
+#     This module defines how popular requests are kept cached ahead of being requested     #
+#############################################################################################
+
+
+# Counts how often each key was requested recently: each count halves every half_life_sec, so that the most popular
+# keys are those requested most often lately. Each key also has a value, e.g. what is needed to make its request again.
+# Past max_size keys, the least popular are removed. Safe to use from multiple threads.
+class PopularityCounter:
+    def __init__(self, max_size: int, half_life_sec: float):
+        self.max_size = max_size
+        self.half_life_sec = half_life_sec
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> [count, when it was counted (a time.monotonic() value), value]
+
+    def get_count(self, entry: list, now: float) -> float:
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life_sec)
+
+    def record(self, key, value):
+        with self.lock:
+            now = time.monotonic()
+            entry = self.entries.get(key)
+            self.entries[key] = [(self.get_count(entry, now) if entry is not None else 0) + 1, now, value]
+            if len(self.entries) > self.max_size:
+                least_popular_key = min(self.entries, key=lambda k: self.get_count(self.entries[k], now))
+                del self.entries[least_popular_key]
+
+    # Return the values of the num_keys most popular keys, most popular first.
+    def get_most_popular(self, num_keys: int) -> list:
+        with self.lock:
+            now = time.monotonic()
+            entries = sorted(self.entries.values(), key=lambda entry: self.get_count(entry, now), reverse=True)
+            return [entry[2] for entry in entries[:num_keys]]
+
+
+# The background thread that runs the pre-warming function (see start_prewarmer), if it was started in this process.
+prewarmer_thread = None
+prewarmer_thread_lock = threading.Lock()
+
+
+# Start a background thread that calls func every interval_sec seconds (e.g. to refresh the cache for the most popular
+# requests), if it isn't already running in this process.
+def start_prewarmer(func, interval_sec: float):
+    global prewarmer_thread
+    if prewarmer_thread is not None and prewarmer_thread.is_alive():
+        return
+    with prewarmer_thread_lock:
+        if prewarmer_thread is None or not prewarmer_thread.is_alive():
+            prewarmer_thread = threading.Thread(target=run_prewarmer, args=(func, interval_sec), daemon=True,
+                                                name='prewarmer')
+            prewarmer_thread.start()
+
+
+def run_prewarmer(func, interval_sec: float):
+    while True:
+        time.sleep(interval_sec)
+        try:
+            func()
+        except Exception as e:
+            print('Error pre-warming:', e)
+
+
+# A forked child process doesn't have the parent's thread, so it starts its own (and the lock may have been held).
+def reset_after_fork():
+    global prewarmer_thread, prewarmer_thread_lock
+    prewarmer_thread = None
+    prewarmer_thread_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,106 @@
+import heapq
+import itertools
+import threading
+import time
+
+################################################################################
+#     This module defines how requests to a rate-limited api are scheduled     #
+################################################################################
+
+
+# A bucket of up to capacity tokens, refilled at refill_per_sec tokens per second, that starts full. Each request takes
+# a token, so bursts of up to capacity requests can be made at once, and refill_per_sec requests per second after that.
+# Not safe to use from multiple threads on its own (see QuotaScheduler).
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_sec: float):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = capacity
+        self.refilled_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.refill_per_sec)
+        self.refilled_at = now
+
+    # Return how long until the bucket has the given number of tokens (0 if it already does).
+    def get_wait_sec(self, num_tokens: float, now: float) -> float:
+        self.refill(now)
+        if self.tokens >= num_tokens:
+            return 0
+        return (num_tokens - self.tokens) / self.refill_per_sec
+
+
+# Schedules requests to an api with a quota, so that they stay within a token bucket's rate (see TokenBucket), and so
+# that the requests with the highest priority (the lowest number) are made first when they have to wait for a token.
+# Requests with a priority of background_priority or lower are only made with spare quota: they need background_reserve
+# tokens to be left over, so that a burst of them can't use up the quota that more important requests need.
+# The quota reported by the api is also tracked (see record_quota): the tokens never go over the quota that the api
+# reported as remaining, and once the api reports that the quota is used up, no requests are made until it may have
+# reset (after pause_sec). A reported quota is also forgotten after pause_sec, in case it reset since.
+# Safe to use from multiple threads.
+class QuotaScheduler:
+    def __init__(self, capacity: float, refill_per_sec: float, background_priority: int, background_reserve: float,
+                 pause_sec: float):
+        self.bucket = TokenBucket(capacity, refill_per_sec)
+        self.background_priority = background_priority
+        self.background_reserve = background_reserve
+        self.pause_sec = pause_sec
+        self.condition = threading.Condition()
+        self.waiting = []  # heap of (priority, order) of the requests waiting for a token
+        self.order = itertools.count()
+        self.paused_until = None  # (a time.monotonic() value) when the api reported that the quota was used up
+        self.quota_remaining = None  # as last reported by the api (and counted down since)
+        self.quota_reported_at = None
+
+    # Wait until a request with the given priority may be made (behind any waiting requests with the same or a higher
+    # priority), and take a token for it. Returns False, without taking a token, if that would take over max_wait_sec.
+    def acquire(self, priority: int, max_wait_sec: float) -> bool:
+        deadline = time.monotonic() + max_wait_sec
+        with self.condition:
+            entry = (priority, next(self.order))
+            heapq.heappush(self.waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    # (Only the first waiting request can take a token, the others wait until they're first)
+                    wait_sec = self.get_wait_sec(priority, now) if self.waiting[0] == entry else None
+                    if wait_sec == 0:
+                        self.bucket.tokens -= 1
+                        if self.quota_remaining is not None:
+                            self.quota_remaining -= 1
+                        return True
+                    if wait_sec is not None and now + wait_sec > deadline or now >= deadline:
+                        return False
+                    self.condition.wait(min(wait_sec, deadline - now) if wait_sec is not None else deadline - now)
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    # Return how long until a request with the given priority may take a token (0 if it may now), or None if it's not
+    # known (i.e. the api's remaining quota is too low for it until the api reports otherwise).
+    def get_wait_sec(self, priority: int, now: float) -> float | None:
+        if self.paused_until is not None and now < self.paused_until:
+            return self.paused_until - now
+        if self.quota_reported_at is not None and now - self.quota_reported_at >= self.pause_sec:
+            self.quota_remaining = self.quota_reported_at = None
+        num_tokens = 1 + (self.background_reserve if priority >= self.background_priority else 0)
+        if self.quota_remaining is not None and self.quota_remaining < num_tokens:
+            return None
+        return self.bucket.get_wait_sec(num_tokens, now)
+
+    # Record the quota reported by the api with a response: the number of requests that remain (None if not reported),
+    # and whether the quota is used up (e.g. the api refused the request), in which case no requests are made for
+    # pause_sec seconds.
+    def record_quota(self, quota_remaining: int | None, used_up: bool):
+        with self.condition:
+            now = time.monotonic()
+            if quota_remaining is not None:
+                self.quota_remaining = quota_remaining
+                self.quota_reported_at = now
+                self.bucket.refill(now)
+                self.bucket.tokens = min(self.bucket.tokens, quota_remaining)
+            if used_up or quota_remaining == 0:
+                self.paused_until = now + self.pause_sec
+                self.quota_remaining = self.quota_reported_at = None  # (unknown until the api reports it after the pause)
+            self.condition.notify_all()
@@ -0,0 +1,64 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+#######################################################################
+#     This module defines how the shared HTTP sessions are set up     #
+#######################################################################
+
+# Responses with these status codes are retried (they are usually temporary).
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+# Max time a request waits for a free connection to its host, when all of the host's connections are in use.
+DEFAULT_POOL_TIMEOUT_SEC = 30
+
+
+# Return a connection pool class that waits at most pool_timeout_sec for a free connection (requests doesn't give the
+# pools a timeout, so a request to a host whose connections are all in use would otherwise wait forever), after which
+# the request fails with urllib3's EmptyPoolError.
+def with_pool_timeout(pool_class, pool_timeout_sec: float):
+    class PoolWithTimeout(pool_class):
+        def urlopen(self, *args, pool_timeout=None, **kwargs):
+            if pool_timeout is None:
+                pool_timeout = pool_timeout_sec
+            return super().urlopen(*args, pool_timeout=pool_timeout, **kwargs)
+    return PoolWithTimeout
+
+
+# An HTTPAdapter whose connection pools wait at most pool_timeout_sec for a free connection (see with_pool_timeout).
+class PoolTimeoutHTTPAdapter(HTTPAdapter):
+    def __init__(self, pool_timeout_sec: float, **kwargs):
+        self.pool_timeout_sec = pool_timeout_sec
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': with_pool_timeout(HTTPConnectionPool, self.pool_timeout_sec),
+            'https': with_pool_timeout(HTTPSConnectionPool, self.pool_timeout_sec)
+        }
+
+
+# Return a session that keeps its connections alive and reuses them, for up to max_hosts hosts. At most
+# max_connections_per_host connections are open to the same host at once (any other requests to that host wait up to
+# pool_timeout_sec for a free connection, and then fail). Failed requests (connection errors, or a status in
+# RETRY_STATUS_CODES) are retried up to max_retries times, waiting backoff_factor * (2 ^ retry number) seconds between
+# retries.
+# Responses requested with stream=True hold on to their connection until they're read to the end or closed, so they must
+# always be closed (e.g. in a finally block).
+def create_session(max_connections_per_host: int, max_hosts: int, max_retries: int, backoff_factor: float,
+                   pool_timeout_sec: float = DEFAULT_POOL_TIMEOUT_SEC) -> requests.Session:
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUS_CODES,
+        allowed_methods=['GET'],
+        respect_retry_after_header=True,
+        raise_on_status=False  # return the last response instead of raising once the retries are used up
+    )
+    adapter = PoolTimeoutHTTPAdapter(pool_timeout_sec, pool_connections=max_hosts, pool_maxsize=max_connections_per_host,
+                                     pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
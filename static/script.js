@@ -55,19 +55,107 @@ function getAndDisplayNumOccurencesForTerm(params, termNumber) {
     // This can be a VERY expensive operation because it makes an individual request to every single article url,
     // but this runs asynchronously so the result will load when we get it back. This way, the articles
     // that were just found above will display while this result is calculating
-    let resultNumOccurrencesDiv = $('#result_' + termNumber + '_num_occurrences');
-    resultNumOccurrencesDiv.html('Loading...');
-    $.get('/internal/get-num-term-occurrences', params).done(function (data) {
-        let response = JSON.parse(data);
-        let numOccurrences = response.results.values.num_occurrences;
-        let numArticles = response.results.values.num_articles;
-        resultNumOccurrencesDiv.html('<b>' + numOccurrences + '</b> matches found across all ' + numArticles + ' articles.');
+    let filters = Object.assign({}, params);
+    delete filters['q'];
+    getAndDisplayNumOccurrencesForTerms(filters, [params['q']], [termNumber]);
+}
+
+function getAndDisplayNumOccurrencesForTerms(params, terms, termNumbers) {
+    // Same as getAndDisplayNumOccurencesForTerm, but for all the given terms at once (displayed in the result for each
+    // term's number, which defaults to the terms' order). Each article page is only loaded once by the server, even if
+    // it's in more than one term's articles, so this is faster than getting each term's result separately.
+    // The counting is done as a background job on the server, and the running totals are displayed as it makes progress.
+    let resultNumOccurrencesDivs = terms.map(function (term, i) {
+        return $('#result_' + (termNumbers !== undefined ? termNumbers[i] : i + 1) + '_num_occurrences');
+    });
+    for (let resultNumOccurrencesDiv of resultNumOccurrencesDivs) {
+        resultNumOccurrencesDiv.html('Loading...');
+    }
+    let displayError = function (message) {
+        for (let resultNumOccurrencesDiv of resultNumOccurrencesDivs) {
+            resultNumOccurrencesDiv.html('Error loading the number of occurrences. Please try again later.');
+        }
+        console.log(message);
+    };
+
+    // ('traditional' sends the terms as repeated 'q' params)
+    let query = $.param(Object.assign({}, params, {'q': terms}), true);
+    $.ajax({url: '/internal/submit-num-terms-occurrences?' + query, method: 'POST'}).done(function (data) {
+        let jobId = JSON.parse(data).results.values.job_id;
+        followJob(jobId, function (job) {
+            if (job.status === 'succeeded') {
+                for (let i = 0; i < terms.length; i++) {
+                    let values = job.result[terms[i].toLowerCase()];
+                    resultNumOccurrencesDivs[i].html('<b>' + values.num_occurrences + '</b> matches found across all ' +
+                        values.num_articles + ' articles.' + getUncountedPagesMessage(values));
+                }
+            } else if (job.status === 'failed') {
+                displayError('num terms occurrences job failed:\n' + JSON.stringify(job.errors));
+            } else if (job.progress.num_pages_total !== undefined) {
+                for (let i = 0; i < terms.length; i++) {
+                    resultNumOccurrencesDivs[i].html('Counting... <b>' +
+                        job.progress.num_occurrences[terms[i].toLowerCase()] + '</b> matches found so far (' +
+                        job.progress.num_pages_done + ' of ' + job.progress.num_pages_total + ' article pages done' +
+                        (job.eta_sec !== null ? ', about ' + Math.ceil(job.eta_sec) + ' seconds left' : '') + ').');
+                }
+            }
+        }, displayError);
+    }).fail(function (data) {
+        displayError('/internal/submit-num-terms-occurrences request failed:\n' + data.responseText);
+    })
+}
+
+// Whether to follow the server's background jobs with Server-Sent Events instead of polling. Each stream holds on to one of
+// the server's workers for as long as the job runs, so this should only be enabled when the server runs with async or
+// threaded workers (see /internal/stream-job).
+const USE_JOB_STREAM = false;
+
+function followJob(jobId, onUpdate, onError) {
+    // Call onUpdate with the state of the server's background job each time it changes, until it's done.
+    // Polls the job's state, unless USE_JOB_STREAM is enabled and the browser supports Server-Sent Events.
+    if (USE_JOB_STREAM && window.EventSource !== undefined) {
+        let source = new EventSource('/internal/stream-job?job_id=' + encodeURIComponent(jobId));
+        source.onmessage = function (event) {
+            let job = JSON.parse(event.data);
+            if (job.status === 'succeeded' || job.status === 'failed') {
+                source.close();
+            }
+            onUpdate(job);
+        };
+        source.onerror = function () {
+            if (source.readyState === EventSource.CLOSED) {
+                onError('/internal/stream-job request failed');
+            }
+        };
+        return;
+    }
+
+    const POLL_INTERVAL_MS = 1000;
+    $.get('/internal/get-job', {'job_id': jobId}).done(function (data) {
+        let job = JSON.parse(data).results.values;
+        onUpdate(job);
+        if (job.status !== 'succeeded' && job.status !== 'failed') {
+            setTimeout(function () {
+                followJob(jobId, onUpdate, onError);
+            }, POLL_INTERVAL_MS);
+        }
     }).fail(function (data) {
-        resultNumOccurrencesDiv.html('Error loading the number of occurrences. Please try again later.');
-        console.log('/internal/get-num-term-occurrences request failed:\n' + data.responseText);
+        onError('/internal/get-job request failed:\n' + data.responseText);
     })
 }
 
+function getUncountedPagesMessage(values) {
+    // Return a message with the number of article pages that weren't counted in a num occurrences result, if any.
+    let messages = [];
+    if (values.num_pages_failed > 0) {
+        messages.push(values.num_pages_failed + ' article pages could not be loaded');
+    }
+    if (values.num_pages_skipped > 0) {
+        messages.push(values.num_pages_skipped + ' article pages were skipped because their sites are failing');
+    }
+    return messages.length > 0 ? ' (' + messages.join(', ') + ' and were not counted.)' : '';
+}
+
 function clearTermResults(resultNum) {
     $('#result_' + resultNum + '_num_articles').html('');
     $('#result_' + resultNum + '_num_occurrences').html('');
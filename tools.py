@@ -1,79 +1,585 @@
 from datetime import datetime, timedelta, timezone
-import requests
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import json
+import math
+import os
 import re
+import threading
+import time
+import cache
+import coalescing
 import db
+import extraction
+import metrics
 import newsapi
-from bs4 import BeautifulSoup
+import pages
+import prewarming
 from tldextract import extract
+from urllib3.exceptions import PoolError
 
 
 ###############################################################
 #     This module defines useful tools for use in the app     #
 ###############################################################
 
-def retrieve_news_search(filters: dict, get_all_pages: bool, use_and_update_db: bool) -> tuple[bool, dict, dict]:
+# The number of articles per page of a news search when the 'pageSize' arg isn't given (newsapi's default).
+DEFAULT_PAGE_SIZE = 100
+# Max number of pages of a news search to retrieve at once when retrieving all pages.
+MAX_CONCURRENT_PAGES = 5
+# Max number of results of a single news search that can be retrieved (newsapi's limit).
+MAX_TOTAL_RESULTS = 500
+# When splitting a news search up by date, the max number of times it may be split (so at most 2 ^ depth sub-searches),
+# and the smallest date window that may be split.
+MAX_DATE_SHARD_DEPTH = 4
+MIN_DATE_SHARD_WINDOW = timedelta(hours=1)
+# If True, news searches are also stored and put together by day (see retrieve_news_search_by_days).
+USE_NEWS_SEARCH_DAYS = True
+# A stored day is no longer current after this long, unless it was retrieved after the day was over, plus the settle time.
+NEWS_SEARCH_DAY_MAX_AGE = timedelta(hours=1)
+NEWS_SEARCH_DAY_SETTLE_TIME = timedelta(hours=1)
+# A stored article page's text is revalidated (with a conditional request) once it was retrieved this long ago.
+PAGE_TEXT_MAX_AGE = timedelta(days=1)
+# The words that page texts are split into for the term index (see get_token_counts).
+WORD_PATTERN = re.compile(r'\w+')
+# The ways that a term's words can be matched against the words in the term index (see db.retrieve_indexed_word_counts).
+TERM_INDEX_MATCH_MODES = ['exact', 'prefix', 'substring']
+# If True, stored page texts are added to the term index by a background thread (see schedule_page_text_indexing), this
+# many at a time, pausing for this many seconds after each batch so that indexing doesn't hold up the requests.
+INDEX_PAGE_TEXTS_IN_BACKGROUND = True
+PAGE_TEXT_INDEXING_BATCH_SIZE = 5
+PAGE_TEXT_INDEXING_PAUSE_SEC = 0.05
+# How long an article page that failed to be retrieved is skipped for (see get_page_failure_ttl).
+PAGE_FAILURE_TTL = timedelta(hours=1)
+PAGE_CLIENT_ERROR_FAILURE_TTL = timedelta(days=1)
+# Identical news searches made at the same time (i.e. whose dates are in the same window of this number of minutes) only
+# run once, and share their result (see coalescing.SingleFlight). The same goes for retrieving the same article page.
+COALESCED_SEARCH_WINDOW_MIN = 1
+news_search_calls = coalescing.SingleFlight()
+page_retrieval_calls = coalescing.SingleFlight()
+# In-process caches in front of the db (see cache.TTLCache). The enums and sources rarely change, so they're kept for
+# longer. Recently served news searches are only kept briefly, since they're already stored in the db.
+enums_cache = cache.TTLCache('enums', max_size=16, ttl_sec=60 * 60)
+sources_cache = cache.TTLCache('sources', max_size=256, ttl_sec=60 * 60)
+sources_domains_cache = cache.TTLCache('sources-domains', max_size=256, ttl_sec=60 * 60)
+news_search_cache = cache.TTLCache('recent-news-searches', max_size=100, ttl_sec=60)
+# The length of each interval that a term's trend can be computed by (see retrieve_term_trend). Computed trends are kept
+# in term_trend_cache, and are the same for searches whose dates are in the same window of this number of minutes.
+TERM_TREND_INTERVALS = {'day': timedelta(days=1), 'hour': timedelta(hours=1)}
+TERM_TREND_WINDOW_MIN = 5
+term_trend_cache = cache.TTLCache('term-trends', max_size=256, ttl_sec=TERM_TREND_WINDOW_MIN * 60)
+# The news searches requested most often lately (see prewarming.PopularityCounter), of which the NUM_PREWARMED_SEARCHES
+# most popular are kept stored in the db ahead of being requested again (see prewarm_popular_searches).
+popular_searches = prewarming.PopularityCounter(max_size=1000, half_life_sec=24 * 60 * 60)
+NUM_PREWARMED_SEARCHES = 10
+# The only article fields needed for counting terms on the articles' pages, and for their trends (see
+# retrieve_news_search's article_projection).
+COUNTED_ARTICLE_PROJECTION = {'_id': 0, 'url': 1, 'publishedAt': 1}
+
+
+# offset and limit select which of the search's articles are returned (the 'totalResults' is always for the whole search).
+# Only the selected articles are retrieved from the db.
+# If shard_by_date is True, then searches with too many results to retrieve all at once are split up by date (see
+# retrieve_all_pages_sharded_by_date). This only applies when get_all_pages is True.
+# Identical searches that are in-flight at the same time only run once (see COALESCED_SEARCH_WINDOW_MIN), and if the db
+# is used, then searches served recently are returned from news_search_cache.
+# If record_popularity is True (i.e. for the searches requested by users, rather than the searches made internally, e.g.
+# for a term's trend), then the search is counted towards the popular searches (see prewarm_popular_searches), unless
+# it's made in the background.
+# article_projection is used for the articles that are retrieved from the db (see db.retrieve_articles_by_urls), so that
+# callers that only need some of the articles' fields (e.g. COUNTED_ARTICLE_PROJECTION) don't retrieve the rest. (Articles
+# that are retrieved from the api have all of their fields)
+def retrieve_news_search(filters: dict, get_all_pages: bool, use_and_update_db: bool, offset: int = 0,
+                         limit: int = None, shard_by_date: bool = False, article_projection: dict = None,
+                         record_popularity: bool = False) -> tuple[bool, dict, dict]:
+    if record_popularity and use_and_update_db and newsapi.priority_var.get() < newsapi.BACKGROUND_PRIORITY:
+        # (The filters are counted as given, so that e.g. the default dates are the latest ones when it's refreshed)
+        popular_filters = {k: v for k, v in filters.items()}
+        popular_searches.record(json.dumps([popular_filters, get_all_pages, shard_by_date], sort_keys=True),
+                                (popular_filters, get_all_pages, shard_by_date))
     filters = clean_news_search_args(use_and_update_db, filters)
-    succeeded, result, errors = get_articles_and_num_total_results(filters, get_all_pages, use_and_update_db)
+    key = (db.get_news_search_key(filters, COALESCED_SEARCH_WINDOW_MIN), get_all_pages, use_and_update_db, offset, limit,
+           shard_by_date, json.dumps(article_projection, sort_keys=True))
+    if use_and_update_db:
+        cached = news_search_cache.get(key)
+        if cached is not None:
+            return cached
+    succeeded, result, errors = news_search_calls.run(key, lambda: get_articles_and_num_total_results(
+        filters, get_all_pages, use_and_update_db, offset, limit, shard_by_date, article_projection))
+    if succeeded and use_and_update_db:
+        news_search_cache.set(key, (succeeded, result, errors))
     return succeeded, result, errors
 
 
-def get_articles_and_num_total_results(params: dict, get_all_pages: bool, use_and_update_db: bool) -> tuple[bool, dict, dict]:
-    max_total_results = 500
-    succeeded = False
-    result = {}
-    errors = {}
+# Make sure that the most popular searches (see popular_searches) are stored in the db and current, so that they don't
+# need to wait on the api when they're requested again. Searches that are already stored are left as is, and the others
+# are retrieved from the api in the background (see newsapi.priority), so only with spare quota. Stops once there isn't
+# any spare quota left. Returns the number of popular searches that are stored.
+def prewarm_popular_searches() -> int:
+    num_stored = 0
+    with newsapi.priority(newsapi.BACKGROUND_PRIORITY):
+        for filters, get_all_pages, shard_by_date in popular_searches.get_most_popular(NUM_PREWARMED_SEARCHES):
+            filters = clean_news_search_args(True, filters)
+            key = (db.get_news_search_key(filters, COALESCED_SEARCH_WINDOW_MIN), get_all_pages, True, 0, None, shard_by_date,
+                   json.dumps(None))
+            succeeded, result, errors = news_search_calls.run(key, lambda: get_articles_and_num_total_results(
+                filters, get_all_pages, True, shard_by_date=shard_by_date))
+            if not succeeded and errors.get('status_code') == '429':
+                break
+            num_stored += int(succeeded)
+    return num_stored
+
 
+# If get_all_pages is False, then the offset selects the page of the search to retrieve (based on the page size), so that
+# paginating over the articles only ever retrieves the page of articles that is needed.
+def get_articles_and_num_total_results(params: dict, get_all_pages: bool, use_and_update_db: bool, offset: int = 0,
+                                       limit: int = None, shard_by_date: bool = False,
+                                       article_projection: dict = None) -> tuple[bool, dict, dict]:
     # Copy arguments and add a page arg
     arguments = dict(params)
-    arguments['page'] = 1
-    articles = []
+    page_size = int(arguments.get('pageSize', DEFAULT_PAGE_SIZE))
+
+    # Searches stored by day can be put together even if the dates don't match a previous search. Only the days that
+    # aren't stored yet need to be retrieved, which is only done when retrieving all pages. (When retrieving a single
+    # page, the search is only put together by day if all of its days are already stored)
+    if use_and_update_db and USE_NEWS_SEARCH_DAYS and can_retrieve_news_search_by_days(arguments):
+        result = retrieve_news_search_by_days(arguments, offset, limit, get_all_pages, shard_by_date, article_projection)
+        if result is not None:
+            return result
+
+    # When only retrieving a single page, the offset and limit are applied to just that page's articles.
+    if not get_all_pages:
+        arguments['page'] = offset // page_size + 1
+        return retrieve_news_search_page(arguments, use_and_update_db, offset % page_size, limit,
+                                         article_projection=article_projection)
+
+    if shard_by_date:
+        succeeded, result, errors = retrieve_all_pages_sharded_by_date(arguments, use_and_update_db,
+                                                                       article_projection=article_projection)
+    else:
+        succeeded, result, errors = retrieve_all_pages(arguments, use_and_update_db, article_projection=article_projection)
+    if succeeded:
+        articles = result.get('articles')
+        result['articles'] = articles[offset:offset + limit] if limit is not None else articles[offset:]
+    return succeeded, result, errors
+
+
+# Retrieve all pages of a news search. The first page is retrieved first (unless it is passed in) to find the total
+# number of results, and all other pages are then retrieved concurrently and merged in page order (without any duplicate
+# articles). Fails if the search has too many results to be retrieved (MAX_TOTAL_RESULTS).
+def retrieve_all_pages(arguments: dict, use_and_update_db: bool, first_page: dict = None,
+                  max_time_difference_min: int = None, article_projection: dict = None) -> tuple[bool, dict, dict]:
+    arguments = {**arguments, 'page': 1}
+    page_size = int(arguments.get('pageSize', DEFAULT_PAGE_SIZE))
+
+    succeeded, errors = True, {}
+    if first_page is None:
+        succeeded, first_page, errors = retrieve_news_search_page(arguments, use_and_update_db,
+                                                                  max_time_difference_min=max_time_difference_min,
+                                                                  article_projection=article_projection)
+    total_results = first_page.get('totalResults', 0)
+    if succeeded and total_results >= MAX_TOTAL_RESULTS:
+        succeeded = False
+        errors = {
+            'error_source': 'external',
+            'status_code': 426,
+            'message': 'Unable to collect articles for search with over ' + str(MAX_TOTAL_RESULTS) + ' results'
+        }
+    if not succeeded:
+        return succeeded, first_page, errors
+
+    # Retrieve the remaining pages concurrently. (executor.map returns the results in page order)
+    num_pages = math.ceil(total_results / page_size)
+    other_pages_arguments = [{**arguments, 'page': page} for page in range(2, num_pages + 1)]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES) as executor:
+        other_pages = list(executor.map(metrics.with_request_log(
+            lambda page_arguments: retrieve_news_search_page(page_arguments, use_and_update_db,
+                                                             max_time_difference_min=max_time_difference_min,
+                                                             article_projection=article_projection)),
+            other_pages_arguments))
+
+    # Merge all pages' articles, skipping any article that was already seen in an earlier page.
+    articles_by_url = {}
+    for page_succeeded, page, page_errors in [(succeeded, first_page, errors)] + other_pages:
+        if not page_succeeded:
+            return page_succeeded, {'articles': [], 'totalResults': total_results}, page_errors
+        for article in page.get('articles', []):
+            articles_by_url.setdefault(article.get('url'), article)
+
+    result = {
+        'articles': list(articles_by_url.values()),
+        'totalResults': total_results
+    }
+    return succeeded, result, errors
+
+
+# Retrieve all pages of a news search, even if it has more results than can be retrieved for a single search
+# (MAX_TOTAL_RESULTS). If it does, then the search's 'from'-'to' window is split in half and each half is searched
+# separately (concurrently), recursively, until each sub-window (shard) is under the limit. Every shard is stored in the db
+# as its own news search, and the shards' articles are merged newest first (newsapi's default order) without duplicates.
+# The number of api calls is bounded by MAX_DATE_SHARD_DEPTH (at most 2 ^ depth shards).
+# max_time_difference_min is the tolerance used for matching the dates of the (unsplit) search in the db.
+def retrieve_all_pages_sharded_by_date(arguments: dict, use_and_update_db: bool, depth: int = 0,
+                                       max_time_difference_min: int = None,
+                                       article_projection: dict = None) -> tuple[bool, dict, dict]:
+    # Shards are looked up in the db with a smaller tolerance than usual, since their windows can be smaller than the
+    # usual tolerance. (Shards are split on whole multiples of MIN_DATE_SHARD_WINDOW, so that the same search is split the
+    # same way each time, and so half of it is small enough to never match a different shard)
+    if depth > 0:
+        max_time_difference_min = MIN_DATE_SHARD_WINDOW // timedelta(minutes=1) // 2
+    succeeded, first_page, errors = retrieve_news_search_page({**arguments, 'page': 1}, use_and_update_db,
+                                                              max_time_difference_min=max_time_difference_min,
+                                                              article_projection=article_projection)
+    if not succeeded or first_page.get('totalResults', 0) < MAX_TOTAL_RESULTS:
+        return retrieve_all_pages(arguments, use_and_update_db, first_page if succeeded else None, max_time_difference_min,
+                                  article_projection)
+
+    from_date = datetime.fromisoformat(arguments['from'])
+    to_date = datetime.fromisoformat(arguments['to'])
+    if depth >= MAX_DATE_SHARD_DEPTH or to_date - from_date < MIN_DATE_SHARD_WINDOW * 3:
+        return False, {'articles': [], 'totalResults': first_page.get('totalResults', 0)}, {
+            'error_source': 'external',
+            'status_code': 426,
+            'message': 'Unable to collect articles for search with over ' + str(MAX_TOTAL_RESULTS) +
+                       ' results in a window of ' + str(to_date - from_date)
+        }
+
+    # Split at the middle (rounded down to a multiple of MIN_DATE_SHARD_WINDOW), newer half first.
+    middle_date = from_date + (to_date - from_date) / 2
+    middle_date -= (middle_date - datetime.fromtimestamp(0, tz=timezone.utc)) % MIN_DATE_SHARD_WINDOW
+    shards_arguments = [
+        {**arguments, 'from': (middle_date + timedelta(seconds=1)).isoformat(), 'to': arguments['to']},
+        {**arguments, 'from': arguments['from'], 'to': middle_date.isoformat()}
+    ]
+    with ThreadPoolExecutor(max_workers=len(shards_arguments)) as executor:
+        shards = list(executor.map(metrics.with_request_log(
+            lambda shard_arguments: retrieve_all_pages_sharded_by_date(shard_arguments, use_and_update_db, depth + 1,
+                                                                       article_projection=article_projection)),
+            shards_arguments))
+
+    articles_by_url = {}
     total_results = 0
+    for shard_succeeded, shard, shard_errors in shards:
+        if not shard_succeeded:
+            return shard_succeeded, {'articles': [], 'totalResults': first_page.get('totalResults', 0)}, shard_errors
+        total_results += shard.get('totalResults', 0)
+        for article in shard.get('articles', []):
+            articles_by_url.setdefault(article.get('url'), article)
 
-    while True:
-        if use_and_update_db:
-            succeeded, result = db.retrieve_news_search(arguments)
-            articles += result.get('articles', []) if succeeded else []
-            total_results = result.get('totalResults', total_results) if succeeded else total_results
-        if not succeeded or not use_and_update_db:  # then retrieve results via api
-            response = newsapi.get_articles(arguments)
-            succeeded = response.status_code == 200
-            result = json.loads(response.content)
-            if succeeded:
-                articles += result.get('articles', [])
-                total_results = result.get('totalResults', total_results)
-                if use_and_update_db:
-                    db.insert_new_news_search_and_articles(arguments, result.get('articles', []), total_results)
-            else:
-                errors = {
-                    'error_source': 'external',
-                    'status_code': str(response.status_code),
-                    'message': 'Error retrieving articles. News API status code: ' + str(response.status_code) +
-                               '.\nAPI code: ' + result.get('code') + '. API Message: ' + result.get(
-                        'message')
-                }
-                break
-        if get_all_pages and total_results >= max_total_results:
-            succeeded = False
+    result = {
+        'articles': list(articles_by_url.values()),
+        'totalResults': total_results
+    }
+    return True, result, {}
+
+
+# Only searches sorted by publish date (newsapi's default) can be put together from the stored days.
+def can_retrieve_news_search_by_days(arguments: dict) -> bool:
+    return arguments.get('sortBy', 'publishedAt') == 'publishedAt' and 'from' in arguments and 'to' in arguments
+
+
+# Put together a news search from its (UTC) days that are stored in the db, retrieving and storing any days that are not
+# stored yet or are no longer current (see is_news_search_day_current). Consecutive missing days are retrieved as a single
+# search, and the searches for separate groups of missing days are retrieved concurrently.
+# The articles are returned newest first, and offset and limit select which of them are returned (only the selected
+# articles are retrieved from the db). None is returned if the search shouldn't be put together by day: if any days are
+# missing and retrieve_missing_days is False, or if all of them are missing and the search itself is already stored.
+def retrieve_news_search_by_days(arguments: dict, offset: int, limit: int | None, retrieve_missing_days: bool,
+                                 shard_by_date: bool, article_projection: dict = None) -> tuple[bool, dict, dict] | None:
+    now = datetime.now(timezone.utc)
+    from_date = datetime.fromisoformat(arguments['from'])
+    to_date = datetime.fromisoformat(arguments['to'])
+    query = get_news_search_query(arguments)
+
+    days = get_days_between(from_date, to_date)
+    stored_days = db.retrieve_news_search_days(query, days)
+    stored_days = {day: entry for day, entry in stored_days.items() if is_news_search_day_current(day, entry, now)}
+    metrics.record_cache_lookups('news-search-days', len(stored_days), len(days) - len(stored_days))
+
+    missing_day_ranges = get_missing_day_ranges(days, stored_days)
+    if missing_day_ranges and not retrieve_missing_days:
+        return None
+    # If none of the days are stored but the search itself is (e.g. its first page was just retrieved for
+    # /internal/get-articles), then it isn't put together by day, so that its stored pages are used instead of retrieving
+    # its days' dates from the api again.
+    if len(stored_days) == 0 and db.news_search_exists({**arguments, 'page': 1}):
+        return None
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES) as executor:
+        retrieved_day_ranges = list(executor.map(metrics.with_request_log(
+            lambda day_range: retrieve_news_search_day_range(arguments, query, day_range[0], day_range[1], shard_by_date, now,
+                                                             article_projection)),
+            missing_day_ranges))
+    # (The retrieved articles are returned as retrieved, since they may not be written to the db yet, see db.WRITE_BEHIND)
+    retrieved_articles_by_url = {}
+    for succeeded, day_range, errors in retrieved_day_ranges:
+        if not succeeded:
+            return succeeded, {'articles': [], 'totalResults': 0}, errors
+        stored_days.update(day_range.get('days'))
+        for article in day_range.get('articles'):
+            retrieved_articles_by_url.setdefault(article.get('url'), article)
+
+    # Put together the urls of all articles within the search's dates, newest first
+    published_dates_by_url = {}
+    for entry in stored_days.values():
+        for article in entry.get('articles', []):
+            if from_date <= article.get('publishedAt') <= to_date:
+                published_dates_by_url[article.get('url')] = article.get('publishedAt')
+    urls = sorted(published_dates_by_url, key=published_dates_by_url.get, reverse=True)
+    selected_urls = urls[offset:offset + limit] if limit is not None else urls[offset:]
+
+    # Only the articles of the days that were already stored are retrieved from the db.
+    stored_articles_by_url = {article.get('url'): article for article in db.retrieve_articles_by_urls(
+        [url for url in selected_urls if url not in retrieved_articles_by_url], article_projection)}
+    articles = [retrieved_articles_by_url.get(url, stored_articles_by_url.get(url)) for url in selected_urls]
+    result = {
+        'articles': [article for article in articles if article is not None],
+        'totalResults': len(urls)
+    }
+    return True, result, {}
+
+
+# Retrieve all articles for the search published from the start of first_day to the end of last_day (or now, if that
+# is earlier), and store them in the db split up by day. Returns the 'days', as a dict of day -> entry (like
+# db.retrieve_news_search_days), and the retrieved 'articles'.
+def retrieve_news_search_day_range(arguments: dict, query: dict, first_day: datetime, last_day: datetime,
+                                   shard_by_date: bool, now: datetime,
+                                   article_projection: dict = None) -> tuple[bool, dict, dict]:
+    range_arguments = {
+        **arguments,
+        'from': first_day.isoformat(),
+        'to': min(last_day + timedelta(days=1, seconds=-1), now).isoformat()
+    }
+    # The range's dates are looked up exactly, since stored searches for other ranges would only be a partial match.
+    if shard_by_date:
+        succeeded, result, errors = retrieve_all_pages_sharded_by_date(range_arguments, True, max_time_difference_min=0,
+                                                                       article_projection=article_projection)
+    else:
+        succeeded, result, errors = retrieve_all_pages(range_arguments, True, max_time_difference_min=0,
+                                                       article_projection=article_projection)
+    if not succeeded:
+        return succeeded, {'days': {}, 'articles': []}, errors
+
+    articles_by_day = {day: [] for day in get_days_between(first_day, last_day)}
+    end_date = min(datetime.fromisoformat(range_arguments['to']), datetime.fromisoformat(arguments['to']))
+    for article in result.get('articles', []):
+        published_at = get_published_date(article, end_date)
+        day = get_days_between(published_at)[0]
+        if day in articles_by_day:
+            articles_by_day[day].append({'url': article.get('url'), 'publishedAt': published_at})
+    db.insert_news_search_days(query, articles_by_day, now)
+
+    entries = {day: {'day': day, 'articles': articles, 'retrievedAt': now} for day, articles in articles_by_day.items()}
+    return True, {'days': entries, 'articles': result.get('articles', [])}, {}
+
+
+# A stored day is current if it was retrieved after the day was over (plus some time for newsapi to finish adding the
+# day's articles), otherwise only if it was retrieved recently (e.g. for today).
+def is_news_search_day_current(day: datetime, entry: dict, now: datetime) -> bool:
+    retrieved_at = entry.get('retrievedAt')
+    if retrieved_at >= day + timedelta(days=1) + NEWS_SEARCH_DAY_SETTLE_TIME:
+        return True
+    return now - retrieved_at < NEWS_SEARCH_DAY_MAX_AGE
+
+
+# Return the start of the (UTC) interval ('day' or 'hour', see TERM_TREND_INTERVALS) that the date is in.
+def get_interval_start(date: datetime, interval: str) -> datetime:
+    day = get_days_between(date)[0]
+    return day + (date.astimezone(timezone.utc) - day) // TERM_TREND_INTERVALS[interval] * TERM_TREND_INTERVALS[interval]
+
+
+# Return the days that aren't in stored_days (a dict of day -> entry) grouped into ranges of consecutive days, as
+# (first day, last day) tuples.
+def get_missing_day_ranges(days: list, stored_days: dict) -> list:
+    missing_day_ranges = []
+    for day in days:
+        if day in stored_days:
+            continue
+        if missing_day_ranges and missing_day_ranges[-1][1] == day - timedelta(days=1):
+            missing_day_ranges[-1] = (missing_day_ranges[-1][0], day)
+        else:
+            missing_day_ranges.append((day, day))
+    return missing_day_ranges
+
+
+# The query of a news search is its args besides for the dates and paging, which is the same for all of its days.
+def get_news_search_query(arguments: dict) -> dict:
+    return {k: arguments[k] for k in sorted(arguments) if k not in ['from', 'to', 'page', 'pageSize']}
+
+
+# Return the article's publish date, or default if it doesn't have a valid one (e.g. the end date of the search it was
+# found by, since newsapi only returns articles published within a search's dates). Dates without a timezone are in UTC.
+def get_published_date(article: dict, default: datetime) -> datetime:
+    try:
+        published_at = datetime.fromisoformat(article.get('publishedAt'))
+    except (TypeError, ValueError):
+        return default
+    return published_at if published_at.tzinfo is not None else published_at.replace(tzinfo=timezone.utc)
+
+
+# Return the start (in UTC) of each day from the start date until the end date (or just the start date's day, if no end
+# date is given).
+def get_days_between(start_date: datetime, end_date: datetime = None) -> list:
+    if end_date is None:
+        end_date = start_date
+    start_date = start_date.astimezone(timezone.utc)
+    end_date = end_date.astimezone(timezone.utc)
+    day = datetime(year=start_date.year, month=start_date.month, day=start_date.day, tzinfo=timezone.utc)
+    days = []
+    while day <= end_date:
+        days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+# Retrieve a single page of a news search (the arguments must include the 'page'), from the db if it was already stored,
+# otherwise from the api (and then store it in the db).
+# article_offset and article_limit select which of the page's articles are returned.
+# max_time_difference_min is the tolerance used for matching the dates of a stored news search (see db.retrieve_news_search).
+# article_projection is used for the articles of a stored news search (see retrieve_news_search).
+def retrieve_news_search_page(arguments: dict, use_and_update_db: bool, article_offset: int = 0, article_limit: int = None,
+                              max_time_difference_min: int = None,
+                              article_projection: dict = None) -> tuple[bool, dict, dict]:
+    succeeded = False
+    result = {}
+    errors = {}
+
+    if use_and_update_db:
+        succeeded, result = db.retrieve_news_search(arguments, max_time_difference_min, article_projection, article_offset,
+                                                    article_limit)
+        metrics.record_cache_lookups('news-searches', int(succeeded), int(not succeeded))
+    if not succeeded or not use_and_update_db:  # then retrieve results via api
+        response = newsapi.get_articles(arguments)
+        succeeded = response.status_code == 200
+        result = json.loads(response.content)
+        if succeeded:
+            if use_and_update_db:
+                db.insert_new_news_search_and_articles(arguments, result.get('articles', []), result.get('totalResults', 0),
+                                                       max_time_difference_min=max_time_difference_min)
+            article_end = article_offset + article_limit if article_limit is not None else None
+            result['articles'] = result.get('articles', [])[article_offset:article_end]
+        else:
             errors = {
                 'error_source': 'external',
-                'status_code': 426,
-                'message': 'Unable to collect articles for search with over ' + str(max_total_results) + ' results'
+                'status_code': str(response.status_code),
+                'message': 'Error retrieving articles. News API status code: ' + str(response.status_code) +
+                           '.\nAPI code: ' + result.get('code') + '. API Message: ' + result.get(
+                    'message')
             }
-            break
-        if not get_all_pages or len(articles) >= result.get('totalResults', float('inf')):
-            break
-        arguments['page'] += 1
 
     result = {
-        'articles': articles,
-        'totalResults': total_results
+        'articles': result.get('articles', []) if succeeded else [],
+        'totalResults': result.get('totalResults', 0) if succeeded else 0
     }
     return succeeded, result, errors
 
 
+# Return the trend of the search's term over its dates, as the number of articles and the number of occurrences of the
+# term in each (UTC) interval ('day' or 'hour') from the 'from' date to the 'to' date, oldest first.
+# The trend is computed from what is stored in the db (see db.retrieve_term_trend), without retrieving any pages, so the
+# occurrences only include the articles whose count for the term is stored (each interval has how many of its articles
+# were counted). The search's articles are put together from its stored days (see retrieve_news_search_by_days), and
+# only the days that aren't stored yet are retrieved (with retrieve_news_search). The articles that were just retrieved
+# may not be written to the db yet (see db.WRITE_BEHIND), so the number of articles in each interval is counted from
+# their publish dates, and only the term's counts for the stored days are aggregated in the db.
+# Expects the same filters as retrieve_news_search. The filters' order ('sortBy') doesn't matter, so it is ignored.
+def retrieve_term_trend(filters: dict, interval: str, shard_by_date: bool = False) -> tuple[bool, dict, dict]:
+    filters = clean_news_search_args(True, {k: v for k, v in filters.items() if k != 'sortBy'})
+    key = (db.get_news_search_key(filters, TERM_TREND_WINDOW_MIN), interval, shard_by_date)
+    cached = term_trend_cache.get(key)
+    if cached is not None:
+        return cached
+
+    now = datetime.now(timezone.utc)
+    from_date = datetime.fromisoformat(filters['from'])
+    to_date = datetime.fromisoformat(filters['to'])
+    query = get_news_search_query(filters)
+
+    days = get_days_between(from_date, to_date)
+    stored_days = db.retrieve_news_search_days(query, days)
+    stored_days = {day: entry for day, entry in stored_days.items() if is_news_search_day_current(day, entry, now)}
+    metrics.record_cache_lookups('news-search-days', len(stored_days), len(days) - len(stored_days))
+    published_dates_by_url = {}
+    for entry in stored_days.values():
+        for article in entry.get('articles', []):
+            published_dates_by_url[article.get('url')] = article.get('publishedAt')
+
+    # Retrieve the days that aren't stored, with a separate search for each range of consecutive missing days.
+    missing_days_filters = [
+        {**filters, 'from': max(first_day, from_date).isoformat(),
+         'to': min(last_day + timedelta(days=1, seconds=-1), to_date).isoformat()}
+        for first_day, last_day in get_missing_day_ranges(days, stored_days)
+    ]
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES) as executor:
+        missing_days_results = list(executor.map(metrics.with_request_log(
+            lambda day_range_filters: retrieve_news_search(day_range_filters, True, True, shard_by_date=shard_by_date,
+                                                           article_projection=COUNTED_ARTICLE_PROJECTION)),
+            missing_days_filters))
+    retrieved_urls = set()
+    for day_range_filters, (succeeded, result, errors) in zip(missing_days_filters, missing_days_results):
+        if not succeeded:
+            return succeeded, {}, errors
+        for article in result.get('articles', []):
+            published_dates_by_url[article.get('url')] = get_published_date(
+                article, datetime.fromisoformat(day_range_filters['to']))
+            retrieved_urls.add(article.get('url'))
+
+    urls = [url for url, published_at in published_dates_by_url.items() if from_date <= published_at <= to_date]
+    counts_by_interval = db.retrieve_term_trend(filters['q'], [url for url in urls if url not in retrieved_urls], interval)
+    retrieved_counts = db.retrieve_term_counts(filters['q'], [url for url in urls if url in retrieved_urls])
+    for url in urls:
+        counts = counts_by_interval.setdefault(get_interval_start(published_dates_by_url[url], interval), {})
+        counts['numArticles'] = counts.get('numArticles', 0) + 1
+        if url in retrieved_counts:
+            counts['numCountedArticles'] = counts.get('numCountedArticles', 0) + 1
+            counts['numOccurrences'] = counts.get('numOccurrences', 0) + retrieved_counts[url]
+
+    # Every interval in the dates is included, even those without any articles.
+    interval_length = TERM_TREND_INTERVALS[interval]
+    interval_start = get_days_between(from_date)[0]
+    points = []
+    while interval_start <= to_date:
+        if interval_start + interval_length > from_date:
+            counts = counts_by_interval.get(interval_start, {})
+            points.append({
+                'date': interval_start.isoformat(),
+                'num_articles': counts.get('numArticles', 0),
+                'num_counted_articles': counts.get('numCountedArticles', 0),
+                'num_occurrences': counts.get('numOccurrences', 0)
+            })
+        interval_start += interval_length
+
+    result = {
+        'term': filters['q'],
+        'interval': interval,
+        'from': filters['from'],
+        'to': filters['to'],
+        'num_articles': len(urls),
+        'points': points
+    }
+    term_trend_cache.set(key, (True, result, {}))
+    return True, result, {}
+
+
+# Return the values of the enum with the given name (e.g. 'language'), as a dict of value -> display name, or None if
+# there is no such enum. The values are kept in enums_cache.
+def retrieve_enum_values(name: str) -> dict | None:
+    values = enums_cache.get(name)
+    if values is None:
+        values = db.retrieve_enum_values(name)
+        if values is not None:
+            enums_cache.set(name, values)
+    return values
+
+
 # Retrieve news sources (used for filtering news searches) based on the given filters.
+# Sources that were retrieved recently are returned from sources_cache.
 def retrieve_sources(use_and_update_db: bool, filters: dict) -> tuple[bool, dict, dict]:
+    key = json.dumps(filters, sort_keys=True)
+    cached = sources_cache.get(key)
+    if cached is not None:
+        return True, cached, {}
+
     # Values to return:
     succeeded = False
     result = {}
@@ -101,6 +607,8 @@ def retrieve_sources(use_and_update_db: bool, filters: dict) -> tuple[bool, dict
                     'message')
             }
             succeeded = False
+    if succeeded:
+        sources_cache.set(key, result)
     return succeeded, result, errors
 
 
@@ -126,17 +634,29 @@ def update_news_search_args_with_domains(use_db: bool, args: dict):
         # Get and remove any parameters from the args dict that are there
         filters = {k: args.pop(k) for k in valid_sources_filters if k in args}
 
-        succeeded, result, errors = retrieve_sources(use_db, filters)
-        if succeeded:
-            # We are only returning the property required for our /everything request, which is the domain + suffix.
-            # E.g., 'amazon.com'. For each source, the below line extracts just the domain and suffix, joins them together,
-            # so they become 'domain.suffix' and joins all domains by commas as the newsapi expects.
-            domains = ",".join(
-                ['.'.join(extract(source[prop_to_extract])[-2:]) for source in result if prop_to_extract in source])
+        # The domains are only extracted once for each list of sources, and then kept in sources_domains_cache.
+        key = json.dumps(filters, sort_keys=True)
+        domains = sources_domains_cache.get(key)
+        if domains is None:
+            succeeded, result, errors = retrieve_sources(use_db, filters)
+            if succeeded:
+                # We are only returning the property required for our /everything request, which is the domain + suffix.
+                # E.g., 'amazon.com'. For each source, the below line extracts just the domain and suffix, joins them together,
+                # so they become 'domain.suffix' and joins all domains by commas as the newsapi expects.
+                domains = ",".join(
+                    [get_domain_and_suffix(source[prop_to_extract]) for source in result if prop_to_extract in source])
+                sources_domains_cache.set(key, domains)
+        if domains is not None:
             args['domains'] = domains
     return args
 
 
+# Return the url's domain and suffix, e.g. 'amazon.com' for 'https://www.amazon.com/news'.
+def get_domain_and_suffix(url: str) -> str:
+    result = extract(url)
+    return result.domain + '.' + result.suffix
+
+
 # Update the 'from' and 'to' date arguments for a news search request to the beginning and end of their days,
 # respectively, and return in utc time.
 def update_news_search_date_args(args: dict) -> dict:
@@ -192,7 +712,7 @@ def get_template_response_dict(url: str = None, args: dict = None, num_results:
     if results_values is None:
         results_values = {}
     if dev_logs is None:
-        dev_logs = []
+        dev_logs = metrics.get_request_log()
 
     return_dict = {
         "request": {
@@ -205,84 +725,391 @@ def get_template_response_dict(url: str = None, args: dict = None, num_results:
             "num_results": num_results,
             "values": results_values
         },
-        "dev_logs": [],
+        "dev_logs": dev_logs,
         "errors": errors
     }
     return return_dict
 
 
-# Return the total number of times the term appears on all webpages given.
+# Return the total number of times the term appears on all webpages given, along with how many pages were counted and
+# how many pages failed (e.g. the page returned an error or didn't respond in time). Failed pages are not included in the total.
 # This can be an expensive operation the higher the number of urls provided, as it may need to make a separate request to
-# each url if it's not already in the db.
-def num_occurrences_on_pages(use_and_update_db: bool, term: str, urls: list) -> int:
-    total_sum = 0
-    for url in urls:
-        current_amount = get_num_occurrences_on_page(use_and_update_db, term, url)
-        if current_amount < 0:  # i.e., if current page failed to count num of term occurrences
-            pass
-            # TODO send back that an error occurred in x num of pages
-        else:
-            total_sum += current_amount
-    return total_sum
+# each url if it's not already in the db. (See num_occurrences_of_terms_on_pages)
+# If on_progress is given, then it's called with the progress so far as pages are counted (see
+# num_occurrences_of_terms_on_pages).
+def num_occurrences_on_pages(use_and_update_db: bool, term: str, urls: list, on_progress=None) -> dict:
+    return num_occurrences_of_terms_on_pages(use_and_update_db, {term: urls}, on_progress).get(term.lower())
 
 
-# Return the number of times the term occurs on the webpage.
-# If there is an error in retrieving the page, then return -1.
-# The search is not case-sensitive.
-def get_num_occurrences_on_page(use_and_update_db: bool, term: str, url: str) -> int:
-    term = term.lower()
-    succeeded = False
+# Same as num_occurrences_on_pages, but for several terms at once. Expects a dict of term -> the urls to count the term on,
+# and returns a dict of term -> the term's result (as returned by num_occurrences_on_pages). Terms are lowercased.
+# Each page is only retrieved once, and all the terms that still need to be counted on it are counted together.
+# Any counts already in the db are retrieved with a single query per term, and any pages whose text is already stored in
+# the db are counted from the stored text. Only the remaining pages are retrieved (concurrently, see the pages module for
+# the limits used), and their text and the new counts for all terms are then stored with bulk writes.
+# Pages that recently failed to be retrieved (see PAGE_FAILURE_TTL), and pages from domains that are currently failing
+# (see pages.DomainCircuitBreaker) are skipped, and are counted separately in each result's 'num_pages_skipped'.
+# If on_progress is given, then it's called once the pages that don't need to be retrieved are counted, and then again
+# each time a retrieved page is done, with a dict of the progress so far: 'num_pages_total', 'num_pages_done',
+# 'num_pages_failed' (including the skipped pages), and 'num_occurrences' (a dict of term -> the total so far).
+# It's called from the threads retrieving the pages, but never by more than one thread at once.
+def num_occurrences_of_terms_on_pages(use_and_update_db: bool, urls_by_term: dict, on_progress=None) -> dict:
+    urls_by_term = {term.lower(): urls for term, urls in urls_by_term.items()}
+    all_urls = list(dict.fromkeys(url for urls in urls_by_term.values() for url in urls))
 
+    counts_by_term = {term: {} for term in urls_by_term}
     if use_and_update_db:
-        # The result we're looking for was already computed if we can find an article that has the same url and has
-        # this term already in the db entry.
-        filters = {
-            'url': url,
-            'termCounts.term': term
-        }
-        # Only return the count of this term on the page, we don't need any other info.
-        projection = {
-            '_id': 0,
-            # The '.$' matches only the entries where that field (the term) matches the filter, so that other terms' results are not returned
-            'termCounts.$': 1
+        counts_by_term = {term: db.retrieve_term_counts(term, urls) for term, urls in urls_by_term.items()}
+        for term, urls in urls_by_term.items():
+            metrics.record_cache_lookups('termCounts', len(counts_by_term[term]), len(set(urls)) - len(counts_by_term[term]))
+
+    # The terms that still need to be counted on each page
+    missing_terms_by_url = {}
+    for term, urls in urls_by_term.items():
+        for url in urls:
+            if url not in counts_by_term[term]:
+                missing_terms_by_url.setdefault(url, []).append(term)
+    missing_urls = [url for url in all_urls if url in missing_terms_by_url]
+
+    skipped_urls = set()
+    if use_and_update_db:
+        skipped_urls = db.retrieve_failed_page_urls(missing_urls)
+        missing_urls = [url for url in missing_urls if url not in skipped_urls]
+
+    # Stored texts that were retrieved too long ago are revalidated (see retrieve_page), the rest are counted without
+    # retrieving the pages (mostly from the term index, see count_terms_on_stored_pages).
+    stored_pages = {}
+    if use_and_update_db:
+        stored_pages = db.retrieve_page_texts(missing_urls, include_text=False)
+    now = datetime.now(timezone.utc)
+    current_urls = [url for url, page in stored_pages.items() if now - page.get('retrievedAt') < PAGE_TEXT_MAX_AGE]
+    if use_and_update_db:
+        metrics.record_cache_lookups('page-texts', len(current_urls), len(missing_urls) - len(current_urls))
+        # (The texts of the pages to revalidate are needed in case they didn't change)
+        stored_pages.update(db.retrieve_page_texts([url for url in stored_pages if url not in current_urls]))
+
+    with metrics.time_stage('page.count'):
+        new_counts_by_url = count_terms_on_stored_pages({url: missing_terms_by_url[url] for url in current_urls},
+                                                        stored_pages)
+
+    urls_to_retrieve = [url for url in missing_urls if url not in new_counts_by_url]
+    revalidated_pages = {url: page for url, page in stored_pages.items() if 'text' in page}
+    progress = {
+        'num_pages_total': len(all_urls),
+        'num_pages_done': len(all_urls) - len(urls_to_retrieve),
+        'num_pages_failed': len(skipped_urls),
+        'num_occurrences': {term: sum(counts.values()) + sum(new_counts.get(term, 0) for new_counts in new_counts_by_url.values())
+                            for term, counts in counts_by_term.items()}
+    }
+    progress_lock = threading.Lock()
+    if on_progress is not None:
+        on_progress(progress)
+
+    # Retrieve the page and count the terms on it (counts is None if the page failed or was skipped)
+    def retrieve_and_count_page(url: str) -> tuple[dict, dict | None]:
+        # (If another count is already retrieving the page, then its result is used instead of retrieving it again)
+        page = page_retrieval_calls.run(url, lambda: retrieve_page_unless_domain_failing(url, revalidated_pages.get(url)))
+        counts = None
+        if 'text' in page:
+            with metrics.time_stage('page.count'):
+                counts = count_terms_in_text(missing_terms_by_url[url], page.get('text'))
+        if on_progress is not None:
+            with progress_lock:
+                progress['num_pages_done'] += 1
+                if counts is None:
+                    progress['num_pages_failed'] += 1
+                else:
+                    for term, count in counts.items():
+                        progress['num_occurrences'][term] += count
+                on_progress(progress)
+        return page, counts
+
+    retrieved_pages_and_counts = pages.run_for_all_urls(urls_to_retrieve, retrieve_and_count_page)
+    retrieved_pages = {url: page for url, (page, _) in retrieved_pages_and_counts.items()}
+    new_counts_by_url.update({url: counts for url, (_, counts) in retrieved_pages_and_counts.items() if counts is not None})
+    skipped_urls.update(url for url, page in retrieved_pages.items() if page.get('skipped'))
+    # (Pages that timed out waiting for a connection aren't stored as failed, see retrieve_page)
+    failed_pages = {url: page for url, page in retrieved_pages.items() if page.get('failed') and not page.get('poolTimeout')}
+    retrieved_pages = {url: page for url, page in retrieved_pages.items() if 'text' in page}
+    if use_and_update_db:
+        unmodified_urls = [url for url, page in retrieved_pages.items() if page.get('notModified')]
+        db.update_page_texts_retrieved(unmodified_urls)
+        new_pages = {url: page for url, page in retrieved_pages.items() if not page.get('notModified')}
+        db.insert_page_texts(new_pages)
+        if len(new_pages) > 0:
+            schedule_page_text_indexing()
+        # If a page's content changed since it was stored, then its stored counts for other terms are out of date
+        db.remove_term_counts([url for url, page in new_pages.items() if url in stored_pages and
+                               db.get_content_hash(page.get('text')) != stored_pages[url].get('contentHash')])
+        db.insert_page_failures({url: {'status': page.get('status'), 'expiresAt': now + get_page_failure_ttl(page.get('status'))}
+                                 for url, page in failed_pages.items()})
+
+    if use_and_update_db:
+        db.insert_terms_counts(new_counts_by_url)
+    for url, new_counts in new_counts_by_url.items():
+        for term, count in new_counts.items():
+            counts_by_term[term][url] = count
+
+    results = {}
+    for term, urls in urls_by_term.items():
+        total_sum = 0
+        num_pages_counted = 0
+        num_pages_failed = 0
+        num_pages_skipped = 0
+        for url in urls:
+            current_amount = counts_by_term[term].get(url, -1)  # urls missing from the counts failed or didn't complete in time
+            if current_amount >= 0:
+                total_sum += current_amount
+                num_pages_counted += 1
+            elif url in skipped_urls:
+                num_pages_skipped += 1
+            else:  # i.e., if current page failed to count num of term occurrences
+                num_pages_failed += 1
+        results[term] = {
+            'num_occurrences': total_sum,
+            'num_pages_counted': num_pages_counted,
+            'num_pages_failed': num_pages_failed,
+            'num_pages_skipped': num_pages_skipped
         }
-        result = db.retrieve_article(filters, projection)
-        succeeded = result is not None
-        if succeeded:
-            count = result.get('termCounts')[0].get('count')
-            return count
+    return results
 
-    # If we could not retrieve the result from the db, then get the info manually and insert the results we find in the db.
-    if not use_and_update_db or not succeeded:
+
+# Retrieve the news search for each term (with the same filters), and return the number of times each term appears
+# across all the pages of its search (see num_occurrences_of_terms_on_pages), along with the number of articles in its
+# search. Returns a dict of term -> result.
+def num_occurrences_of_terms(use_and_update_db: bool, filters: dict, terms: list, shard_by_date: bool = False,
+                             on_progress=None) -> tuple[bool, dict, dict]:
+    urls_by_term = {}
+    num_articles_by_term = {}
+    for term in terms:
+        succeeded, result, errors = retrieve_news_search({**filters, 'q': term}, True, use_and_update_db,
+                                                         shard_by_date=shard_by_date,
+                                                         article_projection=COUNTED_ARTICLE_PROJECTION)
+        if not succeeded:
+            return succeeded, {}, errors
+        urls_by_term[term.lower()] = [article.get('url') for article in result.get('articles')]
+        num_articles_by_term[term.lower()] = result.get('totalResults', -1)
+
+    occurrences_by_term = num_occurrences_of_terms_on_pages(use_and_update_db, urls_by_term, on_progress)
+    result = {term: {**occurrences, 'num_articles': num_articles_by_term[term]}
+              for term, occurrences in occurrences_by_term.items()}
+    return True, result, {}
+
+
+# Return a dict of url -> (dict of term -> count) for each of the pages whose text is stored, given a dict of url -> the
+# terms to count on the page, without retrieving the pages. stored_pages is the pages' entries (see db.retrieve_page_texts,
+# their texts aren't needed).
+# Terms that are a single word are counted from the term index (see db.retrieve_indexed_word_counts). Other terms (e.g.
+# phrases) are only counted in the stored texts of the pages that the index has the term's longest word on, since the
+# term can't be on any other page. The words are matched as substrings of the index's words, so that the counts are the
+# same as counting the terms in the texts (see count_terms_in_text). Pages that aren't in the index yet are counted from
+# their texts (and are indexed in the background, see schedule_page_text_indexing).
+# Pages whose text is no longer stored (e.g. it was just removed) are left out.
+def count_terms_on_stored_pages(terms_by_url: dict, stored_pages: dict) -> dict:
+    indexed_urls = [url for url in terms_by_url if stored_pages[url].get('indexed')]
+    counts_by_url = {url: {} for url in indexed_urls}
+    text_terms_by_url = {url: list(terms) for url, terms in terms_by_url.items() if url not in counts_by_url}
+
+    for term in dict.fromkeys(term for url in indexed_urls for term in terms_by_url[url]):
+        urls = [url for url in indexed_urls if term in terms_by_url[url]]
+        word = get_index_lookup_word(term)
+        word_counts = db.retrieve_indexed_word_counts(word, 'substring', urls) if word is not None else {}
+        for url in urls:
+            if word == term:
+                counts_by_url[url][term] = word_counts.get(url, 0)
+            elif word is not None and url not in word_counts:  # (the term's longest word isn't on the page)
+                counts_by_url[url][term] = 0
+            else:
+                text_terms_by_url.setdefault(url, []).append(term)
+
+    texts = {}
+    if len(text_terms_by_url) > 0:
+        texts = {url: page.get('text') for url, page in db.retrieve_page_texts(list(text_terms_by_url)).items()}
+    for url, terms in text_terms_by_url.items():
+        if url in texts:
+            counts_by_url.setdefault(url, {}).update(count_terms_in_text(terms, texts[url]))
+        else:
+            counts_by_url.pop(url, None)
+    if any(not stored_pages[url].get('indexed') for url in texts):
+        schedule_page_text_indexing()
+    return counts_by_url
+
+
+# Return the number of times the term occurs on the indexed pages (see count_terms_on_stored_pages) of the articles
+# published between the dates, and the number of those pages it occurs on, without retrieving any pages.
+# match is how the term's words are matched against the index's words (one of TERM_INDEX_MATCH_MODES, see
+# db.retrieve_indexed_word_counts). Terms that aren't a single word are counted in the stored texts of the pages that the
+# index has the term's longest word on (so with 'exact', e.g. 'new york' isn't counted on pages that only have 'new yorkers').
+# Returns None if the term doesn't have any words to look up in the index (e.g. it is only punctuation).
+def num_occurrences_in_index(term: str, from_date: datetime, to_date: datetime, match: str = 'exact') -> dict | None:
+    term = term.lower()
+    word = get_index_lookup_word(term)
+    if word is None:
+        return None
+    counts = db.retrieve_indexed_word_counts(word, match, from_date=from_date, to_date=to_date)
+    if word != term:
+        counts = {url: count_term_in_text(term, page.get('text'))
+                  for url, page in db.retrieve_page_texts(list(counts)).items()}
+    return {
+        'num_occurrences': sum(counts.values()),
+        'num_pages': sum(1 for count in counts.values() if count > 0)
+    }
+
+
+# Add any stored page texts that aren't in the term index yet (e.g. that were stored before there was an index) to the
+# index, batch_size at a time, pausing for pause_sec after each batch. Returns the number of pages indexed.
+def index_stored_page_texts(batch_size: int = 100, pause_sec: float = 0) -> int:
+    num_indexed = 0
+    while True:
+        urls = db.retrieve_unindexed_page_text_urls(batch_size)
+        if len(urls) == 0:
+            return num_indexed
+        stored_pages = db.retrieve_page_texts(urls)
+        if not db.insert_term_index({url: get_token_counts(page.get('text')) for url, page in stored_pages.items()},
+                                    {url: page.get('contentHash') for url, page in stored_pages.items()}):
+            return num_indexed
+        num_indexed += len(stored_pages)
+        time.sleep(pause_sec)
+
+
+# The background thread that indexes the stored page texts (see schedule_page_text_indexing), if it was started in this
+# process, and the event that wakes it up when there are new texts to index.
+page_text_indexing_thread = None
+page_text_indexing_thread_lock = threading.Lock()
+page_text_indexing_event = threading.Event()
+
+
+# Have the stored page texts that aren't indexed yet added to the term index by a background thread (see
+# index_stored_page_texts), so that indexing them isn't part of the request that stored them. Texts that are stored while
+# it's indexing are picked up before it's done. Does nothing unless INDEX_PAGE_TEXTS_IN_BACKGROUND is True.
+# (Texts that aren't indexed in the end, e.g. if the process exits first, are indexed once any other texts are stored, or
+# by `python manage.py index-page-texts`)
+def schedule_page_text_indexing():
+    global page_text_indexing_thread
+    if not INDEX_PAGE_TEXTS_IN_BACKGROUND:
+        return
+    with page_text_indexing_thread_lock:
+        if page_text_indexing_thread is None or not page_text_indexing_thread.is_alive():
+            page_text_indexing_thread = threading.Thread(target=page_text_indexing_worker, daemon=True,
+                                                         name='page-text-indexer')
+            page_text_indexing_thread.start()
+    page_text_indexing_event.set()
+
+
+def page_text_indexing_worker():
+    while True:
+        page_text_indexing_event.wait()
+        page_text_indexing_event.clear()
         try:
-            response = requests.get(url)
-            if response.status_code != 200:
-                return -1
+            index_stored_page_texts(PAGE_TEXT_INDEXING_BATCH_SIZE, PAGE_TEXT_INDEXING_PAUSE_SEC)
+        except Exception as e:
+            print('Error indexing page texts:', e)
 
-            html_content = response.content
 
-            # Parse the HTML content
-            soup = BeautifulSoup(html_content, 'html.parser')
-            main_text = soup.get_text()
-            pattern = re.escape(term)
+# A forked child process doesn't have the parent's thread, so it starts its own (and the lock may have been held).
+def reset_after_fork():
+    global page_text_indexing_thread, page_text_indexing_thread_lock, page_text_indexing_event
+    page_text_indexing_thread = None
+    page_text_indexing_thread_lock = threading.Lock()
+    page_text_indexing_event = threading.Event()
 
-            # Find the number of occurrences
-            count = len(re.findall(pattern, main_text, re.IGNORECASE))
 
-            # Update the db with the found term's count
-            if use_and_update_db:
-                article_filter = {'url': url}
-
-                # Update or insert a new term in the termCounts list for this new term and count
-                update = {
-                    '$push': {
-                        'termCounts': {
-                            'term': term,
-                            'count': count
-                        }
-                    }
-                }
-                db.update_or_create_entry('articles', article_filter, update)
-            return count
-        except Exception:  # Unknown error, return -1 to indicate so.
-            return -1
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+# Same as retrieve_page, unless the url's domain is currently failing (see pages.DomainCircuitBreaker), in which case
+# the page isn't retrieved and a dict with 'skipped' as True is returned.
+def retrieve_page_unless_domain_failing(url: str, stored_page: dict = None) -> dict:
+    domain = pages.get_domain(url)
+    if not pages.circuit_breaker.allow_request(domain):
+        return {'skipped': True}
+    page = retrieve_page(url, stored_page)
+    if page.get('poolTimeout'):
+        pages.circuit_breaker.cancel_request(domain)
+    else:
+        pages.circuit_breaker.record_result(domain, not page.get('failed'))
+    return page
+
+
+# Return how long a page that failed to be retrieved with the given status code (None if there was no response) is
+# skipped for. Client errors (e.g. paywalls and blocked requests) are unlikely to change soon, so they're skipped longer.
+def get_page_failure_ttl(status_code: int | None) -> timedelta:
+    if status_code is not None and 400 <= status_code < 500:
+        return PAGE_CLIENT_ERROR_FAILURE_TTL
+    return PAGE_FAILURE_TTL
+
+
+# Retrieve the webpage and return a dict with its 'text', and its 'etag' and 'lastModified' headers, without using the db.
+# The page is read as it's downloaded (up to pages.MAX_PAGE_BYTES) and its text is extracted with the default backend
+# of the extraction module, which leaves out scripts, styles, etc.
+# If the page's stored entry is given (see db.retrieve_page_texts), then the page is only downloaded if it changed since
+# (using a conditional request). If it didn't change, then the stored text is returned and 'notModified' is True.
+# If there is an error in retrieving the page, then return a dict with 'failed' as True and the response's 'status' (or
+# None if there was no response). If the request timed out waiting for a free connection of our own (see
+# sessions.with_pool_timeout), then 'poolTimeout' is also True, since it says nothing about the page or its site.
+def retrieve_page(url: str, stored_page: dict = None) -> dict:
+    request_headers = {}
+    if stored_page is not None:
+        if stored_page.get('etag') is not None:
+            request_headers['If-None-Match'] = stored_page.get('etag')
+        if stored_page.get('lastModified') is not None:
+            request_headers['If-Modified-Since'] = stored_page.get('lastModified')
+
+    response = None
+    try:
+        with metrics.time_stage('page.fetch'):
+            response = pages.session.get(url, headers=request_headers, timeout=pages.REQUEST_TIMEOUT_SEC, stream=True)
+        page = {
+            'etag': response.headers.get('ETag'),
+            'lastModified': response.headers.get('Last-Modified'),
+            'notModified': False
+        }
+        if response.status_code == 304 and len(request_headers) > 0:
+            metrics.increment_counter('page_retrievals_total', {'result': 'not_modified'})
+            return {**stored_page, 'notModified': True}
+        if response.status_code != 200:
+            metrics.increment_counter('page_retrievals_total', {'result': 'error_status'})
+            return {'failed': True, 'status': response.status_code}
+
+        # (The page's content is read as the text is extracted, so this also includes the time to download it)
+        with metrics.time_stage('page.extract'):
+            page['text'] = extraction.extract_text(pages.iter_page_content(response), pages.get_response_encoding(response))
+        metrics.increment_counter('page_retrievals_total', {'result': 'retrieved'})
+        return page
+    except PoolError:
+        metrics.increment_counter('page_retrievals_total', {'result': 'pool_timeout'})
+        return {'failed': True, 'status': None, 'poolTimeout': True}
+    except Exception:  # Unknown error (e.g. a timeout, or an unknown encoding), return that it failed without a status.
+        metrics.increment_counter('page_retrievals_total', {'result': 'error'})
+        return {'failed': True, 'status': None}
+    finally:
+        # (Closing the response returns its connection to the pool, even if the page wasn't read to the end)
+        if response is not None:
+            response.close()
+
+
+# Return the number of times the term occurs in the text. The search is not case-sensitive.
+def count_term_in_text(term: str, text: str) -> int:
+    return count_terms_in_text([term], text).get(term.lower())
+
+
+# Return a dict of term -> the number of times the term occurs in the text, for each of the terms (lowercased).
+# The search is not case-sensitive, and occurrences of the same term don't overlap (like re.findall).
+# The text is lowercased once for all terms, and each term is then counted with str.count, which scans the text in C
+# and is faster than matching all the terms together in Python for the few terms that are compared at once.
+def count_terms_in_text(terms: list, text: str) -> dict:
+    text = text.lower()
+    return {term.lower(): text.count(term.lower()) for term in terms}
+
+
+# Return a dict of token -> the number of times it occurs in the text, where the tokens are the text's words (runs of
+# word characters), lowercased. These are what the term index is made of (see db.insert_term_index).
+def get_token_counts(text: str) -> dict:
+    return dict(Counter(WORD_PATTERN.findall(text.lower())))
+
+
+# Return the word of the (lowercase) term to look up in the term index: the term itself if it's a single word, otherwise
+# its longest word (every page the term occurs on has a token containing each of its words). None if it has no words.
+def get_index_lookup_word(term: str) -> str | None:
+    words = WORD_PATTERN.findall(term)
+    return max(words, key=len) if len(words) > 0 else None